@@ -1,7 +1,83 @@
 from dataclasses import dataclass
 from datetime import datetime
 from typing import Union
-from enum import Enum
+from enum import Enum, IntFlag
+import itertools
+import socket
+import struct
+import zlib
+
+
+# sender, sender_time, rsvd, port, dlen, dtype
+HEADER = struct.Struct('>32sI14sHQI')
+HEADER_SIZE = HEADER.size
+DLEN_OFFSET = 52
+DLEN = struct.Struct('>Q')
+DTYPE_OFFSET = 60
+DTYPE = struct.Struct('>I')
+# transfer_id, offset of XFER_* payloads
+TRANSFER_HEADER = struct.Struct('>QQ')
+RECV_BUFFER_SIZE = 64 * 1024
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+# rsvd[0]: how this packet's payload is encoded, rsvd[1]: what the sender can decode,
+# rsvd[2]: how many times it was relayed (then `sender` is its author, not the peer it came from),
+# rsvd[3:11]: the version of the roster change an ACCEPT/NEW_USR/DEL_USR carries (see `roster.Membership`)
+RSVD_SIZE = 14
+FLAGS = 0
+CAPABILITIES = 1
+HOPS = 2
+MAX_HOPS = 255
+ROSTER_VERSION = 3
+VERSION = struct.Struct('>Q')
+# binary ACCEPT/NEW_USR/DEL_USR payloads: format, members; then for ROSTER_IPV4 an entry per member
+# and the utf-8 names separated by NULs, for ROSTER_ADDRESSES the ports and the NUL separated names and addresses
+ROSTER_HEADER = struct.Struct('>BI')
+ROSTER_IPV4 = 1
+ROSTER_ADDRESSES = 2
+ROSTER_ENTRY = struct.Struct('>4sH') # IPv4 address, port
+MAX_CACHED_ROSTER = 1024 # members of rosters decoded with a struct of their own
+ADDRESS_CACHE_SIZE = 4096
+COMPRESS_THRESHOLD = 128
+# seeds zlib with what peer maps are made of, so even short ones compress
+ROSTER_DICTIONARY = (
+    b'unknown:2137;:2137;127.0.0.1:192.168.0.:192.168.1.:10.0.0.:172.17.0.:172.18.0.:'
+    b'0123456789;:0123456789;:'
+)
+# the same for binary rosters: runs of entries (address, port 2137) from common networks
+BINARY_ROSTER_DICTIONARY = b'unknown\0user\0' + b''.join(
+    bytes(address) + b'\x08\x59' for address in [
+        (127, 0, 0, 1), (10, 0, 0, 1), (10, 0, 0, 2), (10, 0, 0, 3), (172, 17, 0, 2), (172, 17, 0, 3), (172, 17, 0, 4),
+        (192, 168, 1, 1), (192, 168, 1, 2), (192, 168, 1, 3), (192, 168, 0, 1), (192, 168, 0, 2), (192, 168, 0, 3), (192, 168, 0, 4),
+    ]
+)
+
+
+class Flags(IntFlag):
+    COMPRESSED = 0x1 # zlib
+    DICTIONARY = 0x2 # zlib with ROSTER_DICTIONARY (BINARY_ROSTER_DICTIONARY for a BINARY payload)
+    BINARY = 0x4 # the roster is in the binary format
+
+
+class Capability(IntFlag):
+    ZLIB = 0x1
+    ZLIB_DICT = 0x2
+    HEARTBEAT = 0x4 # answers RUA with IAA
+    BINARY_ROSTER = 0x8
+
+
+SUPPORTED_CAPABILITIES = Capability.ZLIB | Capability.ZLIB_DICT | Capability.HEARTBEAT | Capability.BINARY_ROSTER
+# the same as plain ints, IntFlag operators build a new object each time
+_BINARY = int(Flags.BINARY)
+_BINARY_ROSTER = int(Capability.BINARY_ROSTER)
+_ZLIB = int(Capability.ZLIB)
+_ZLIB_DICT = int(Capability.ZLIB_DICT)
+_ZLIB_MASK = _ZLIB | _ZLIB_DICT
+_COMPRESSION_MASK = int(Flags.COMPRESSED | Flags.DICTIONARY)
+_COMPRESSED_WITH_DICTIONARY = Flags.COMPRESSED | Flags.DICTIONARY
+_SUPPORTED = int(SUPPORTED_CAPABILITIES)
+_CAPABILITIES = [Capability(i & _SUPPORTED) for i in range(256)] # rsvd[CAPABILITIES] -> Capability
+_NEW_RSVD = bytes([0, _SUPPORTED]) + bytes(RSVD_SIZE - 2)
 
 
 class PayloadType(Enum):
@@ -15,6 +91,28 @@ class PayloadType(Enum):
     IAA = 0x8
     NEW_USR = 0x9
     DEL_USR = 0xA
+    XFER_BEGIN = 0xB
+    XFER_CHUNK = 0xC
+    XFER_END = 0xD
+
+
+ROSTER_TYPES = frozenset({PayloadType.ACCEPT, PayloadType.NEW_USR, PayloadType.DEL_USR})
+
+@dataclass
+class Transfer:
+    """
+    Payload of the `XFER_*` packets, one file streamed in chunks:
+
+    1. `XFER_BEGIN`: `offset` = total size, `data` = file name (utf-8)
+
+    2. `XFER_CHUNK`: `data` = file contents starting at `offset`
+
+    3. `XFER_END`: `offset` = total size, `data` empty
+    """
+    transfer_id: int
+    offset: int
+    data: Union[bytes, memoryview] = b''
+
 
 @dataclass
 class Packet:
@@ -24,19 +122,62 @@ class Packet:
     port: Union[int, None]
     dlen: int
     dtype: PayloadType
-    payload: Union[None, dict[str, int], str]
+    payload: Union[None, dict[str, int], str, Transfer]
 
-    def to_bytearray(self) -> bytearray:
-        sender = bytearray(b''.join([bytes(self.sender[i], encoding='ascii') if i < len(self.sender) else b'\x00' for i in range(32)]))
-        sender_time = Packet._serialize_int(int(self.sender_time.timestamp()), 4)
-        if self.port:
-            port = Packet._serialize_int(self.port, 2)
-        else:
-            port = b'\x00' * 2
-        dlen = Packet._serialize_int(self.dlen, 8)
-        dtype = Packet._serialize_int(self.dtype.value, 4)
-        payload = Packet._serialize_payload(self.dtype, self.payload)
-        return sender + sender_time + self.rsvd + port + dlen + dtype + payload
+    @property
+    def capabilities(self) -> Capability:
+        return _CAPABILITIES[self.rsvd[CAPABILITIES]]
+
+    @property
+    def hops(self) -> int:
+        return self.rsvd[HOPS]
+
+    @property
+    def roster_version(self) -> int:
+        return VERSION.unpack_from(self.rsvd, ROSTER_VERSION)[0]
+
+    @roster_version.setter
+    def roster_version(self, version: int):
+        VERSION.pack_into(self.rsvd, ROSTER_VERSION, version)
+
+    def to_bytearray(self, compress: Capability = 0) -> bytearray:
+        """
+        `compress` - what the receiver can decode. Rosters are then sent in
+        the binary format and payloads of at least `COMPRESS_THRESHOLD`
+        bytes (rosters of any size, with a dictionary) compressed if that
+        makes them smaller.
+        """
+        rsvd = self.rsvd
+        dlen = self.dlen
+        payload = None
+        if compress:
+            compress = int(compress)
+            if compress & _BINARY_ROSTER and self.dtype in ROSTER_TYPES:
+                payload = Packet._serialize_roster(self.payload)
+                if payload is not None:
+                    dlen = len(payload)
+                    rsvd = bytes([rsvd[FLAGS] | _BINARY]) + rsvd[FLAGS + 1:]
+        if payload is None:
+            payload = Packet._serialize_payload(self.dtype, self.payload)
+        # rosters compress well even when short, thanks to the dictionaries
+        if compress & _ZLIB_MASK and (len(payload) >= COMPRESS_THRESHOLD or compress & _ZLIB_DICT and self.dtype in ROSTER_TYPES):
+            flags, compressed = Packet._compress(self.dtype, payload, compress, rsvd[FLAGS])
+            if flags and len(compressed) < len(payload):
+                payload = compressed
+                dlen = len(payload)
+                rsvd = bytes([rsvd[FLAGS] | flags]) + rsvd[FLAGS + 1:]
+        b = bytearray(HEADER_SIZE + len(payload))
+        HEADER.pack_into(
+            b, 0,
+            self.sender.encode('ascii'),
+            int(self.sender_time.timestamp()),
+            rsvd,
+            self.port if self.port else 0,
+            dlen,
+            self.dtype.value,
+        )
+        b[HEADER_SIZE:] = payload
+        return b
     
     @classmethod
     def new(cls, sender: str, dtype: PayloadType, payload: Union[None, dict[str, int], str], port=None):
@@ -48,6 +189,8 @@ class Packet:
             2. PayloadType.MSG | PayloadType.WHISPER | PayloadType.ERROR: payload = str
 
             3. PayloadType.JOIN | PayloadType.RUA | PayloadType.IAA: payload = None
+
+            4. PayloadType.XFER_BEGIN | PayloadType.XFER_CHUNK | PayloadType.XFER_END: payload = Transfer
         """
         dlen = 0
         match dtype:
@@ -55,12 +198,14 @@ class Packet:
                 dlen = len(Packet._serialize_payload(dtype, payload))
             case PayloadType.MSG | PayloadType.WHISPER | PayloadType.ERROR: 
                 dlen = len(bytearray(payload, encoding='utf-8'))
+            case PayloadType.XFER_BEGIN | PayloadType.XFER_CHUNK | PayloadType.XFER_END:
+                dlen = TRANSFER_HEADER.size + len(payload.data)
             case _: 
                 dlen = 0
         return cls(
             sender,
             datetime.today(),
-            bytearray(b'\x00' * 14),
+            bytearray(_NEW_RSVD),
             port,
             dlen,
             dtype,
@@ -68,37 +213,142 @@ class Packet:
         )
 
     @classmethod
-    def from_raw(cls, b: bytearray):
-        sender = Packet._parse_sender(b[0:32:])
-        sender_time = Packet._parse_sender_time(b[32:36:])
-        rsvd = b[36:50:]
-        port = Packet._parse_number(b[50:52])
-        dlen = Packet._parse_number(b[52:60:])
-        dtype = PayloadType(value=Packet._parse_number(b[60:64:]))
-        payload = Packet._parse_payload(dtype, b[64::])
-
-        return cls(sender, sender_time, rsvd, port if port != 0 else None, dlen, dtype, payload)
+    def from_raw(cls, b: Union[bytearray, memoryview]):
+        """
+        Parses a raw packet. Works on `memoryview`s without copying them,
+        the payload is decoded straight from the underlying buffer.
+        """
+        sender, sender_time, rsvd, port, dlen, dtype = HEADER.unpack_from(b)
+        dtype = PayloadType(value=dtype)
+        raw_payload = b[HEADER_SIZE::]
+        rsvd = bytearray(rsvd)
+        if rsvd[FLAGS] & _COMPRESSION_MASK:
+            # hand back the packet as it was before compression
+            raw_payload = Packet._decompress(raw_payload, Flags(rsvd[FLAGS]))
+            dlen = len(raw_payload)
+            rsvd[FLAGS] &= ~_COMPRESSION_MASK
+        if rsvd[FLAGS] & _BINARY and dtype in ROSTER_TYPES:
+            # it's re-encoded for whoever it's relayed to
+            payload = Packet._parse_roster(raw_payload)
+            rsvd[FLAGS] &= ~_BINARY
+        else:
+            payload = Packet._parse_payload(dtype, raw_payload)
+
+        return cls(
+            Packet._parse_sender(sender),
+            datetime.fromtimestamp(sender_time),
+            rsvd,
+            port if port != 0 else None,
+            dlen,
+            dtype,
+            payload
+        )
     
+    @staticmethod
+    def peek_dtype(b: bytearray) -> PayloadType:
+        """
+        Reads only the payload type of a raw packet, without decoding the rest.
+        """
+        return PayloadType(value=DTYPE.unpack_from(b, DTYPE_OFFSET)[0])
+
+    @staticmethod
+    def _compress(dtype: PayloadType, payload: bytes, compress: int, flags: int = 0) -> tuple[Flags, bytes]:
+        match dtype:
+            case PayloadType.ACCEPT | PayloadType.NEW_USR | PayloadType.DEL_USR if compress & _ZLIB_DICT:
+                c = zlib.compressobj(zdict=BINARY_ROSTER_DICTIONARY if flags & _BINARY else ROSTER_DICTIONARY)
+                return _COMPRESSED_WITH_DICTIONARY, c.compress(payload) + c.flush()
+            case PayloadType.ACCEPT | PayloadType.NEW_USR | PayloadType.DEL_USR | PayloadType.MSG | PayloadType.WHISPER | PayloadType.ERROR if compress & _ZLIB:
+                return Flags.COMPRESSED, zlib.compress(payload)
+            case _:
+                return Flags(0), payload
+
+    @staticmethod
+    def _decompress(payload: bytes, flags: Flags) -> bytes:
+        if Flags.DICTIONARY in flags:
+            d = zlib.decompressobj(zdict=BINARY_ROSTER_DICTIONARY if Flags.BINARY in flags else ROSTER_DICTIONARY)
+        else:
+            d = zlib.decompressobj()
+        data = d.decompress(payload, MAX_PAYLOAD_SIZE)
+        if d.unconsumed_tail:
+            raise ValueError(f'Decompressed payload larger than {MAX_PAYLOAD_SIZE} bytes')
+        return data
+
     @staticmethod
     def _serialize_payload(dtype: PayloadType, payload: Union[None, dict[str, int], str]) -> bytearray:
         match dtype:
             case PayloadType.ACCEPT | PayloadType.NEW_USR | PayloadType.DEL_USR: 
-                res = ''
-                for k, v in payload.items():
-                    res += f'{k}:{v}'
+                # addresses are 'ip[:port]' when built, (ip, port) when parsed (and relayed)
+                res = ';'.join(f'{k}:{v if isinstance(v, str) else f"{v[0]}:{v[1]}"}' for k, v in payload.items())
                 return bytearray(res, encoding='utf-8')
             case PayloadType.MSG | PayloadType.WHISPER | PayloadType.ERROR: 
                 return bytearray(payload, encoding='utf-8')
+            case PayloadType.XFER_BEGIN | PayloadType.XFER_CHUNK | PayloadType.XFER_END:
+                return TRANSFER_HEADER.pack(payload.transfer_id, payload.offset) + payload.data
             case _: return bytearray()
 
     @staticmethod
-    def _parse_sender(b: bytearray) -> str:
-        sender = ''
-        for byte in b:
-            if byte == 0:
-                break
-            sender += chr(byte)
-        return sender
+    def _serialize_roster(payload: dict) -> bytes | None:
+        """
+        The binary form of a roster, None if it can't be put in one (a name
+        with a NUL or a port out of range), then it's sent as text.
+        """
+        n = len(payload)
+        addresses = payload.values()
+        try:
+            try:
+                # usually all of them are IPv4 addresses seen before, an entry each
+                entries = [ROSTER_ENTRY.pack(_packed_ipv4[ip], port) for ip, port in addresses]
+            except (KeyError, ValueError):
+                if str in map(type, addresses):
+                    addresses = list(map(_split_address, addresses))
+                entries = [ROSTER_ENTRY.pack(_packed_ipv4.get(ip) or _pack_ipv4(ip), port) for ip, port in addresses]
+            names = '\0'.join(payload)
+            if names.count('\0') != max(n - 1, 0):
+                return None
+            return b''.join([ROSTER_HEADER.pack(ROSTER_IPV4, n), *entries, names.encode('utf-8')])
+        except OSError:
+            names = '\0'.join([*payload, *(ip for ip, _ in addresses)])
+            if names.count('\0') != max(2 * n - 1, 0):
+                return None
+            return b''.join([ROSTER_HEADER.pack(ROSTER_ADDRESSES, n), struct.pack(f'>{n}H', *(port for _, port in addresses)), names.encode('utf-8')])
+        except struct.error:
+            return None
+
+    @staticmethod
+    def _parse_roster(b: Union[bytes, memoryview]) -> dict[str, tuple[str, int]]:
+        """
+        Decodes a binary roster straight from `b`, only the names and
+        addresses themselves are copied out.
+        """
+        b = memoryview(b)
+        kind, n = ROSTER_HEADER.unpack_from(b)
+        start = ROSTER_HEADER.size
+        if kind == ROSTER_IPV4:
+            end = start + ROSTER_ENTRY.size * n
+            if end > len(b):
+                raise ValueError(f'Roster of {n} members is only {len(b)} bytes')
+            if n <= MAX_CACHED_ROSTER:
+                fields = _roster_struct(n).unpack_from(b, start)
+            else:
+                fields = tuple(itertools.chain.from_iterable(ROSTER_ENTRY.iter_unpack(b[start:end])))
+            names = str(b[end:], 'utf-8').split('\0') if n else []
+            ips, ports = _unpack_ipv4(fields[::2]), fields[1::2]
+        elif kind == ROSTER_ADDRESSES:
+            end = start + 2 * n
+            if end > len(b):
+                raise ValueError(f'Roster of {n} members is only {len(b)} bytes')
+            ports = struct.unpack_from(f'>{n}H', b, start)
+            names = str(b[end:], 'utf-8').split('\0') if n else []
+            names, ips = names[:n], names[n:]
+        else:
+            raise ValueError(f'Unknown roster format {kind}')
+        if len(names) != n or len(ips) != n or not n and end != len(b):
+            raise ValueError(f'Roster of {n} members doesn\'t match its {len(b)} bytes')
+        return dict(zip(names, zip(ips, ports)))
+
+    @staticmethod
+    def _parse_sender(b: bytes) -> str:
+        return b.split(b'\x00', 1)[0].decode('latin-1')
 
     @staticmethod
     def _parse_payload(dtype: PayloadType, b: bytearray) -> Union[None, dict[str, int], str]:
@@ -106,7 +356,7 @@ class Packet:
             case PayloadType.ACCEPT | PayloadType.NEW_USR | PayloadType.DEL_USR: 
                 mapping = {}
                 if len(b) > 0:
-                    for s in b.decode('utf-8').split(';'):
+                    for s in str(b, encoding='utf-8').split(';'):
                         spl = s.split(':')
                         name = spl[0]
                         if len(spl) == 3:
@@ -117,40 +367,132 @@ class Packet:
                 return mapping
             case PayloadType.MSG | PayloadType.WHISPER | PayloadType.ERROR: 
                 return str(b, encoding='utf-8')
+            case PayloadType.XFER_BEGIN | PayloadType.XFER_CHUNK | PayloadType.XFER_END:
+                transfer_id, offset = TRANSFER_HEADER.unpack_from(b)
+                # `b` may be a view into a reused receive buffer
+                return Transfer(transfer_id, offset, bytes(b[TRANSFER_HEADER.size:]))
             case _: return None
 
-    @staticmethod
-    def _parse_number(b: bytearray) -> int:
-        mul = 1
-        number = 0
 
-        for byte in reversed(b):
-            number += byte * mul
-            mul <<= 8
+_packed_ipv4: dict[str, bytes] = {}
+_unpacked_ipv4: dict[bytes, str] = {}
+_roster_structs: dict[int, struct.Struct] = {}
 
-        return number
 
-    @staticmethod
-    def _parse_sender_time(b: bytearray) -> datetime.date:
-        return datetime.fromtimestamp(Packet._parse_number(b))
-    
-    @staticmethod
-    def _serialize_int(n: int, length: int) -> bytearray:
-        return Packet._pad_with_zeros(Packet._int_as_bytes(n), length)
-    
-    @staticmethod
-    def _int_as_bytes(n: int) -> bytearray:
-        res = []
-        while n > 0:
-            res.insert(0, n & 0xff)
-            n >>= 8
-        return bytearray(res)
+def _pack_ipv4(ip: str) -> bytes:
+    """
+    `ip` packed and cached, rosters repeat the same addresses. Raises
+    OSError if it isn't an IPv4 address.
+    """
+    if len(_packed_ipv4) > ADDRESS_CACHE_SIZE:
+        _packed_ipv4.clear()
+    packed = _packed_ipv4[ip] = socket.inet_pton(socket.AF_INET, ip)
+    return packed
 
-    @staticmethod
-    def _pad_with_zeros(b: bytearray, length: int) -> bytearray:
-        while len(b) < length:
-            b.insert(0, 0x0)
-        return b
+
+def _unpack_ipv4(packed: tuple[bytes, ...]) -> list[str]:
+    """
+    The addresses `packed`, the same cache the other way round.
+    """
+    try:
+        return list(map(_unpacked_ipv4.__getitem__, packed))
+    except KeyError:
+        if len(_unpacked_ipv4) > ADDRESS_CACHE_SIZE:
+            _unpacked_ipv4.clear()
+        return [_unpacked_ipv4.get(p) or _unpacked_ipv4.setdefault(p, socket.inet_ntoa(p)) for p in packed]
+
+
+def _roster_struct(n: int) -> struct.Struct:
+    """
+    `ROSTER_ENTRY` `n` times, unpacks a whole roster in one call.
+    """
+    s = _roster_structs.get(n)
+    if s is None:
+        if len(_roster_structs) >= 64:
+            _roster_structs.clear()
+        s = _roster_structs[n] = struct.Struct('>' + '4sH' * n)
+    return s
+
+
+def _split_address(addr: Union[str, tuple[str, int]]) -> tuple[str, int]:
+    """
+    (ip, port) of an 'ip[:port]' string or an (ip, port) tuple.
+    """
+    if not isinstance(addr, str):
+        return addr[0], int(addr[1])
+    if addr.count(':') == 1:
+        ip, port = addr.split(':')
+        return ip, int(port)
+    return addr, 2137
+
+
+class FrameReader:
+    """
+    Reassembles whole packets from a TCP byte stream.
+
+    Data is received straight into a preallocated, reusable buffer with
+    `recv_into` (or copied in with `feed`). `frames` then yields a
+    `memoryview` of every complete packet (header + `dlen` bytes of payload)
+    and keeps the trailing partial frame buffered until the next read.
+    Yielded views point into the buffer and must be consumed before the
+    next frame is requested.
+    """
+    def __init__(self, size: int = RECV_BUFFER_SIZE, max_payload: int = MAX_PAYLOAD_SIZE):
+        self.max_payload = max_payload
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0 # first unconsumed byte
+        self._end = 0 # end of received data
+
+    def __len__(self):
+        return self._end - self._start
+
+    def recv_into(self, sock) -> int:
+        if self._end == len(self._buf):
+            self._reserve(len(self._buf) // 2)
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        return n
+
+    def feed(self, data: bytes):
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self):
+        try:
+            while self._end - self._start >= HEADER_SIZE:
+                start = self._start
+                dlen, = DLEN.unpack_from(self._buf, start + DLEN_OFFSET)
+                if dlen > self.max_payload:
+                    raise ValueError(f'Payload too large ({dlen} bytes)')
+                end = start + HEADER_SIZE + dlen
+                if self._end < end:
+                    # make sure the rest of this frame fits before the next read
+                    self._reserve(end - self._end)
+                    break
+                self._start = end
+                yield self._view[start:end]
+        finally:
+            if self._start == self._end:
+                self._start = self._end = 0
+
+    def _reserve(self, n: int):
+        """
+        Makes room for `n` more bytes after the buffered data, moving the
+        partial frame to the front or growing the buffer if needed.
+        """
+        if len(self._buf) - self._end >= n:
+            return
+        pending = self._end - self._start
+        if pending + n <= len(self._buf):
+            self._buf[:pending] = self._buf[self._start:self._end]
+        else:
+            buf = bytearray(max(pending + n, 2 * len(self._buf)))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start, self._end = 0, pending
 
 
 # test
@@ -159,7 +501,8 @@ if __name__ == '__main__':
         raw_packet = bytearray(
             b'User1\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + # sender
             b'\x12\x34\x56\x78' + #  sender_time
-            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + # rsvd
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + # rsvd
+            b'\x08\x59' + # port
             b'\x00\x00\x00\x00\x00\x00\x00\x05' + # dlen
             b'\x00\x00\x00\x04' + # dtype
             b'hello' # payload 
@@ -167,8 +510,9 @@ if __name__ == '__main__':
 
         packet = Packet(
             'User1',
-            datetime(1979, 9, 6, 0, 51, 36),
-            bytearray(b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'),
+            datetime.fromtimestamp(0x12345678),
+            bytearray(b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'),
+            2137,
             0x5,
             PayloadType.MSG,
             'hello'
@@ -181,6 +525,27 @@ if __name__ == '__main__':
         assert packet == Packet.from_raw(packet.to_bytearray())
         assert raw_packet == Packet.from_raw(raw_packet).to_bytearray()
 
+        # two packets and a half in one read, the rest in the next one
+        reader = FrameReader(size=128)
+        stream = raw_packet * 3
+        reader.feed(stream[:-10])
+        assert [Packet.from_raw(f) for f in reader.frames()] == [packet, packet]
+        reader.feed(stream[-10:])
+        assert [Packet.from_raw(f) for f in reader.frames()] == [packet]
+        assert len(reader) == 0
+
+        chunk = Packet.new('User1', PayloadType.XFER_CHUNK, Transfer(7, 1 << 40, memoryview(b'\x00\xff' * 100)[1:]))
+        parsed = Packet.from_raw(chunk.to_bytearray())
+        assert parsed.payload == Transfer(7, 1 << 40, b'\xff' + b'\x00\xff' * 99)
+        assert parsed.dlen == chunk.dlen == 16 + 199
+
+        roster = Packet.new('user', PayloadType.NEW_USR, {'alice': '10.0.0.1', 'bob': '10.0.0.2:2138'})
+        roster.roster_version = 1 << 40
+        parsed = Packet.from_raw(roster.to_bytearray())
+        assert parsed.roster_version == 1 << 40 and parsed.hops == 0
+        assert parsed.payload == {'alice': ('10.0.0.1', 2137), 'bob': ('10.0.0.2', 2138)}
+        assert Packet.from_raw(parsed.to_bytearray()) == parsed
+
         print("All tests passed successfully.")
     
     test()
@@ -1,4 +1,9 @@
 from app_logic import AppLogic
+from async_server import AsyncServer
+from datetime import datetime
+from identity import DEFAULT_DIR, KEY_PROFILES
+from profiler import SamplingProfiler
+from render import Renderer
 from tui import Tui
 from threading import Thread
 import argparse
@@ -7,11 +12,19 @@ import sys
 
 
 class App:
-    def __init__(self, username: str, port: int = 2137, passwd=None, public: str = None, private: str = None, delete_keys: bool = True):
+    def __init__(self, username: str, port: int = 2137, passwd=None, public: str = None, private: str = None, delete_keys: bool = True, profile: str = None, profile_rate: float = 100.0, render_rate: float = 30.0, render_lines: int = 50, **server_options):
         self.tui = Tui(self, username)
-        self.app_logic = AppLogic(self, username, port=port, passwd=passwd, public=public, private=private, delete_keys=delete_keys)
+        # the network threads only queue what they show, the terminal can't slow them down
+        self.renderer = Renderer(render_rate, render_lines, prompt=lambda: self.tui.reading, history=server_options.get('keep_history', False))
+        self.app_logic = AppLogic(self, username, port=port, passwd=passwd, public=public, private=private, delete_keys=delete_keys, output=self.renderer.write, output_message=self.renderer.message, **server_options)
+        self.profile_path = profile
+        self.profile_rate = profile_rate
+        self.profiler: SamplingProfiler = None
 
     def run(self):
+        if self.profile_path:
+            self.profile('start')
+        self.renderer.start()
         self.tui_thread = Thread(target=self.tui.run, name='tui_thread')
         self.app_logic_thread = Thread(target=self.app_logic.run, name='app_logic_thread')
         
@@ -22,21 +35,67 @@ class App:
         self.app_logic_thread.join()
 
     def stop(self):
+        if self.profiler and self.profiler.running:
+            print(self.profile('stop'))
         self.tui.stop()
         self.app_logic.stop()
+        self.renderer.stop()
+
+    def profile(self, action: str) -> str:
+        match action:
+            case 'start':
+                if self.profiler and self.profiler.running:
+                    return 'The profiler is already running'
+                self.profiler = SamplingProfiler(self.profile_rate)
+                self.profiler.start()
+                return f'Profiling at {self.profile_rate:g} Hz, /profile stop to write the stacks'
+            case 'stop':
+                if not (self.profiler and self.profiler.running):
+                    return 'The profiler isn\'t running'
+                self.profiler.stop()
+                path = self.profile_path or f'profile-{datetime.now():%Y%m%d-%H%M%S}.collapsed'
+                try:
+                    stacks = self.profiler.write(path)
+                except OSError as e:
+                    return f'Couldn\'t write the profile to {path}: {e}'
+                return f'Wrote {stacks} stacks ({self.profiler.samples} samples) to {path}'
+            case _:
+                return f'Unknown profiler action `{action}`, use start or stop'
     
     def send(self, *args):
         self.app_logic.send(*args)
 
+    def send_file(self, *args):
+        return self.app_logic.send_file(*args)
+
     def sendall(self, *args):
-        self.app_logic.sendall(*args)
+        return self.app_logic.sendall(*args)
+
+    def history(self, *args):
+        return self.app_logic.history(*args)
+
+    def search(self, *args):
+        return self.app_logic.search(*args)
 
     def find_by_username(self, *args):
         return self.app_logic.find_by_username(*args)
 
+    def stats(self):
+        metrics = self.app_logic.server.metrics
+        return metrics.summary() if metrics else 'Metrics are off, start with --metrics'
+
+    def pool_stats(self):
+        server = self.app_logic.server
+        if isinstance(server, AsyncServer):
+            return 'There is no connection pool with --engine asyncio, every connection is opened anew'
+        return server.pool.stats()
+
     def users_list(self):
         return self.app_logic.server.users
     
+    def accept(self, *args):
+        self.app_logic.accept(*args)
+
     def join(self, *args, **kwargs):
         self.app_logic.join(*args, **kwargs)
 
@@ -46,6 +105,9 @@ class App:
     def exit_conversation(self):
         self.app_logic.exit_conversation()
 
+    def set_flush_delay(self, *args):
+        self.app_logic.set_flush_delay(*args)
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -71,8 +133,34 @@ def main():
     parser.add_argument('-u', '--username', required=True, type=str, help='Your username that will be used in communication.')
     parser.add_argument('-P', '--password', required='--keys' not in sys.argv and '-k' not in sys.argv, help='Passphrase for generating public-private key pair.')
     parser.add_argument('-p', '--port', type=int, default=2137, help='Optional TCP port for the main socket. The default is 2137.')
-    parser.add_argument('--delete-keys', type=bool, default='--keys' not in sys.argv and '-k' not in sys.argv, help='If the keys used for communication encryption should be deleted, True on default.')
+    parser.add_argument('--delete-keys', type=bool, default=False, help='If the keys used for communication encryption should be deleted on exit instead of being cached for the next launch, False on default.')
+    parser.add_argument('--identity-dir', type=str, default=DEFAULT_DIR, help=f'Directory where generated keys are cached (encrypted with the passphrase). The default is {DEFAULT_DIR}.')
+    parser.add_argument('--high-water', type=int, default=1024 * 1024, help='Max bytes queued for a single peer before the overflow policy kicks in. The default is 1 MiB.')
+    parser.add_argument('--overflow', choices=['drop', 'block'], default='drop', help='What to do with messages for a peer whose queue is full: drop them right away or block for a while. The default is drop.')
+    parser.add_argument('--engine', choices=['select', 'asyncio'], default='select', help='Networking engine: a select() loop or asyncio streams (better for large rooms). The default is select.')
+    parser.add_argument('--key-profile', choices=KEY_PROFILES, default='p256', help='Type of the generated key: ECDSA P-256, Ed25519 or RSA-2048. The default is p256.')
+    parser.add_argument('--flush-delay', type=float, default=0, help='Milliseconds to hold outgoing messages back so that bursts go out in one write (changeable per conversation with /flush-delay). The default is 0 - send right away.')
+    parser.add_argument('--flush-bytes', type=int, default=16 * 1024, help='Max bytes coalesced into one write. The default is 16 KiB (one TLS record).')
+    parser.add_argument('--download-dir', type=str, default='.', help='Directory where received files are saved. The default is the current directory.')
+    parser.add_argument('--max-file-size', type=int, default=1024, help='Largest file in MiB that a conversation member may send you; bigger ones are refused. The default is 1024.')
+    parser.add_argument('--topology', choices=['mesh', 'tree'], default='mesh', help='mesh: connect to every member of the conversation; tree: only to the peers you joined or accepted, who relay messages on (connections and upload per member stay flat in large rooms, at the cost of a hop per relay). Everyone in a conversation has to use the same one. The default is mesh.')
+    parser.add_argument('--heartbeat', type=float, default=15, help='Seconds a peer may stay silent before it\'s asked whether it\'s alive (RUA). 0 turns liveness checks off. The default is 15.')
+    parser.add_argument('--heartbeat-timeout', type=float, default=5, help='Seconds to wait for the answer (IAA) before the peer is considered dead. The default is 5.')
+    parser.add_argument('--dead-peers', choices=['evict', 'reconnect'], default='evict', help='What to do with a peer that stopped answering: drop it right away, or reconnect to it once first. The default is evict.')
+    parser.add_argument('--receive-workers', type=int, default=0, help='Threads to spread decrypting and parsing incoming messages over (select engine only). The default is 0 - do it all on the server thread.')
+    parser.add_argument('--metrics', action='store_true', help='Count bytes, packets, handshakes, wake-ups and queue depths (see /stats).')
+    parser.add_argument('--metrics-timings', action='store_true', help='Also time encoding, decoding, TLS reads/writes and dispatching of every packet. Implies --metrics.')
+    parser.add_argument('--metrics-file', type=str, help='Periodically write the metrics to this file in the Prometheus text format. Implies --metrics.')
+    parser.add_argument('--metrics-port', type=int, help='Serve the metrics in the Prometheus text format over HTTP on 127.0.0.1:<port>. Implies --metrics.')
+    parser.add_argument('--profile', type=str, help='Sample the stacks of the app\'s threads from the start and write them to this file on exit, in the collapsed format of flamegraph tools (see also /profile).')
+    parser.add_argument('--profile-rate', type=float, default=100, help='Stack samples per second taken by the profiler. The default is 100.')
+    parser.add_argument('--render-rate', type=float, default=30, help='Max times per second incoming messages are drawn on the terminal, in batches. The default is 30.')
+    parser.add_argument('--render-lines', type=int, default=50, help='Max messages drawn at once; older ones in a bigger batch are collapsed into "+N more messages" (notices are always shown). The default is 50.')
+    parser.add_argument('--history', action='store_true', help='Keep a history of the messages sent and received (see /history and /search). It\'s stored unencrypted, readable by anyone with access to your files. Off by default.')
+    parser.add_argument('--no-compression', action='store_true', help='Never compress outgoing payloads, even for peers that support it.')
     args = parser.parse_args()
+    if args.engine == 'asyncio' and args.receive_workers:
+        parser.error('--receive-workers only works with --engine select')
 
     username = args.username
     port = args.port
@@ -83,7 +171,38 @@ def main():
     else:
         public = args.keys[0]
         private = args.keys[1]
-    App(username, port=port, passwd=args.password, public=public, private=private, delete_keys=args.delete_keys).run()
+    App(
+        username,
+        port=port,
+        passwd=args.password,
+        public=public,
+        private=private,
+        delete_keys=args.delete_keys,
+        profile=args.profile,
+        profile_rate=args.profile_rate,
+        render_rate=args.render_rate,
+        render_lines=args.render_lines,
+        identity_dir=args.identity_dir,
+        key_profile=args.key_profile,
+        flush_delay=args.flush_delay / 1000,
+        flush_bytes=args.flush_bytes,
+        compression=not args.no_compression,
+        download_dir=args.download_dir,
+        max_file_size=args.max_file_size * 1024 * 1024,
+        keep_history=args.history,
+        receive_workers=args.receive_workers,
+        topology=args.topology,
+        heartbeat_interval=args.heartbeat,
+        heartbeat_timeout=args.heartbeat_timeout,
+        dead_peers=args.dead_peers,
+        collect_metrics=args.metrics or bool(args.metrics_file) or args.metrics_port is not None,
+        time_stages=args.metrics_timings,
+        metrics_file=args.metrics_file,
+        metrics_port=args.metrics_port,
+        high_water=args.high_water,
+        overflow=args.overflow,
+        engine=args.engine,
+    ).run()
 
 
 if __name__ == '__main__':
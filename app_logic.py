@@ -1,13 +1,20 @@
 from typing import Any
 from alp import Packet, PayloadType
 from server import Server, User
+from async_server import AsyncServer
+
+
+ENGINES = {
+    'select': Server,
+    'asyncio': AsyncServer,
+}
 
 
 class AppLogic:
-    def __init__(self, control: Any, username: str, port=2137, passwd=None, public=None, private=None, delete_keys=True):
+    def __init__(self, control: Any, username: str, port=2137, passwd=None, public=None, private=None, delete_keys=True, engine='select', **server_options):
         self.running = False
         self.control = control
-        self.server = Server(username, control, port=port, passwd=passwd, public=public, private=private, delete_keys=delete_keys)
+        self.server = ENGINES[engine](username, control, port=port, passwd=passwd, public=public, private=private, delete_keys=delete_keys, **server_options)
 
     def run(self):
         self.running = True
@@ -16,8 +23,14 @@ class AppLogic:
     def send(self, packet: Packet, user: User):
         self.server.send(packet, user)
 
+    def send_file(self, path: str, user: User):
+        return self.server.send_file(path, user)
+
     def sendall(self, packet: Packet):
-        self.server.sendall(packet)
+        return self.server.sendall(packet)
+
+    def accept(self, user: User):
+        self.server.accept(user)
 
     def join(self, ip: str, port: int):
         self.server.join((ip, port))
@@ -25,17 +38,24 @@ class AppLogic:
     def exit_conversation(self):
         self.server.exit_conversation()
 
+    def set_flush_delay(self, delay: float):
+        self.server.set_flush_delay(delay)
+
+    def history(self, n: int):
+        if not self.server.history:
+            return ['The history is off, start with --history to keep one']
+        return self.server.history.tail(n, self.server.conversation)
+
+    def search(self, text: str):
+        if not self.server.history:
+            return ['The history is off, start with --history to keep one']
+        return self.server.history.search(text)
+
     def find_by_username(self, username: str):
-        for u in self.server.users:
-            if u.name == username:
-                return u
-        return None
+        return self.server.users.find_by_name(username)
     
     def find_by_ip(self, ip: str):
-        for u in self.server.users:
-            if u.ip[0] == ip:
-                return u
-        return None
+        return self.server.users.find_by_ip(ip)
 
     def stop(self):
         self.server.stop()
\ No newline at end of file
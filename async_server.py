@@ -0,0 +1,390 @@
+from dataclasses import dataclass
+from alp import Packet, PayloadType, HEADER_SIZE, DLEN, DLEN_OFFSET, MAX_PAYLOAD_SIZE
+from server import Server, User, Delivery, BootstrapReport
+from transfer import OutgoingTransfer
+import asyncio
+import queue
+import threading
+import time
+
+
+@dataclass
+class AsyncServer(Server):
+    """
+    `Server` running on an asyncio event loop instead of select() + pipe.
+
+    Every peer connection is served by its own task on a single loop, so
+    there is no FD_SETSIZE limit and no scan over all sockets on wake-up.
+    `send`, `sendall`, `join`, `exit_conversation` and `stop` are safe to
+    call from the TUI thread; they are handed over to the loop.
+
+    The peer's `StreamWriter`s take the place of `User.send_socket` and
+    `User.recv_socket`. There are no receive workers (every connection is
+    read by a task of its own) and no connection pool: every connection is
+    opened anew.
+    """
+
+    def __post_init__(self):
+        if self.receive_workers:
+            raise ValueError('receive_workers only work with the select engine')
+        super().__post_init__()
+        self.main_socket.close() # asyncio.start_server opens its own
+        self._loop: asyncio.AbstractEventLoop = None
+        self._loop_thread: int = None
+        self._stopped: asyncio.Event = None
+        self._started = threading.Event()
+        self._startup_error: BaseException = None
+        self._batches: dict[asyncio.StreamWriter, bytearray] = {}
+        self._batch_timers: dict[asyncio.StreamWriter, asyncio.TimerHandle] = {}
+
+    def _queue_depths(self) -> dict[tuple, int]:
+        return {
+            (('peer', str(u)),): u.send_socket.transport.get_write_buffer_size() + len(self._batches.get(u.send_socket, b''))
+            for u in self.users if u.send_socket
+        }
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped = asyncio.Event()
+        try:
+            self._load_identity()
+            server = await asyncio.start_server(
+                self._on_connection,
+                self.host,
+                self.port,
+                ssl=self.server_ctx,
+            )
+        except BaseException as e:
+            self._startup_error = e
+            raise
+        finally:
+            # `_submit` raises the error rather than waiting for a loop that never comes
+            self._started.set()
+        beat = asyncio.create_task(self._beat_forever()) if self.heartbeat is not None else None
+        prune = asyncio.create_task(self._prune_forever())
+        async with server:
+            await self._stopped.wait()
+            if beat:
+                beat.cancel()
+            prune.cancel()
+            self._leave_conversation()
+
+    async def _beat_forever(self):
+        while True:
+            await asyncio.sleep(self._beat() or self.heartbeat.wheel.tick)
+
+    async def _prune_forever(self):
+        while True:
+            await asyncio.sleep(self.transfers.prune() or self.transfers.idle_timeout)
+
+    def _submit(self, coro):
+        """
+        Runs `coro` on the server loop. Returns a `concurrent.futures.Future`
+        when called from another thread, an `asyncio.Task` from the loop itself.
+        Raises `RuntimeError` if the server failed to start.
+        """
+        self._started.wait()
+        if self._startup_error:
+            coro.close()
+            raise RuntimeError(f'The server failed to start: {self._startup_error}') from self._startup_error
+        if threading.get_ident() == self._loop_thread:
+            return self._loop.create_task(coro)
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def send(self, packet: Packet, user: User):
+        self._submit(self._send(packet, user)).result()
+        self._log(packet)
+
+    def send_file(self, path: str, user: User) -> OutgoingTransfer:
+        transfer = OutgoingTransfer(self.sender, path)
+        self._submit(self._send_file(transfer, user))
+        return transfer
+
+    async def _send_file(self, transfer: OutgoingTransfer, user: User):
+        try:
+            if not user.send_socket:
+                self.users.update(user, send_socket=await self._connect(user.addr))
+            for packet in transfer.packets():
+                # waits for the peer to catch up and lets other tasks' messages in between the chunks
+                await asyncio.wait_for(user.send_socket.drain(), self.send_timeout)
+                if not await self._write(user, self._encode(packet, user)):
+                    raise queue.Full(f'send queue of {user} is full')
+        except Exception as e:
+            self.output(f'Couldn\'t send {transfer} to {user}: {e}')
+            return
+        self.output(f'Sent {transfer} to {user}')
+
+    def broadcast(self, packet: Packet, users=None) -> list[Delivery]:
+        return self._submit(self._broadcast(packet, users)).result()
+
+    def _forward(self, packet: Packet, users: list[User]):
+        # called on the loop as well, don't wait for it
+        self._submit(self._broadcast(packet, users))
+
+    def join(self, addr: tuple[str, int], username=None):
+        self._submit(self._join(addr, username))
+
+    def exit_conversation(self):
+        self._submit(self._exit_conversation())
+
+    def set_flush_delay(self, delay: float):
+        self._submit(self._set_flush_delay(delay))
+
+    async def _set_flush_delay(self, delay: float):
+        self._conversation_flush_delay = delay
+
+    def stop(self):
+        self._delete_keys()
+        if self.history:
+            self.history.close()
+        self._submit(self._stop())
+
+    async def _stop(self):
+        self._stopped.set()
+
+    def _reconnect(self, user: User):
+        self._close_send_socket(user)
+        async def reconnect():
+            try:
+                await self._send(Packet.new(self.sender, PayloadType.RUA, None, port=self.port), user)
+            except Exception as e:
+                self.output(f'Couldn\'t reconnect to {user}: {e}')
+                if user in self.users:
+                    self._disconnect(user)
+        self._submit(reconnect())
+
+    def _welcome(self, user: User):
+        async def welcome():
+            try:
+                await self._send(Packet.new(self.sender, PayloadType.ACCEPT, {}, port=self.port), user)
+            except Exception as e:
+                self.output(f'Couldn\'t connect to {user}: {e}')
+        self._submit(welcome())
+
+    async def _exit_conversation(self):
+        self._leave_conversation()
+
+    async def _connect(self, addr: tuple[str, int]) -> asyncio.StreamWriter:
+        start = time.perf_counter_ns()
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(addr[0], addr[1], ssl=self.client_ctx, local_addr=self._source_address()),
+            self.send_timeout
+        )
+        if self.metrics:
+            self.metrics.since('handshake_seconds', start, kind='full')
+        return writer
+
+    async def _send(self, packet: Packet, user: User):
+        if not user.send_socket:
+            self.users.update(user, send_socket=await self._connect(user.addr))
+        if not await self._write(user, self._encode(packet, user)):
+            raise queue.Full(f'send queue of {user} is full')
+
+    async def _broadcast(self, packet: Packet, users) -> list[Delivery]:
+        targets = [u for u in (self._neighbours() if users is None else users) if u.accepted and u.send_socket]
+        encoded = {}
+        results = await asyncio.gather(*[self._write(u, self._encode(packet, u, encoded)) for u in targets], return_exceptions=True)
+        deliveries = []
+        for user, result in zip(targets, results):
+            if result is True:
+                deliveries.append(Delivery(user, True))
+            elif isinstance(result, Exception):
+                deliveries.append(Delivery(user, False, result))
+            else:
+                deliveries.append(Delivery(user, False, queue.Full('send queue is full')))
+        return deliveries
+
+    async def _write(self, user: User, data: bytes) -> bool:
+        writer = user.send_socket
+        batch = self._batches.get(writer)
+        if writer.transport.get_write_buffer_size() + len(batch or b'') + len(data) > self.high_water:
+            if self.overflow == 'drop':
+                return False
+            # the batch goes out first, so that draining waits for it as well
+            self._flush_batch(writer)
+            try:
+                await asyncio.wait_for(writer.drain(), self.send_timeout)
+            except asyncio.TimeoutError:
+                return False
+            if writer.is_closing():
+                return False
+            # the flush timer may have written the batch while we waited
+            batch = self._batches.get(writer)
+        if self.metrics:
+            self.metrics.inc('bytes_sent_total', len(data))
+        try:
+            if not self._conversation_flush_delay:
+                writer.write(data)
+                return True
+            if batch is None:
+                batch = self._batches[writer] = bytearray()
+                self._batch_timers[writer] = self._loop.call_later(self._conversation_flush_delay, self._flush_batch, writer)
+            batch += data
+            if len(batch) >= self.flush_bytes:
+                self._flush_batch(writer)
+        except Exception:
+            self._close_send_socket(user)
+            raise
+        return True
+
+    def _flush_batch(self, writer: asyncio.StreamWriter):
+        """
+        Writes the packets coalesced for `writer` during the flush window.
+        """
+        if timer := self._batch_timers.pop(writer, None):
+            timer.cancel() # flushed early, by `flush_bytes` or a closing connection
+        batch = self._batches.pop(writer, None)
+        if batch and not writer.is_closing():
+            writer.write(batch)
+
+    def _wake(self):
+        pass # nothing to wake up, writes are scheduled on the loop
+
+    async def _join(self, addr: tuple[str, int], username=None):
+        try:
+            await self._connect_peer(addr, username)
+        except Exception as e:
+            self.output(f'Couldn\'t connect to requested address: {e}')
+
+    async def _connect_peer(self, addr: tuple[str, int], username=None) -> User:
+        packet = Packet.new(
+            self.sender,
+            PayloadType.JOIN,
+            None,
+            port=self.port
+        )
+        user = User('unknown' if username is None else username, addr, True, await self._connect(addr), None)
+        await self._write(user, self._encode(packet, user))
+        self.users.add(user)
+        return user
+
+    def bootstrap(self, peers: dict[str, tuple[str, int]]) -> BootstrapReport:
+        return self._submit(self._bootstrap(peers)).result()
+
+    def _start_bootstrap(self, peers: dict[str, tuple[str, int]]):
+        async def bootstrap():
+            self.output(await self._bootstrap(peers))
+        self._submit(bootstrap())
+
+    async def _bootstrap(self, peers: dict[str, tuple[str, int]]) -> BootstrapReport:
+        report = BootstrapReport()
+        peers = {name: tuple(addr) for name, addr in peers.items() if not self.find_by_addr(addr)}
+        start = time.monotonic()
+        # like the select engine's thread pool: at most `bootstrap_workers` handshakes at a time
+        limit = asyncio.Semaphore(self.bootstrap_workers)
+        async def connect(name: str, addr: tuple[str, int]) -> User:
+            async with limit:
+                return await self._connect_peer(addr, name)
+        results = await asyncio.gather(
+            *[connect(name, addr) for name, addr in peers.items()],
+            return_exceptions=True
+        )
+        for name, result in zip(peers, results):
+            if isinstance(result, Exception):
+                report.failed[name] = result
+            else:
+                report.connected.append(name)
+        report.elapsed = time.monotonic() - start
+        return report
+
+    async def _on_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_address = writer.get_extra_info('peername')[:2]
+        self.output(f"Connection accepted: {client_address}")
+
+        if user := self.find_by_addr(client_address, ignore_port=True):
+            self._close_recv_socket(user) # ends the task still reading the one it replaces
+            self.users.update(user, recv_socket=writer)
+        else:
+            user = User('unknown', client_address, False, None, writer)
+            self.users.add(user)
+
+        m = self.metrics
+        while True:
+            try:
+                header = await reader.readexactly(HEADER_SIZE)
+                dlen, = DLEN.unpack_from(header, DLEN_OFFSET)
+                if dlen > MAX_PAYLOAD_SIZE:
+                    raise ValueError(f'Payload too large ({dlen} bytes)')
+                raw = header + await reader.readexactly(dlen)
+                start = time.perf_counter_ns() if m and m.timings else 0
+                packet = Packet.from_raw(raw)
+                if m:
+                    m.inc('bytes_received_total', len(raw))
+                    if start:
+                        m.since('stage_seconds', start, stage='decode')
+            except (asyncio.IncompleteReadError, ConnectionError):
+                if user.recv_socket is writer:
+                    self._disconnect(user)
+                return
+            except asyncio.CancelledError:
+                # the server is shutting down
+                writer.close()
+                return
+            except Exception as e:
+                self._reject(writer, e)
+                return
+            start = time.perf_counter_ns() if m and m.timings else 0
+            self._handle_packet(writer, user, packet)
+            if start:
+                m.since('stage_seconds', start, stage='dispatch')
+
+    def _reject(self, writer: asyncio.StreamWriter, e: Exception):
+        writer.write(
+            Packet.new(
+                self.sender,
+                PayloadType.ERROR,
+                f'Unknown packet format\n{e}'
+            ).to_bytearray()
+        )
+        writer.close()
+
+    def _close_send_socket(self, user: User):
+        send_socket = user.send_socket
+        self.users.update(user, send_socket=None)
+        if send_socket:
+            self._flush_batch(send_socket)
+            send_socket.close()
+
+    def _close_recv_socket(self, user: User):
+        recv_socket = user.recv_socket
+        self.users.update(user, recv_socket=None)
+        if recv_socket:
+            recv_socket.close()
+
+
+if __name__ == '__main__':
+    def test_backpressure_with_batching():
+        import contextlib
+        import io
+        from bench import _start_pair, _stop_servers, _wait_for
+
+        # a tiny high-water mark makes nearly every send wait for the peer while a batch is pending
+        received = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            alice, bob, bob_at_alice, threads = _start_pair(
+                'asyncio', overflow='block', high_water=300, flush_delay=0.002,
+                on_message=lambda user, packet: received.append(packet.payload),
+            )
+            try:
+                n = 2000
+                failed = 0
+                for i in range(n):
+                    failed += sum(not d.ok for d in alice.sendall(Packet.new('alice', PayloadType.MSG, f'message {i}')))
+                try:
+                    _wait_for(lambda: len(received) >= n - failed, 20)
+                except TimeoutError:
+                    pass
+            finally:
+                _stop_servers([alice, bob], threads)
+        # every message reported as delivered arrived, in order
+        assert len(received) == n - failed, (len(received), failed)
+        numbers = [int(message.split()[1]) for message in received]
+        assert numbers == sorted(numbers)
+        print(f'{len(received)} of {n} messages received under backpressure, {failed} reported failed')
+
+    test_backpressure_with_batching()
+    print("All tests passed successfully.")
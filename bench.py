@@ -0,0 +1,631 @@
+from alp import Packet, PayloadType, Capability, HEADER_SIZE
+from identity import IdentityStore, KEY_PROFILES
+from datetime import datetime
+import alp
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import socket
+import ssl
+import string
+import tempfile
+import threading
+import time
+import timeit
+import tls
+
+
+class LegacyCodec:
+    """
+    The original byte-by-byte `Packet` codec, kept as a baseline for `codec`.
+    """
+    @staticmethod
+    def to_bytearray(p: Packet) -> bytearray:
+        sender = bytearray(b''.join([bytes(p.sender[i], encoding='ascii') if i < len(p.sender) else b'\x00' for i in range(32)]))
+        sender_time = LegacyCodec._serialize_int(int(p.sender_time.timestamp()), 4)
+        if p.port:
+            port = LegacyCodec._serialize_int(p.port, 2)
+        else:
+            port = b'\x00' * 2
+        dlen = LegacyCodec._serialize_int(p.dlen, 8)
+        dtype = LegacyCodec._serialize_int(p.dtype.value, 4)
+        payload = Packet._serialize_payload(p.dtype, p.payload)
+        return sender + sender_time + p.rsvd + port + dlen + dtype + payload
+
+    @staticmethod
+    def from_raw(b: bytearray) -> Packet:
+        sender = ''
+        for byte in b[0:32:]:
+            if byte == 0:
+                break
+            sender += chr(byte)
+        sender_time = datetime.fromtimestamp(LegacyCodec._parse_number(b[32:36:]))
+        rsvd = b[36:50:]
+        port = LegacyCodec._parse_number(b[50:52])
+        dlen = LegacyCodec._parse_number(b[52:60:])
+        dtype = PayloadType(value=LegacyCodec._parse_number(b[60:64:]))
+        payload = Packet._parse_payload(dtype, b[64::])
+        return Packet(sender, sender_time, rsvd, port if port != 0 else None, dlen, dtype, payload)
+
+    @staticmethod
+    def _parse_number(b: bytearray) -> int:
+        mul = 1
+        number = 0
+        for byte in reversed(b):
+            number += byte * mul
+            mul <<= 8
+        return number
+
+    @staticmethod
+    def _serialize_int(n: int, length: int) -> bytearray:
+        res = []
+        while n > 0:
+            res.insert(0, n & 0xff)
+            n >>= 8
+        b = bytearray(res)
+        while len(b) < length:
+            b.insert(0, 0x0)
+        return b
+
+
+def _rate(fn, number: int) -> float:
+    return number / min(timeit.repeat(fn, number=number, repeat=3))
+
+
+def bench_codec(args) -> dict:
+    packet = Packet.new('benchmark_user', PayloadType.MSG, 'x' * args.size, port=2137)
+    raw = packet.to_bytearray()
+    assert LegacyCodec.to_bytearray(packet) == raw, 'codecs disagree on the wire format'
+    assert LegacyCodec.from_raw(raw) == Packet.from_raw(raw)
+
+    results = {
+        'legacy_encode': _rate(lambda: LegacyCodec.to_bytearray(packet), args.number),
+        'struct_encode': _rate(packet.to_bytearray, args.number),
+        'legacy_decode': _rate(lambda: LegacyCodec.from_raw(raw), args.number),
+        'struct_decode': _rate(lambda: Packet.from_raw(raw), args.number),
+    }
+    results['encode_speedup'] = results['struct_encode'] / results['legacy_encode']
+    results['decode_speedup'] = results['struct_decode'] / results['legacy_decode']
+    return results
+
+
+def bench_roster(args) -> dict:
+    """
+    Size and encode/decode rate of ACCEPT rosters of `args.members`
+    members in the text and the binary format, plain and compressed. The
+    binary codec caches packed addresses, `_cold` is with empty caches
+    (the first time the addresses are seen).
+    """
+    def cold(fn, cache):
+        def run():
+            cache.clear()
+            fn()
+        return run
+
+    results = {}
+    for n in args.members:
+        members = {f'user{i}': (f'192.168.{i // 256 % 256}.{i % 256}', 2137) for i in range(n)}
+        packet = Packet.new('benchmark_user', PayloadType.ACCEPT, members, port=2137)
+        text = Packet._serialize_payload(PayloadType.ACCEPT, members)
+        binary = Packet._serialize_roster(members)
+        number = max(1, args.number // n)
+        results[f'members_{n}'] = {
+            'text_bytes': len(text),
+            'binary_bytes': len(binary),
+            'text_zlib_bytes': len(packet.to_bytearray(Capability.ZLIB | Capability.ZLIB_DICT)) - HEADER_SIZE,
+            'binary_zlib_bytes': len(packet.to_bytearray(Capability.ZLIB | Capability.ZLIB_DICT | Capability.BINARY_ROSTER)) - HEADER_SIZE,
+            'text_encode': _rate(lambda: Packet._serialize_payload(PayloadType.ACCEPT, members), number),
+            'binary_encode': _rate(lambda: Packet._serialize_roster(members), number),
+            'text_decode': _rate(lambda: Packet._parse_payload(PayloadType.ACCEPT, text), number),
+            'binary_decode': _rate(lambda: Packet._parse_roster(binary), number),
+            'binary_encode_cold': _rate(cold(lambda: Packet._serialize_roster(members), alp._packed_ipv4), number),
+            'binary_decode_cold': _rate(cold(lambda: Packet._parse_roster(binary), alp._unpacked_ipv4), number),
+        }
+    return results
+
+
+def bench_tls(args) -> dict:
+    return {profile: _bench_tls_profile(profile, args) for profile in args.profiles}
+
+
+def _bench_tls_profile(profile: str, args) -> dict:
+    passwd = 'benchmark'
+    keygen = []
+    for _ in range(args.keygens):
+        store = IdentityStore('benchmark', None, profile)
+        start = time.perf_counter()
+        store.generate(passwd)
+        keygen.append(time.perf_counter() - start)
+        store.delete()
+
+    store = IdentityStore('benchmark', None, profile)
+    store.generate(passwd)
+    server_ctx = tls.create_context(True, store.public, store.private, passwd)
+    client_ctx = tls.create_context(False, store.public, store.private, passwd)
+
+    listener = socket.create_server(('127.0.0.1', 0))
+    addr = listener.getsockname()
+    received = []
+    done = threading.Event()
+
+    def serve():
+        with server_ctx.wrap_socket(listener, server_side=True) as s:
+            while not done.is_set():
+                try:
+                    conn, _ = s.accept()
+                except OSError:
+                    continue
+                with conn:
+                    n = 0
+                    while data := conn.recv(256 * 1024):
+                        n += len(data)
+                    received.append(n)
+
+    server = threading.Thread(target=serve, daemon=True)
+    server.start()
+
+    start = time.perf_counter()
+    for _ in range(args.handshakes):
+        with client_ctx.wrap_socket(socket.create_connection(addr)) as s:
+            cipher = s.cipher()[0]
+    handshakes = args.handshakes / (time.perf_counter() - start)
+
+    chunk = b'\x00' * (64 * 1024)
+    total = args.megabytes * 1024 * 1024
+    received.clear()
+    start = time.perf_counter()
+    with client_ctx.wrap_socket(socket.create_connection(addr)) as s:
+        for _ in range(total // len(chunk)):
+            s.sendall(chunk)
+    # handshake-only connections may still be reporting 0 bytes
+    while not any(received):
+        time.sleep(0.001)
+    throughput = max(received) / (time.perf_counter() - start) / (1024 * 1024)
+
+    done.set()
+    socket.create_connection(addr).close() # wake the accept() up
+    server.join()
+    store.delete()
+
+    return {
+        'keygen_ms': 1000 * sum(keygen) / len(keygen),
+        'handshakes_per_s': handshakes,
+        'bulk_mib_per_s': throughput,
+        'cipher': cipher,
+    }
+
+
+class _Control:
+    def change_mode(self, mode):
+        pass
+
+
+def _wait_for(condition, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while not (result := condition()):
+        if time.monotonic() > deadline:
+            raise TimeoutError('peers didn\'t connect in time')
+        time.sleep(0.005)
+    return result
+
+
+def _start_servers(names: list[str], engine: str, **server_options) -> tuple[list, list[threading.Thread]]:
+    """
+    One server per name, each on an address of its own in 127.0.0.0/8,
+    since peers are told apart by their IP.
+    """
+    from app_logic import ENGINES
+    servers = []
+    threads = []
+    for i, name in enumerate(names):
+        host = f'127.0.{i // 250}.{i % 250 + 2}'
+        listener = socket.create_server((host, 0)) # grab a free port
+        port = listener.getsockname()[1]
+        listener.close()
+        server = ENGINES[engine](name, _Control(), host=host, port=port, passwd='benchmark', **server_options)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        servers.append(server)
+        threads.append(thread)
+    for server in servers:
+        server._load_identity() # keys are generated in the background, don't count that as handshake time
+    time.sleep(0.2)
+    return servers, threads
+
+
+def _stop_servers(servers: list, threads: list[threading.Thread]):
+    for server in servers:
+        server.stop()
+    for thread in threads:
+        thread.join(timeout=5)
+
+
+def _form_mesh(servers: list) -> list[float]:
+    """
+    Joins every server to the first one through the regular JOIN/ACCEPT
+    flow: the first one accepts it, the newcomer joins the members it was
+    told about and they let it in. Returns how long every join took.
+    """
+    host = servers[0]
+    joins = []
+    for i, joiner in enumerate(servers[1:], 1):
+        start = time.perf_counter()
+        joiner.join((host.host, host.port))
+        user = _wait_for(lambda: host.users.find_by_name(joiner.sender))
+        host.accept(user)
+        _wait_for(lambda: all(
+            (u := joiner.users.find_by_name(s.sender)) and u.accepted and u.send_socket
+            and (v := s.users.find_by_name(joiner.sender)) and v.send_socket
+            for s in servers[:i]
+        ))
+        joins.append(time.perf_counter() - start)
+    return joins
+
+
+def _form_tree(servers: list) -> list[float]:
+    """
+    Joins server `i` to server `(i - 1) // 2`, which accepts it, so the
+    servers form a binary tree (with `topology='tree'`). Returns how long
+    every join took, until all members knew about the newcomer.
+    """
+    joins = []
+    for i, joiner in enumerate(servers[1:], 1):
+        parent = servers[(i - 1) // 2]
+        start = time.perf_counter()
+        joiner.join((parent.host, parent.port))
+        user = _wait_for(lambda: parent.users.find_by_name(joiner.sender))
+        parent.accept(user)
+        _wait_for(lambda: (u := joiner.users.find_by_name(parent.sender)) and u.accepted and u.send_socket)
+        _wait_for(lambda: all(s.users.find_by_name(joiner.sender) and joiner.users.find_by_name(s.sender) for s in servers[:i]))
+        joins.append(time.perf_counter() - start)
+    return joins
+
+
+def _start_pair(engine: str, **server_options):
+    """
+    Two servers on loopback, the second one joined and accepted by the first.
+    """
+    (alice, bob), threads = _start_servers(['alice', 'bob'], engine, **server_options)
+    _form_mesh([alice, bob])
+    return alice, bob, alice.users.find_by_name('bob'), threads
+
+
+def _percentile(values: list, p: float):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+def _rss_mib() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_mesh(args) -> dict:
+    latencies = []
+    last = [0.0]
+    def on_message(user, packet):
+        latencies.append(time.perf_counter_ns() - int(packet.payload.split(':', 1)[0]))
+        last[0] = time.perf_counter()
+
+    filler = ''.join(random.choices(string.ascii_letters + string.digits, k=args.size))
+    sent = [0] * args.peers
+    failed = [0] * args.peers
+
+    def drive(i: int, server):
+        start = time.perf_counter()
+        for n in range(int(args.rate * args.duration)):
+            delay = start + n / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            stamp = f'{time.perf_counter_ns()}:'
+            deliveries = server.sendall(Packet.new(server.sender, PayloadType.MSG, stamp + filler[len(stamp):]))
+            sent[i] += 1
+            failed[i] += sum(not d.ok for d in deliveries)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        servers, threads = _start_servers(
+            [f'peer{i}' for i in range(args.peers)],
+            args.engine,
+            keep_history=False,
+            on_message=on_message,
+            receive_workers=args.receive_workers,
+            compression=not args.no_compression,
+            collect_metrics=args.metrics != 'off',
+            time_stages=args.metrics == 'timings',
+            topology=args.topology,
+        )
+        start = time.perf_counter()
+        joins = _form_tree(servers) if args.topology == 'tree' else _form_mesh(servers)
+        mesh = time.perf_counter() - start
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        drivers = [threading.Thread(target=drive, args=(i, s)) for i, s in enumerate(servers)]
+        for driver in drivers:
+            driver.start()
+        for driver in drivers:
+            driver.join()
+        expected = sum(sent) * (args.peers - 1) - sum(failed)
+        # wait for the stragglers, give up once nothing arrived for a while
+        while len(latencies) < expected and time.perf_counter() - max(last[0], start) < 2.0:
+            time.sleep(0.01)
+        elapsed = max(last[0], start) - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        rss = _rss_mib()
+        pool = [s.pool.stats() for s in servers]
+        _stop_servers(servers, threads)
+
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    latencies.sort()
+    joins.sort()
+    return {
+        'messages_per_s': len(latencies) / elapsed if elapsed else 0,
+        'delivered': len(latencies),
+        'expected': expected,
+        'send_failures': sum(failed),
+        'latency_ms': {
+            'p50': _percentile(latencies, 0.50) / 1e6,
+            'p99': _percentile(latencies, 0.99) / 1e6,
+            'max': (latencies[-1] if latencies else 0) / 1e6,
+        },
+        'handshake': {
+            'mesh_s': mesh,
+            'join_ms_p50': 1000 * _percentile(joins, 0.50),
+            'join_ms_max': 1000 * (joins[-1] if joins else 0),
+            'full_handshakes': sum(p.full_handshakes for p in pool),
+            'resumed': sum(p.resumed for p in pool),
+        },
+        # all peers run in this process
+        'cpu_percent': 100 * cpu / elapsed if elapsed else 0,
+        'rss_mib': rss,
+        'peak_rss_mib': after.ru_maxrss / 1024,
+    }
+
+
+def bench_topology(args) -> dict:
+    """
+    Simulates rooms of `args.members` peers as a full mesh and as a tree
+    (see `Server._neighbours`): connections, copies uploaded per message,
+    hops, the busiest relay and the time until the last member has a
+    message, from the measured cost of sending and receiving one copy and
+    `args.hop_latency` of network latency per hop.
+    """
+    send_cost, receive_cost = _copy_costs(args.size)
+    latency = args.hop_latency / 1000
+    rng = random.Random(args.seed)
+    results = {'send_copy_us': send_cost * 1e6, 'receive_copy_us': receive_cost * 1e6}
+    for n in args.members:
+        # everyone sends to everyone else directly
+        mesh_delivery = (n - 1) * send_cost + latency + receive_cost
+        mesh = {
+            'connections_per_member': 2 * (n - 1),
+            'connections_max': 2 * (n - 1),
+            'room_connections': n * (n - 1),
+            'sender_copies': n - 1,
+            'sender_copies_max': n - 1,
+            'hops': 1,
+            'hops_max': 1,
+            'busiest_member_copies': n - 1,
+            'delivery_ms_p50': 1000 * mesh_delivery,
+            'delivery_ms_max': 1000 * mesh_delivery,
+        }
+        neighbours = _accept_tree(n, args.accepter, rng)
+        degrees = [len(adjacent) for adjacent in neighbours]
+        hops, delivery = [], []
+        for origin in range(n):
+            distance, arrival = _flood(neighbours, origin, send_cost, receive_cost, latency)
+            hops += distance[:origin] + distance[origin + 1:]
+            delivery.append(max(arrival))
+        hops.sort()
+        delivery.sort()
+        tree = {
+            'connections_per_member': 2 * sum(degrees) / n,
+            'connections_max': 2 * max(degrees),
+            'room_connections': 2 * (n - 1),
+            'sender_copies': sum(degrees) / n,
+            'sender_copies_max': max(degrees),
+            'hops': sum(hops) / len(hops),
+            'hops_max': hops[-1],
+            # when everyone sends one message: its own copies plus what it relays for the others
+            'busiest_member_copies': max(degrees) * n - (n - 1),
+            'delivery_ms_p50': 1000 * _percentile(delivery, 0.50),
+            'delivery_ms_max': 1000 * delivery[-1],
+        }
+        results[f'{n}_members'] = {'mesh': mesh, 'tree': tree}
+    return results
+
+
+def _accept_tree(n: int, accepter: str, rng: random.Random) -> list[list[int]]:
+    """
+    Neighbours of each of `n` members when member `i` was accepted by
+    member 0 (`first`), a random earlier member (`random`) or member
+    `(i - 1) // 2` (`balanced`).
+    """
+    neighbours = [[] for _ in range(n)]
+    for i in range(1, n):
+        parent = {'first': 0, 'random': rng.randrange(i), 'balanced': (i - 1) // 2}[accepter]
+        neighbours[i].append(parent)
+        neighbours[parent].append(i)
+    return neighbours
+
+
+def _flood(neighbours: list[list[int]], origin: int, send_cost: float, receive_cost: float, latency: float) -> tuple[list[int], list[float]]:
+    """
+    Hops to and arrival time at every member of a message from `origin`
+    relayed along the tree, every member sending its copies one by one.
+    """
+    distance = [0] * len(neighbours)
+    arrival = [0.0] * len(neighbours)
+    queue = [(origin, -1)]
+    for member, source in queue:
+        sent = arrival[member]
+        for neighbour in neighbours[member]:
+            if neighbour == source:
+                continue
+            sent += send_cost
+            distance[neighbour] = distance[member] + 1
+            arrival[neighbour] = sent + latency + receive_cost
+            queue.append((neighbour, member))
+    return distance, arrival
+
+
+def _copy_costs(size: int, number: int = 20000) -> tuple[float, float]:
+    """
+    Seconds spent sending one copy of a `size` byte MSG (encoding and
+    encrypting it) and receiving one (decrypting and decoding it), over a
+    TLS session between two in-memory endpoints.
+    """
+    passwd = 'benchmark'
+    store = IdentityStore('benchmark', None, 'p256')
+    store.generate(passwd)
+    client_in, client_out, server_in, server_out = (ssl.MemoryBIO() for _ in range(4))
+    client = tls.create_context(False, store.public, store.private, passwd).wrap_bio(client_in, client_out)
+    server = tls.create_context(True, store.public, store.private, passwd).wrap_bio(server_in, server_out, server_side=True)
+    store.delete()
+    for _ in range(10):
+        for end in (client, server):
+            try:
+                end.do_handshake()
+            except ssl.SSLWantReadError:
+                pass
+        server_in.write(client_out.read())
+        client_in.write(server_out.read())
+
+    packet = Packet.new('benchmark_user', PayloadType.MSG, 'x' * size, port=2137)
+    records = []
+    start = time.perf_counter()
+    for _ in range(number):
+        client.write(packet.to_bytearray())
+        records.append(client_out.read())
+    send_cost = (time.perf_counter() - start) / number
+
+    start = time.perf_counter()
+    for record in records:
+        server_in.write(record)
+        Packet.from_raw(server.read(len(record)))
+    receive_cost = (time.perf_counter() - start) / number
+    return send_cost, receive_cost
+
+
+def bench_transfer(args) -> dict:
+    with tempfile.TemporaryDirectory(prefix='secure_messenger_') as directory:
+        path = os.path.join(directory, 'payload.bin')
+        block = os.urandom(1024 * 1024)
+        with open(path, 'wb') as f:
+            for _ in range(args.megabytes):
+                f.write(block)
+        downloads = os.path.join(directory, 'downloads')
+        received = os.path.join(downloads, 'payload.bin')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            alice, bob, bob_at_alice, threads = _start_pair(args.engine, download_dir=downloads, keep_history=False)
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.perf_counter()
+            alice.send_file(path, bob_at_alice)
+            deadline = time.monotonic() + args.timeout
+            while not os.path.exists(received) and time.monotonic() < deadline:
+                time.sleep(0.005)
+            elapsed = time.perf_counter() - start
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            intact = os.path.exists(received) and os.path.getsize(received) == os.path.getsize(path)
+            _stop_servers([alice, bob], threads)
+
+    return {
+        'mib_per_s': args.megabytes / elapsed if intact else 0.0,
+        'seconds': elapsed,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_growth_mib': (rss_after - rss_before) / 1024,
+        'complete': intact,
+    }
+
+
+def _flatten(results: dict, prefix='') -> dict:
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{name}.'))
+        else:
+            flat[f'{prefix}{name}'] = value
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='secure_messenger bench',
+        description='Micro-benchmarks for secure_messenger.'
+    )
+    parser.add_argument('--json', action='store_true', help='Print results as a single JSON object.')
+    parser.add_argument('--output', type=str, help='Also append the results, with the parameters and a timestamp, as a JSON line to this file.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    codec = subparsers.add_parser('codec', help='Packet encode/decode rate, legacy vs struct-based codec.')
+    codec.add_argument('-n', '--number', type=int, default=20000, help='Iterations per measurement.')
+    codec.add_argument('-s', '--size', type=int, default=64, help='MSG payload size in bytes.')
+    codec.set_defaults(func=bench_codec)
+
+    roster = subparsers.add_parser('roster', help='ACCEPT roster size and encode/decode rate, text vs binary format.')
+    roster.add_argument('-m', '--members', type=int, nargs='+', default=[10, 100, 1000], help='Roster sizes to measure.')
+    roster.add_argument('-n', '--number', type=int, default=20000, help='Members encoded/decoded per measurement.')
+    roster.set_defaults(func=bench_roster)
+
+    tls_parser = subparsers.add_parser('tls', help='Key generation time, handshakes per second and bulk throughput per key profile.')
+    tls_parser.add_argument('--profiles', nargs='+', choices=KEY_PROFILES, default=list(KEY_PROFILES), help='Key profiles to compare.')
+    tls_parser.add_argument('--keygens', type=int, default=5, help='Keys generated per profile.')
+    tls_parser.add_argument('--handshakes', type=int, default=200, help='Full handshakes per profile.')
+    tls_parser.add_argument('--megabytes', type=int, default=256, help='Bulk transfer size in MiB.')
+    tls_parser.set_defaults(func=bench_tls)
+
+    mesh = subparsers.add_parser('mesh', help='Load test: a full mesh of peers on loopback, all sending to everyone.')
+    mesh.add_argument('-p', '--peers', type=int, default=4, help='Number of peers.')
+    mesh.add_argument('-r', '--rate', type=float, default=100, help='Messages per second sent by every peer.')
+    mesh.add_argument('-s', '--size', type=int, default=64, help='Message size in bytes.')
+    mesh.add_argument('-d', '--duration', type=float, default=5, help='Seconds to send for.')
+    mesh.add_argument('--engine', choices=['select', 'asyncio'], default='select', help='Networking engine of the peers.')
+    mesh.add_argument('--receive-workers', type=int, default=0, help='Receive worker threads per peer (select engine).')
+    mesh.add_argument('--no-compression', action='store_true', help='Send every payload uncompressed.')
+    mesh.add_argument('--metrics', choices=['off', 'on', 'timings'], default='off', help='Metrics collection of the peers, to measure its overhead.')
+    mesh.add_argument('--topology', choices=['mesh', 'tree'], default='mesh', help='Full mesh, or a binary tree of peers relaying the messages.')
+    mesh.set_defaults(func=bench_mesh)
+
+    topology = subparsers.add_parser('topology', help='Simulation: connections, upload, hops and delivery time of mesh vs tree rooms.')
+    topology.add_argument('-m', '--members', type=int, nargs='+', default=[10, 100, 1000], help='Room sizes to simulate.')
+    topology.add_argument('-s', '--size', type=int, default=64, help='Message size in bytes.')
+    topology.add_argument('--accepter', choices=['random', 'first', 'balanced'], default='random', help='Who accepted each member into the tree: a random earlier member, the first one (a star) or a balanced binary tree.')
+    topology.add_argument('--hop-latency', type=float, default=0.2, help='Network latency per hop in milliseconds.')
+    topology.add_argument('--seed', type=int, default=2137, help='Seed of the random tree.')
+    topology.set_defaults(func=bench_topology)
+
+    transfer = subparsers.add_parser('transfer', help='File transfer throughput between two peers over loopback.')
+    transfer.add_argument('--megabytes', type=int, default=1024, help='File size in MiB.')
+    transfer.add_argument('--engine', choices=['select', 'asyncio'], default='select', help='Networking engine of both peers.')
+    transfer.add_argument('--timeout', type=float, default=600, help='Seconds to wait for the file before giving up and reporting it incomplete.')
+    transfer.set_defaults(func=bench_transfer)
+
+    args = parser.parse_args()
+    results = args.func(args)
+
+    if args.output:
+        parameters = {k: v for k, v in vars(args).items() if k not in {'func', 'json', 'output'}}
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({'time': datetime.now().isoformat(), 'parameters': parameters, 'results': results}) + '\n')
+
+    if args.json:
+        print(json.dumps({'benchmark': args.benchmark, 'results': results}))
+    else:
+        for name, value in _flatten(results).items():
+            if isinstance(value, (str, bool)):
+                print(f'{name:>32}: {value}')
+            elif isinstance(value, int):
+                print(f'{name:>32}: {value:,}')
+            else:
+                print(f'{name:>32}: {value:,.2f}')
+
+
+if __name__ == '__main__':
+    main()
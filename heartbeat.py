@@ -0,0 +1,206 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable
+import math
+import time
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: timers go into one of `slots` buckets by the tick
+    they expire at, so scheduling, cancelling and expiring one is O(1)
+    however many there are. A timer further out than one revolution just
+    stays in its bucket until its tick comes round.
+    """
+    def __init__(self, tick: float = 0.5, slots: int = 128, now: float = None):
+        self.tick = tick
+        self._slots: list[dict[Hashable, int]] = [{} for _ in range(slots)] # key -> tick it's due at
+        self._slot_of: dict[Hashable, int] = {}
+        self._origin = time.monotonic() if now is None else now
+        self._current = 0 # the last tick expired
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __contains__(self, key: Hashable):
+        return key in self._slot_of
+
+    def schedule(self, key: Hashable, delay: float, now: float = None):
+        """
+        (Re)sets the timer of `key` to expire in `delay` seconds, rounded up to a tick.
+        """
+        self.cancel(key)
+        due = max(self._ticks(now), self._current) + max(1, math.ceil(delay / self.tick))
+        slot = due % len(self._slots)
+        self._slots[slot][key] = due
+        self._slot_of[key] = slot
+
+    def cancel(self, key: Hashable):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def expire(self, now: float = None) -> list[Hashable]:
+        """
+        Removes and returns the keys of the timers due by `now`.
+        """
+        target = self._ticks(now)
+        expired = []
+        # after a long stall one revolution visits every bucket anyway
+        for tick in range(self._current + 1, min(target, self._current + len(self._slots)) + 1):
+            slot = self._slots[tick % len(self._slots)]
+            due = [key for key, at in slot.items() if at <= target]
+            for key in due:
+                del slot[key]
+                del self._slot_of[key]
+            expired += due
+        self._current = max(self._current, target)
+        return expired
+
+    def next_timeout(self, now: float = None) -> float | None:
+        """
+        Seconds until the next non-empty bucket comes round, None if there are no timers.
+        """
+        if not self._slot_of:
+            return None
+        now = time.monotonic() if now is None else now
+        for tick in range(self._current + 1, self._current + len(self._slots) + 1):
+            if self._slots[tick % len(self._slots)]:
+                return max(0.0, self._origin + tick * self.tick - now)
+        return None
+
+    def _ticks(self, now: float = None) -> int:
+        now = time.monotonic() if now is None else now
+        return int((now - self._origin) / self.tick)
+
+
+@dataclass
+class _Peer:
+    user: Any
+    last_seen: float
+    probed_at: float = None # when the unanswered probe went out
+    strikes: int = 0 # probes in a row that went unanswered
+
+
+class Heartbeat:
+    """
+    Tells live peers from dead ones (including half-open connections
+    nothing is ever read from again) with one timer per peer in a
+    `TimerWheel`, instead of a thread or a timer task each.
+
+    Every packet from a peer only updates its `last_seen`, the timer is
+    pushed back lazily when it fires. A peer not heard from for `interval`
+    seconds gets probed (`probe(user)`, returning whether a probe could be
+    sent). If nothing arrives within `timeout` after that, `dead(user,
+    strikes)` is called; a peer that is still tracked afterwards (e.g.
+    being reconnected) gets another `timeout` to show up.
+
+    Not thread-safe, the server loop drives it with `expire`.
+    """
+    def __init__(self, interval: float, timeout: float, probe: Callable[[Any], bool], dead: Callable[[Any, int], None], tick: float = 0.5, now: float = None):
+        self.interval = interval
+        self.timeout = timeout
+        self.probe = probe
+        self.dead = dead
+        self.wheel = TimerWheel(min(tick, interval / 4, timeout / 4), now=now)
+        self._peers: dict[int, _Peer] = {}
+
+    def __len__(self):
+        return len(self._peers)
+
+    def seen(self, user: Any, now: float = None):
+        now = time.monotonic() if now is None else now
+        peer = self._peers.get(id(user))
+        if peer is None:
+            self._peers[id(user)] = _Peer(user, now)
+            self.wheel.schedule(id(user), self.interval, now)
+        else:
+            peer.last_seen = now
+
+    def remove(self, user: Any):
+        if self._peers.pop(id(user), None):
+            self.wheel.cancel(id(user))
+
+    def clear(self):
+        for key in self._peers:
+            self.wheel.cancel(key)
+        self._peers.clear()
+
+    def expire(self, now: float = None) -> float | None:
+        """
+        Probes and declares dead whoever is due. Returns the seconds until
+        it should be called again, None if nobody is tracked.
+        """
+        now = time.monotonic() if now is None else now
+        for key in self.wheel.expire(now):
+            peer = self._peers.get(key)
+            if peer is None:
+                continue
+            if peer.probed_at is not None and peer.last_seen >= peer.probed_at:
+                # answered (or sent something else meanwhile)
+                peer.probed_at = None
+                peer.strikes = 0
+            idle = now - peer.last_seen
+            if peer.probed_at is None:
+                if idle < self.interval:
+                    self.wheel.schedule(key, self.interval - idle, now)
+                elif self.probe(peer.user):
+                    peer.probed_at = now
+                    self.wheel.schedule(key, self.timeout, now)
+                else:
+                    self.wheel.schedule(key, self.interval, now)
+                continue
+            peer.strikes += 1
+            self.dead(peer.user, peer.strikes)
+            if self._peers.get(key) is peer:
+                peer.probed_at = now
+                self.wheel.schedule(key, self.timeout, now)
+        return self.wheel.next_timeout(now)
+
+
+if __name__ == '__main__':
+    def test():
+        wheel = TimerWheel(tick=1.0, slots=8, now=0.0)
+        wheel.schedule('a', 3, now=0.0)
+        wheel.schedule('b', 20, now=0.0) # more than a revolution out
+        wheel.schedule('c', 5, now=0.0)
+        wheel.cancel('c')
+        assert wheel.next_timeout(0.0) == 3.0
+        assert wheel.expire(2.5) == []
+        assert wheel.expire(3.0) == ['a']
+        assert wheel.expire(19.0) == []
+        assert wheel.expire(100.0) == ['b']
+        assert len(wheel) == 0 and wheel.next_timeout(100.0) is None
+
+        # 500 peers, every 10th stops answering, every 7th of the rest keeps talking
+        class Peer:
+            def __init__(self, n):
+                self.n = n
+                self.alive = n % 10 != 0
+        peers = [Peer(n) for n in range(500)]
+        probed, dead = [], []
+        t = 0.0
+        heartbeat = Heartbeat(10.0, 5.0, lambda p: probed.append(p) or True, lambda p, strikes: dead.append((p, strikes, t)), now=0.0)
+        for p in peers:
+            heartbeat.seen(p, now=0.0)
+        while t < 60.0:
+            t += 0.5
+            for p in peers:
+                if p.alive and p.n % 7 == 0:
+                    heartbeat.seen(p, now=t)
+            for p in probed:
+                if p.alive:
+                    heartbeat.seen(p, now=t) # IAA
+            probed.clear()
+            heartbeat.expire(now=t)
+            for p, strikes, _ in dead:
+                if strikes >= 2:
+                    heartbeat.remove(p)
+        assert {p.n for p, _, _ in dead} == {p.n for p in peers if not p.alive}
+        assert len(heartbeat) == sum(p.alive for p in peers)
+        # first declared dead within interval + timeout (+ a tick) of going silent at 0
+        assert all(at <= 15.5 for _, strikes, at in dead if strikes == 1)
+        assert all(strikes <= 2 for _, strikes, _ in dead)
+
+        print("All tests passed successfully.")
+
+    test()
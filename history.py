@@ -0,0 +1,343 @@
+from alp import PayloadType
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+# length (of the rest), crc32 (of the rest), time (us), dtype, conversation length, sender length
+# followed by the conversation, the sender and the text
+RECORD = struct.Struct('>IIqBBB')
+CHECKED = 8 # length and crc32 aren't covered by the crc
+SEGMENT_SIZE = 4 * 1024 * 1024
+MAX_BATCH = 256
+
+
+@dataclass
+class Entry:
+    time: datetime
+    conversation: str
+    sender: str
+    dtype: PayloadType
+    text: str
+
+    def __str__(self):
+        return f"[{self.time:%Y-%m-%d %H:%M:%S}] {self.sender}{' whispers' if self.dtype == PayloadType.WHISPER else ''}: {self.text}"
+
+
+class _Index:
+    """
+    Arrival times and positions (`segment << 32 | offset`) of records, in
+    the order they were appended, i.e. sorted by time.
+    """
+    __slots__ = ('times', 'positions')
+
+    def __init__(self):
+        self.times = array('q')
+        self.positions = array('Q')
+
+    def add(self, t: int, position: int):
+        self.times.append(t)
+        self.positions.append(position)
+
+    def between(self, start: int, end: int) -> array:
+        return self.positions[bisect_left(self.times, start):bisect_right(self.times, end)]
+
+
+class MessageLog:
+    """
+    Append-only log of the messages sent and received, in `directory`.
+
+    Records are appended to numbered segment files of up to
+    `SEGMENT_SIZE` bytes. Every record is indexed by arrival time three
+    ways: overall, per conversation and per sender, so time ranges and the
+    tail of a conversation are found with a binary search and read with a
+    single `pread` per record. The indexes are rebuilt from the segments
+    by the first query that needs them, so startup only checks the last
+    segment (a torn record at its end is cut off), however long the
+    history.
+
+    `append` only queues the record, a background thread writes the queue
+    out in batches, so logging doesn't hold up the caller. Reads see what
+    was appended before them. Notices about damaged records go to `output`.
+    """
+    def __init__(self, directory: str, output: Callable = print):
+        self.directory = directory
+        self.output = output
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._lock = threading.Lock()
+        self._all = _Index()
+        self._by_conversation: dict[str, _Index] = {}
+        self._by_sender: dict[str, _Index] = {}
+        self._segments: list[int] = []
+        self._readers: dict[int, int] = {} # segment -> fd
+        self._last = 0
+        self._indexed = False
+        self._load()
+
+        if not self._segments:
+            self._segments.append(0)
+        segment = self._segments[-1]
+        self._file = open(self._path(segment), 'ab')
+        self._size = self._file.tell()
+
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_loop, name='history', daemon=True)
+        self._writer.start()
+
+    def append(self, conversation: str, sender: str, dtype: PayloadType, text: str, t: float = None):
+        self._queue.put((time.time() if t is None else t, conversation, sender, dtype, text))
+
+    def flush(self, timeout: float = None):
+        """
+        Waits until everything appended so far is written.
+        """
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        with self._lock:
+            for fd in self._readers.values():
+                os.close(fd)
+            self._readers.clear()
+
+    def tail(self, n: int, conversation: str = None) -> list[Entry]:
+        """
+        The last `n` records, of `conversation` or of all of them.
+        """
+        self.flush()
+        with self._lock:
+            self._build_index()
+            index = self._all if conversation is None else self._by_conversation.get(conversation)
+            positions = index.positions[-n:] if index and n > 0 else []
+            return [self._read(position) for position in positions]
+
+    def between(self, start: datetime, end: datetime, conversation: str = None, sender: str = None) -> list[Entry]:
+        """
+        Records that arrived from `start` to `end`, optionally only of
+        `conversation` and/or from `sender`.
+        """
+        self.flush()
+        with self._lock:
+            self._build_index()
+            if sender is not None:
+                index = self._by_sender.get(sender)
+            elif conversation is not None:
+                index = self._by_conversation.get(conversation)
+            else:
+                index = self._all
+            if not index:
+                return []
+            entries = [self._read(position) for position in index.between(_micros(start), _micros(end))]
+        if sender is not None and conversation is not None:
+            entries = [e for e in entries if e.conversation == conversation]
+        return entries
+
+    def search(self, text: str, conversation: str = None, limit: int = 50) -> list[Entry]:
+        """
+        Up to `limit` records containing `text` (case-insensitive), newest first.
+        """
+        self.flush()
+        needle = text.casefold()
+        # bytes.lower() only folds ASCII, good enough to skip whole segments
+        raw_needle = needle.encode('utf-8') if needle.isascii() else None
+        with self._lock:
+            segments = list(self._segments)
+        matches = []
+        for segment in reversed(segments):
+            with open(self._path(segment), 'rb') as f:
+                data = f.read()
+            if raw_needle is not None and raw_needle not in data.lower():
+                continue
+            found = [
+                entry for _, entry in _records(data)
+                if (conversation is None or entry.conversation == conversation) and needle in entry.text.casefold()
+            ]
+            matches += reversed(found)
+            if len(matches) >= limit:
+                break
+        return matches[:limit]
+
+    def _load(self):
+        """
+        Finds the segments and repairs the last one, the only one written to.
+        """
+        self._segments = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log'))
+        if not self._segments:
+            return
+        path = self._path(self._segments[-1])
+        with open(path, 'rb') as f:
+            data = f.read()
+        end = 0
+        for offset, _ in _records(data, decode_text=False):
+            length, _, t, *_ = RECORD.unpack_from(data, offset)
+            self._last = max(self._last, t)
+            end = offset + CHECKED + length
+        if end != len(data):
+            self.output(f'Cutting off a damaged record at the end of {path}')
+            os.truncate(path, end)
+
+    def _build_index(self):
+        """
+        Indexes the records on disk, once. Called with `_lock` held, which
+        the writer holds while it writes and indexes a batch.
+        """
+        if self._indexed:
+            return
+        for segment in self._segments:
+            with open(self._path(segment), 'rb') as f:
+                data = f.read()
+            for offset, entry in _records(data, decode_text=False):
+                _, _, t, *_ = RECORD.unpack_from(data, offset)
+                self._index(t, entry.conversation, entry.sender, segment << 32 | offset)
+        self._indexed = True
+
+    def _index(self, t: int, conversation: str, sender: str, position: int):
+        self._all.add(t, position)
+        self._by_conversation.setdefault(conversation, _Index()).add(t, position)
+        self._by_sender.setdefault(sender, _Index()).add(t, position)
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [item for item in batch if isinstance(item, tuple)]
+            if records:
+                self._write(records)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if None in batch:
+                self._file.close()
+                return
+
+    def _write(self, records: list[tuple]):
+        buf = bytearray()
+        added = []
+        for t, conversation, sender, dtype, text in records:
+            t = self._last = max(_micros_from(t), self._last) # keeps the indexes sorted
+            record = _encode(t, conversation, sender, dtype, text)
+            added.append((t, conversation, sender, record))
+        # a batch is on disk and indexed at once, or not at all, as far as `_build_index` can tell
+        with self._lock:
+            for t, conversation, sender, record in added:
+                if self._size + len(buf) + len(record) > SEGMENT_SIZE and self._size + len(buf) > 0:
+                    self._file.write(buf)
+                    self._size += len(buf)
+                    buf.clear()
+                    self._roll()
+                if self._indexed:
+                    self._index(t, conversation, sender, self._segments[-1] << 32 | self._size + len(buf))
+                buf += record
+            self._file.write(buf)
+            self._file.flush()
+            self._size += len(buf)
+
+    def _roll(self):
+        self._file.close()
+        self._segments.append(self._segments[-1] + 1)
+        self._file = open(self._path(self._segments[-1]), 'ab')
+        self._size = 0
+
+    def _read(self, position: int) -> Entry:
+        segment, offset = position >> 32, position & 0xffffffff
+        fd = self._readers.get(segment)
+        if fd is None:
+            fd = self._readers[segment] = os.open(self._path(segment), os.O_RDONLY)
+        length, = struct.unpack('>I', os.pread(fd, 4, offset))
+        return next(_records(os.pread(fd, CHECKED + length, offset)))[1]
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{segment:08d}.log')
+
+
+def _encode(t: int, conversation: str, sender: str, dtype: PayloadType, text: str) -> bytes:
+    conversation = conversation.encode('utf-8')[:255]
+    sender = sender.encode('utf-8')[:255]
+    body = RECORD.pack(0, 0, t, dtype.value, len(conversation), len(sender))[CHECKED:] + conversation + sender + text.encode('utf-8')
+    return struct.pack('>II', len(body), zlib.crc32(body)) + body
+
+
+def _records(data: bytes, decode_text=True):
+    """
+    Yields `(offset, Entry)` of every intact record in `data`, stops at the first damaged one.
+    """
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        length, crc, t, dtype, clen, slen = RECORD.unpack_from(data, offset)
+        end = offset + CHECKED + length
+        if end > len(data) or zlib.crc32(memoryview(data)[offset + CHECKED:end]) != crc:
+            return
+        start = offset + RECORD.size
+        yield offset, Entry(
+            datetime.fromtimestamp(t / 1_000_000),
+            data[start:start + clen].decode('utf-8', 'replace'),
+            data[start + clen:start + clen + slen].decode('utf-8', 'replace'),
+            PayloadType(dtype),
+            data[start + clen + slen:end].decode('utf-8', 'replace') if decode_text else None,
+        )
+        offset = end
+
+
+def _micros(t: datetime) -> int:
+    return _micros_from(t.timestamp())
+
+
+def _micros_from(t: float) -> int:
+    return round(t * 1_000_000)
+
+
+if __name__ == '__main__':
+    def test():
+        import tempfile
+        from datetime import timedelta
+
+        with tempfile.TemporaryDirectory() as directory:
+            log = MessageLog(directory)
+            start = float(int(time.time()))
+            for i in range(3000):
+                log.append('a' if i % 2 else 'b', f'user{i % 3}', PayloadType.MSG, f'message {i} ' + 'x' * 2000, start + i)
+            log.append('a', 'user0', PayloadType.WHISPER, 'Zażółć gęślą jaźń', start + 3000)
+
+            assert [e.text for e in log.tail(2, 'a')] == [f'message 2999 ' + 'x' * 2000, 'Zażółć gęślą jaźń']
+            assert len(log._segments) > 1
+            t0 = datetime.fromtimestamp(start)
+            entries = log.between(t0 + timedelta(seconds=10), t0 + timedelta(seconds=19), sender='user1')
+            assert [e.text.split()[1] for e in entries] == ['10', '13', '16', '19']
+            assert [str(e).endswith('whispers: Zażółć gęślą jaźń') for e in log.search('GĘŚLĄ')] == [True]
+            assert len(log.search('message 1', conversation='a', limit=5)) == 5
+            log.close()
+
+            # torn write at the end of the last segment
+            last = os.path.join(directory, sorted(os.listdir(directory))[-1])
+            with open(last, 'ab') as f:
+                f.write(_encode(0, 'a', 'user0', PayloadType.MSG, 'torn')[:-3])
+            notices = []
+            log = MessageLog(directory, output=notices.append)
+            assert len(notices) == 1 and notices[0].startswith('Cutting off a damaged record')
+            assert not log._indexed # nothing is indexed until it's needed
+            log.append('a', 'user0', PayloadType.MSG, 'after restart')
+            log.flush()
+            assert [e.text for e in log.tail(2, 'a')] == ['Zażółć gęślą jaźń', 'after restart']
+            assert len(log._all.times) == 3002 # indexed once, not again by the writer
+            log.append('b', 'user1', PayloadType.MSG, 'after indexing')
+            assert log.tail(2)[-1].text == 'after indexing' and len(log._all.times) == 3003
+            log.close()
+
+        print("All tests passed successfully.")
+
+    test()
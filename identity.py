@@ -0,0 +1,150 @@
+from concurrent.futures import Future
+from datetime import datetime, timezone, timedelta
+from typing import Callable
+import os
+import ssl
+import tempfile
+import threading
+import time
+
+DEFAULT_DIR = os.path.join(
+    os.environ.get('XDG_DATA_HOME', os.path.join(os.path.expanduser('~'), '.local', 'share')),
+    'secure_messenger'
+)
+CERT_VALIDITY = timedelta(days=10)
+RENEW_BEFORE = timedelta(days=1)
+KEY_PROFILES = ('p256', 'ed25519', 'rsa')
+
+
+class IdentityStore:
+    """
+    Self-signed certificate and private key of a single user.
+
+    Generated once and cached in `<directory>/<name>/<profile>/`, the key
+    encrypted under the user's passphrase. Later launches reuse them until
+    the certificate is about to expire, so the key generation (and the
+    `cryptography` import) is skipped entirely. With `directory=None` the
+    identity lives in a temporary directory that `delete` removes.
+
+    `profile` is the key type: `'p256'` (ECDSA on NIST P-256), `'ed25519'`
+    or `'rsa'` (2048 bits). Both elliptic curve ones are generated and sign
+    handshakes much faster than RSA. Notices go to `output`, which may be
+    called from the background thread of `load_in_background`.
+    """
+    def __init__(self, name: str, directory: str = DEFAULT_DIR, profile: str = 'p256', output: Callable = print):
+        if profile not in KEY_PROFILES:
+            raise ValueError(f'Unknown key profile: `{profile}`')
+        self.profile = profile
+        self.output = output
+        if directory is None:
+            self.directory = tempfile.mkdtemp(prefix='secure_messenger_')
+        else:
+            self.directory = os.path.join(directory, name, profile)
+        self.public = os.path.join(self.directory, 'cert.pem')
+        self.private = os.path.join(self.directory, 'key.pem')
+
+    def load(self, passwd: str) -> tuple[str, str]:
+        """
+        Returns `(cert_path, key_path)`, generating a new identity if there
+        is no usable cached one.
+        """
+        if not self._usable(passwd):
+            self.generate(passwd)
+        return self.public, self.private
+
+    def load_in_background(self, passwd: str) -> Future:
+        """
+        Like `load`, but runs in a separate thread, so the caller (e.g. the
+        TUI) can start up while the key is being generated.
+        """
+        future = Future()
+        def load():
+            try:
+                future.set_result(self.load(passwd))
+            except Exception as e:
+                future.set_exception(e)
+        threading.Thread(target=load, name='identity', daemon=True).start()
+        return future
+
+    def generate(self, passwd: str):
+        # cryptography is heavy to import and only needed here
+        from cryptography.hazmat.primitives import serialization
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+
+        key, algorithm = self._generate_key()
+
+        subject = issuer = x509.Name([
+            x509.NameAttribute(NameOID.COUNTRY_NAME, "PL"),
+            x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "mazowieckie"),
+            x509.NameAttribute(NameOID.LOCALITY_NAME, "Warszawa"),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "secure_messenger"),
+        ])
+
+        cert = x509.CertificateBuilder().subject_name(
+            subject
+        ).issuer_name(
+            issuer
+        ).public_key(
+            key.public_key()
+        ).serial_number(
+            x509.random_serial_number()
+        ).not_valid_before(
+            datetime.now(timezone.utc)
+        ).not_valid_after(
+            datetime.now(timezone.utc) + CERT_VALIDITY
+        ).sign(key, algorithm)
+
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self._write(self.private, key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.BestAvailableEncryption(passwd.encode('utf-8')),
+        ))
+        self._write(self.public, cert.public_bytes(serialization.Encoding.PEM))
+
+    def _generate_key(self):
+        """
+        Returns the new private key and the hash to sign the certificate with.
+        """
+        from cryptography.hazmat.primitives import hashes
+
+        match self.profile:
+            case 'p256':
+                from cryptography.hazmat.primitives.asymmetric import ec
+                return ec.generate_private_key(ec.SECP256R1()), hashes.SHA256()
+            case 'ed25519':
+                from cryptography.hazmat.primitives.asymmetric import ed25519
+                return ed25519.Ed25519PrivateKey.generate(), None # Ed25519 hashes internally
+            case 'rsa':
+                from cryptography.hazmat.primitives.asymmetric import rsa
+                return rsa.generate_private_key(public_exponent=65537, key_size=2048), hashes.SHA256()
+
+    def delete(self):
+        for path in (self.public, self.private):
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.isdir(self.directory) and not os.listdir(self.directory):
+            os.rmdir(self.directory)
+
+    def _usable(self, passwd: str) -> bool:
+        if not os.path.isfile(self.public) or not os.path.isfile(self.private):
+            return False
+        # the certificate is written together with the key, its age tells when it expires
+        age = timedelta(seconds=time.time() - os.path.getmtime(self.public))
+        if age > CERT_VALIDITY - RENEW_BEFORE:
+            return False
+        try:
+            ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER).load_cert_chain(self.public, self.private, password=passwd)
+        except ssl.SSLError:
+            self.output(f'Cached keys in {self.directory} are unusable (different passphrase?), generating new ones')
+            return False
+        return True
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        tmp = f'{path}.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
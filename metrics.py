@@ -0,0 +1,197 @@
+from bisect import bisect_left
+from typing import Callable
+import os
+import threading
+import time
+
+PREFIX = 'secure_messenger_'
+# 1 us .. ~4 s, 4x apart
+BUCKETS = tuple(1e-6 * 4 ** i for i in range(12))
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket the `q` quantile falls into.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of a server, exported in the Prometheus
+    text format.
+
+    Counters and histograms are keyed by name and labels. Gauges are
+    functions returning `{labels: value}`, evaluated only on export. With
+    `timings` the server also times its stages (encode, decode, TLS
+    reads/writes, dispatch) with `time_ns` pairs; without it `timings` is
+    all those code paths check. A server without metrics has `None`
+    instead of a `Metrics`, which costs a single check per event.
+    """
+    def __init__(self, timings=False):
+        self.timings = timings
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._histograms: dict[tuple[str, tuple], Histogram] = {}
+        self._gauges: dict[str, Callable[[], dict[tuple, float]]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def since(self, name: str, start_ns: int, **labels):
+        """
+        Observes the seconds elapsed since `start_ns` (a `time.perf_counter_ns()`).
+        """
+        self.observe(name, (time.perf_counter_ns() - start_ns) / 1e9, **labels)
+
+    def gauge(self, name: str, collect: Callable[[], dict[tuple, float]]):
+        self._gauges[name] = collect
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.counts), h.count, h.sum, h.buckets) for key, h in histograms]
+        gauges = [(name, collect()) for name, collect in sorted(self._gauges.items())]
+
+        typed = set()
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {PREFIX}{name} {kind}')
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{PREFIX}{name}{_labels(labels)} {_number(value)}')
+        for (name, labels), counts, count, total, buckets in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(buckets + (float('inf'),), counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'{PREFIX}{name}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{PREFIX}{name}_sum{_labels(labels)} {_number(total)}')
+            lines.append(f'{PREFIX}{name}_count{_labels(labels)} {count}')
+        for name, values in gauges:
+            header(name, 'gauge')
+            for labels, value in sorted(values.items()):
+                lines.append(f'{PREFIX}{name}{_labels(labels)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """
+        Human-readable overview, for `/stats`.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                ((key, h.count, h.quantile(0.5), h.quantile(0.99)) for key, h in self._histograms.items()),
+                key=lambda item: item[0]
+            )
+        lines = [f'uptime: {time.time() - self.started:.0f}s']
+        lines += [f'{name}{_labels(labels)}: {_number(value)}' for (name, labels), value in counters]
+        lines += [
+            f'{name}{_labels(labels)}: {count} samples, p50 <= {_duration(p50)}, p99 <= {_duration(p99)}'
+            for (name, labels), count, p50, p99 in histograms
+        ]
+        for name, collect in sorted(self._gauges.items()):
+            lines += [f'{name}{_labels(labels)}: {_number(value)}' for labels, value in sorted(collect().items())]
+        return '\n'.join(lines)
+
+    def write_to(self, path: str):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def export_to_file(self, path: str, interval: float = 10.0, output: Callable = print):
+        """
+        Rewrites `path` every `interval` seconds (e.g. for node_exporter's
+        textfile collector). Failures are reported to `output`, from the
+        exporting thread.
+        """
+        def export():
+            while True:
+                try:
+                    self.write_to(path)
+                except OSError as e:
+                    output(f'Couldn\'t export metrics to {path}: {e}')
+                time.sleep(interval)
+        threading.Thread(target=export, name='metrics_file', daemon=True).start()
+
+    def serve(self, host: str, port: int) -> 'ThreadingHTTPServer':
+        """
+        Serves the metrics over HTTP on `(host, port)`, for Prometheus to scrape.
+        """
+        # only needed here, don't make every startup pay for the import
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # don't litter the chat
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics_http', daemon=True).start()
+        return server
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else f'{value:g}'
+
+
+def _duration(seconds: float) -> str:
+    if seconds == float('inf'):
+        return 'inf'
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.0f}us'
+    if seconds < 1:
+        return f'{seconds * 1e3:.1f}ms'
+    return f'{seconds:.2f}s'
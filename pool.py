@@ -0,0 +1,111 @@
+from dataclasses import dataclass
+import socket
+import ssl
+import threading
+import time
+
+
+@dataclass
+class PoolStats:
+    full_handshakes: int = 0
+    resumed: int = 0
+    failed: int = 0
+    sessions: int = 0
+
+    def __str__(self):
+        return (
+            f'full handshakes: {self.full_handshakes}, resumed: {self.resumed}, '
+            f'failed: {self.failed}, cached sessions: {self.sessions}'
+        )
+
+
+class ConnectionPool:
+    """
+    Outbound TLS connections to peers.
+
+    `acquire` connects and resumes the last TLS session with the address (a
+    single round trip, no certificate signatures) when one is cached,
+    falling back to a full handshake. `release` keeps the session ticket
+    and closes the connection. Connections themselves aren't kept for
+    reuse: a peer closes both of its sockets when it disconnects, so an
+    idle one would never be usable again.
+
+    With a `source_address` connections are made from that `(ip, port)`.
+    With `metrics` (a `metrics.Metrics`) the duration of every connection
+    setup is recorded.
+    """
+    def __init__(self, ctx: ssl.SSLContext, timeout: float = None, source_address: tuple[str, int] = None, metrics=None):
+        self.ctx = ctx
+        self.timeout = timeout
+        self.source_address = source_address
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._sessions: dict[tuple[str, int], ssl.SSLSession] = {}
+        self._stats = PoolStats()
+
+    def acquire(self, addr: tuple[str, int]) -> ssl.SSLSocket:
+        addr = tuple(addr)
+        with self._lock:
+            session = self._sessions.get(addr)
+        start = time.perf_counter_ns()
+        sock = self.ctx.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), session=session)
+        sock.settimeout(self.timeout)
+        try:
+            if self.source_address:
+                sock.bind(self.source_address)
+            sock.connect(addr)
+        except Exception:
+            sock.close()
+            with self._lock:
+                self._stats.failed += 1
+                if session:
+                    # the peer may have restarted, its tickets are no good anymore
+                    self._sessions.pop(addr, None)
+            raise
+        with self._lock:
+            if sock.session_reused:
+                self._stats.resumed += 1
+            else:
+                self._stats.full_handshakes += 1
+        if self.metrics:
+            # TCP connect included
+            self.metrics.since('handshake_seconds', start, kind='resumed' if sock.session_reused else 'full')
+        return sock
+
+    def release(self, addr: tuple[str, int], sock: ssl.SSLSocket):
+        self._save_session(tuple(addr), sock)
+        sock.close()
+
+    def stats(self) -> PoolStats:
+        with self._lock:
+            return PoolStats(
+                self._stats.full_handshakes,
+                self._stats.resumed,
+                self._stats.failed,
+                len(self._sessions),
+            )
+
+    def _save_session(self, addr: tuple[str, int], sock: ssl.SSLSocket):
+        # TLS 1.3 tickets arrive after the handshake and are only processed on read
+        if sock.fileno() < 0:
+            return
+        session = sock.session
+        if session and not session.has_ticket:
+            self._poll(sock)
+            session = sock.session
+        if session and session.has_ticket:
+            with self._lock:
+                self._sessions[addr] = session
+
+    @staticmethod
+    def _poll(sock: ssl.SSLSocket):
+        """
+        Reads from `sock` without blocking, so that OpenSSL processes the
+        session tickets that arrived. Peers never send anything else on
+        these connections.
+        """
+        sock.setblocking(False)
+        try:
+            sock.recv(1)
+        except OSError:
+            pass
@@ -0,0 +1,126 @@
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all other threads `rate` times a second and
+    counts them in the collapsed format of flamegraph tools
+    (`thread;file:function;... count`, root first).
+
+    With `cpu_only` a thread is only sampled if it used CPU since the
+    previous sample, so threads blocked in select(), input() or on a lock
+    don't drown out the ones doing the work (needs per-thread CPU clocks,
+    i.e. Linux/BSD; otherwise every thread is sampled).
+    """
+    def __init__(self, rate: float = 100.0, cpu_only=True):
+        self.interval = 1.0 / rate
+        self.cpu_only = cpu_only and hasattr(time, 'pthread_getcpuclockid')
+        self.samples = 0
+        self._stacks: Counter[str] = Counter()
+        self._cpu: dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def write(self, path: str) -> int:
+        """
+        Writes the collapsed stacks to `path`, returns the number of distinct stacks.
+        """
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        with open(path, 'w') as f:
+            for stack, count in stacks:
+                f.write(f'{stack} {count}\n')
+        return len(stacks)
+
+    def _run(self):
+        me = threading.get_ident()
+        next_sample = time.perf_counter()
+        while not self._stopped.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            collapsed = [
+                self._collapse(names.get(ident, str(ident)), frame)
+                for ident, frame in frames.items()
+                if ident != me and self._busy(ident)
+            ]
+            del frames
+            with self._lock:
+                self._stacks.update(collapsed)
+                self.samples += 1
+            next_sample += self.interval
+            self._stopped.wait(max(0.0, next_sample - time.perf_counter()))
+
+    def _busy(self, ident: int) -> bool:
+        if not self.cpu_only:
+            return True
+        try:
+            cpu = time.clock_gettime_ns(time.pthread_getcpuclockid(ident))
+        except OSError:
+            return False # exited meanwhile
+        previous = self._cpu.get(ident, cpu) # the first sighting only sets the baseline
+        self._cpu[ident] = cpu
+        return cpu != previous
+
+    @staticmethod
+    def _collapse(thread: str, frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{os.path.basename(code.co_filename)}:{getattr(code, "co_qualname", code.co_name)}')
+            frame = frame.f_back
+        stack.append(thread)
+        return ';'.join(reversed(stack)).replace(' ', '_')
+
+
+if __name__ == '__main__':
+    def test():
+        import tempfile
+
+        def spin(until):
+            while time.perf_counter() < until:
+                sum(range(1000))
+
+        profiler = SamplingProfiler(rate=200)
+        profiler.start()
+        until = time.perf_counter() + 0.5
+        busy = threading.Thread(target=spin, args=(until,), name='busy')
+        idle = threading.Thread(target=time.sleep, args=(0.5,), name='idle')
+        busy.start()
+        idle.start()
+        busy.join()
+        idle.join()
+        profiler.stop()
+
+        with tempfile.NamedTemporaryFile('r', suffix='.collapsed') as f:
+            assert profiler.write(f.name) > 0
+            lines = f.read().splitlines()
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+        assert any(line.startswith('busy;') and 'profiler.py:test.<locals>.spin' in line for line in lines)
+        if profiler.cpu_only:
+            assert not any(line.startswith('idle;') for line in lines)
+        print(f'{profiler.samples} samples')
+
+        print("All tests passed successfully.")
+
+    test()
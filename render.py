@@ -0,0 +1,145 @@
+from collections import deque
+from typing import Callable, TextIO
+import sys
+import threading
+import time
+
+
+class Renderer:
+    """
+    Puts what the network threads have to say on the terminal without them
+    ever waiting for it: `write` only queues the line, a thread of its own
+    prints the queue at most `rate` times a second, one write per frame.
+
+    Messages (queued with `message`) beyond `max_lines` in a frame are cut
+    down to the last ones after a "+N more messages" line, so a flood costs
+    the terminal the same as a trickle. Notices (queued with `write`) are
+    never collapsed: a join request or a failed delivery must not scroll
+    away unseen. With `history` the collapsed line points to `/history`.
+    If `prompt()` returns the prompt of an `input()` in progress, it's
+    cleared before the frame and drawn again after it, with what was typed
+    so far.
+    """
+    def __init__(self, rate: float = 30.0, max_lines: int = 50, prompt: Callable[[], str | None] = None, out: TextIO = None, history: bool = False):
+        self.interval = 1.0 / rate
+        self.max_lines = max_lines
+        self.prompt = prompt or (lambda: None)
+        self.out = out or sys.stdout
+        self.history = history
+        self.rendered = 0
+        self.collapsed = 0
+        self._lines: deque[tuple[str, bool]] = deque() # (line, is a message); appending and popping from either end is thread-safe
+        self._pending = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+
+    def write(self, *values, sep=' '):
+        """
+        Queues a notice, like `print` would print it.
+        """
+        self._lines.append((sep.join(map(str, values)), False))
+        self._pending.set()
+
+    def message(self, *values, sep=' '):
+        """
+        Queues a message, which may be collapsed in a flood.
+        """
+        self._lines.append((sep.join(map(str, values)), True))
+        self._pending.set()
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='renderer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the renderer, printing what's still queued.
+        """
+        self._stopped.set()
+        self._pending.set()
+        if self._thread:
+            self._thread.join()
+        self._render()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._pending.wait()
+            self._pending.clear()
+            start = time.monotonic()
+            self._render()
+            # whatever arrives meanwhile goes into the next frame
+            self._stopped.wait(max(0.0, start + self.interval - time.monotonic()))
+
+    def _render(self):
+        lines = []
+        while self._lines:
+            lines.append(self._lines.popleft())
+        if not lines:
+            return
+        collapsed = max(0, sum(message for _, message in lines) - self.max_lines)
+        text = []
+        if collapsed:
+            text.append(f'... +{collapsed} more messages' + (' (see /history)' if self.history else ''))
+        skip = collapsed # the oldest messages, notices stay
+        for line, message in lines:
+            if message and skip:
+                skip -= 1
+            else:
+                text.append(line)
+        self.rendered += len(lines) - collapsed
+        self.collapsed += collapsed
+
+        prompt = self.prompt() if self.out.isatty() else None
+        frame = '\n'.join(text) + '\n'
+        if prompt is not None:
+            import readline
+            # clear the prompt line, then put the prompt and the input so far back under the frame
+            frame = '\r\x1b[K' + frame + prompt + readline.get_line_buffer()
+        try:
+            self.out.write(frame)
+            self.out.flush()
+        except (OSError, ValueError):
+            pass # the terminal went away, nothing to show it on
+
+
+if __name__ == '__main__':
+    def test():
+        import io
+
+        class SlowTerminal(io.StringIO):
+            def write(self, s):
+                time.sleep(0.01) # 100 frames a second at most
+                return super().write(s)
+
+        out = SlowTerminal()
+        renderer = Renderer(rate=50, max_lines=20, out=out)
+        renderer.start()
+        n = 100_000
+        start = time.perf_counter()
+        for i in range(n):
+            if i % 1000 == 0:
+                renderer.write(f'notice {i}')
+            renderer.message(f'message {i}')
+        queued = time.perf_counter() - start
+        renderer.stop()
+
+        lines = out.getvalue().splitlines()
+        assert lines[-1] == f'message {n - 1}' # the newest are always shown
+        assert renderer.rendered + renderer.collapsed == n + n // 1000
+        assert renderer.collapsed > 0 and any(line.startswith('... +') for line in lines)
+        assert not any('/history' in line for line in lines)
+        shown = [int(line.split()[1]) for line in lines if line.startswith('message')]
+        assert shown == sorted(shown) and len(shown) == renderer.rendered - n // 1000
+        # notices are never collapsed, and stay in order with the messages around them
+        notices = [line for line in lines if line.startswith('notice')]
+        assert notices == [f'notice {i}' for i in range(0, n, 1000)]
+        order = [int(line.split()[1]) for line in lines if line.startswith(('notice', 'message'))]
+        assert order == sorted(order)
+        # writing never waited for the terminal: 100k writes would take 1000 s at 1 per frame
+        assert queued < 5.0, queued
+        print(f'{n} lines queued in {queued:.2f}s, {renderer.rendered} shown, {renderer.collapsed} collapsed')
+
+        print("All tests passed successfully.")
+
+    test()
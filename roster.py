@@ -0,0 +1,217 @@
+import threading
+import zlib
+
+Address = tuple[str, int]
+
+
+class Membership:
+    """
+    Who is in the conversation (besides us), kept in sync between members
+    by small versioned changes instead of resending the whole roster.
+
+    Every change is stamped with `(version, origin)`: `version` is a
+    Lamport clock, one more than the highest version its origin had seen,
+    and the origin's name breaks ties. A member keeps the latest stamp of
+    every name, including the ones that left, so changes can arrive late,
+    twice or out of order and every member still ends up with the same
+    roster. The cost of a change is the change, not the size of the room.
+
+    The snapshot a newcomer gets on ACCEPT is its starting point, every
+    change it hears about afterwards wins over it. All methods are safe to
+    call from any thread.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._entries: dict[str, tuple[tuple[int, str], Address | None]] = {} # name -> stamp, address (None - left)
+
+    def __len__(self):
+        with self._lock:
+            return sum(addr is not None for _, addr in self._entries.values())
+
+    def __contains__(self, name: str):
+        return self.get(name) is not None
+
+    def get(self, name: str) -> Address | None:
+        entry = self._entries.get(name)
+        return entry[1] if entry else None
+
+    def members(self) -> dict[str, Address]:
+        with self._lock:
+            return {name: addr for name, (_, addr) in self._entries.items() if addr is not None}
+
+    def change(self, origin: str, changes: dict[str, Address | None]) -> int:
+        """
+        Applies a change made here (`None` - the member left), returns its
+        version to send along with it.
+        """
+        with self._lock:
+            self.version += 1
+            version = self.version
+        self.update(version, origin, changes)
+        return version
+
+    def update(self, version: int, origin: str, changes: dict[str, Address | None]) -> dict[str, Address | None]:
+        """
+        Applies a change made at `origin`, returns what it actually changed.
+        """
+        stamp = (version, origin)
+        changed = {}
+        with self._lock:
+            self.version = max(self.version, version)
+            for name, addr in changes.items():
+                addr = tuple(addr) if addr is not None else None
+                current = self._entries.get(name)
+                if current is not None and current[0] >= stamp:
+                    continue
+                self._entries[name] = (stamp, addr)
+                if current is None or current[1] != addr:
+                    changed[name] = addr
+        return changed
+
+    def load(self, version: int, members: dict[str, Address]) -> dict[str, Address]:
+        """
+        Takes in a snapshot at `version`, returns the members that are new to us.
+        """
+        added = {}
+        with self._lock:
+            self.version = max(self.version, version)
+            for name, addr in members.items():
+                if name not in self._entries:
+                    # the lowest stamp, any change heard about later is newer
+                    self._entries[name] = ((0, ''), tuple(addr))
+                    added[name] = tuple(addr)
+        return added
+
+    def digest(self) -> int:
+        """
+        Checksum of the members, equal on members that agree on the roster.
+        """
+        return zlib.crc32(';'.join(f'{name}:{ip}:{port}' for name, (ip, port) in sorted(self.members().items())).encode('utf-8'))
+
+    def clear(self):
+        with self._lock:
+            self.version = 0
+            self._entries.clear()
+
+
+if __name__ == '__main__':
+    import random
+
+    def test_membership():
+        from alp import Packet, PayloadType
+
+        # churn in a 500 member room: members join through random members and
+        # leave, the changes reach everyone late, out of order and some twice
+        def deliver(message):
+            target, *change = message
+            # what the newcomers it accepted may have missed
+            if replicas[target].update(*change):
+                in_flight.extend((newcomer, *change) for newcomer in accepted[target])
+
+        rng = random.Random(2137)
+        replicas = {f'user{i}': Membership() for i in range(500)}
+        names = list(replicas)
+        expected = {name: (f'10.0.{i // 250}.{i % 250}', 2137) for i, name in enumerate(names)}
+        for name, replica in replicas.items():
+            replica.load(1, {other: addr for other, addr in expected.items() if other != name})
+
+        in_flight = []
+        accepted = {name: [] for name in names} # who passes changes on to whom
+        delta_bytes = snapshot_bytes = 0
+        steps = 600
+        for step in range(steps):
+            origin = rng.choice([n for n in names if expected[n] is not None])
+            if rng.random() < 0.5 and len([n for n in expected if expected[n] is not None]) > 10:
+                name = rng.choice([n for n in names if expected[n] is not None and n != origin])
+                changes = {name: None}
+                dtype = PayloadType.DEL_USR
+            else:
+                name = f'new{step}'
+                names.append(name)
+                changes = {name: (f'10.1.{step // 250}.{step % 250}', 2138)}
+                dtype = PayloadType.NEW_USR
+            version = replicas[origin].change(origin, changes)
+            expected.update(changes)
+            if dtype == PayloadType.NEW_USR:
+                # the newcomer gets a snapshot from whoever accepted them
+                replica = replicas[name] = Membership()
+                members = {n: a for n, a in replicas[origin].members().items() if n != name}
+                replica.load(version, {**members, origin: expected[origin]})
+                accepted[origin].append(name)
+                accepted[name] = []
+                snapshot_bytes += len(Packet.new(origin, PayloadType.ACCEPT, members).to_bytearray())
+            payload = {n: a or ('0.0.0.0', 0) for n, a in changes.items()}
+            delta_bytes += len(Packet.new(origin, dtype, payload).to_bytearray())
+            for target in replicas:
+                if target != origin and target != name:
+                    in_flight.append((target, version, origin, changes))
+            # deliver some of what's in flight, in random order, sometimes twice
+            rng.shuffle(in_flight)
+            for _ in range(len(in_flight) // 2):
+                deliver(in_flight.pop() if rng.random() < 0.9 else in_flight[-1])
+
+        while in_flight:
+            deliver(in_flight.pop())
+
+        live = {n: a for n, a in expected.items() if a is not None}
+        for name in live:
+            members = replicas[name].members()
+            assert members == {n: a for n, a in live.items() if n != name}, name
+        assert len({replicas[n].digest() for n in live}) == len(live) # everyone misses only themselves
+        # a change costs the same in a 500 member room as in a 2 member one
+        assert delta_bytes / steps < 100 < snapshot_bytes / sum(1 for n in names if n.startswith('new'))
+        print(f'{len(live)} members, {delta_bytes / steps:.0f} bytes per change, {snapshot_bytes / sum(1 for n in names if n.startswith("new")):.0f} bytes per snapshot')
+
+    def test_binary_roster():
+        from alp import Packet, PayloadType, Capability, Flags, FLAGS
+        import socket
+        import struct
+
+        # binary rosters round-trip whatever the names and addresses, compressed or not
+        rng = random.Random(2137)
+        def address():
+            match rng.randrange(4):
+                case 0 | 1: return socket.inet_ntop(socket.AF_INET, rng.randbytes(4))
+                case 2: return socket.inet_ntop(socket.AF_INET6, rng.randbytes(16))
+                case _: return rng.choice(['localhost', 'example.org', 'ząb.pl'])
+        for _ in range(200):
+            ipv4 = rng.random() < 0.5
+            members = {
+                ''.join(rng.choice('abcxyz_019ąż') for _ in range(rng.randrange(1, 12))): (address() if not ipv4 else socket.inet_ntop(socket.AF_INET, rng.randbytes(4)), rng.randrange(1 << 16))
+                for _ in range(rng.choice([0, 1, 2, 10, 300, 2000]))
+            }
+            for caps in [Capability.BINARY_ROSTER, Capability.BINARY_ROSTER | Capability.ZLIB | Capability.ZLIB_DICT]:
+                roster = Packet.new('user', rng.choice([PayloadType.ACCEPT, PayloadType.NEW_USR]), members)
+                raw = roster.to_bytearray(caps)
+                assert Flags.BINARY in Flags(raw[32 + 4 + FLAGS])
+                parsed = Packet.from_raw(memoryview(raw))
+                assert parsed.payload == members and parsed.rsvd == roster.rsvd
+                # relayed to a peer without the capability it goes back to text
+                assert Packet.from_raw(parsed.to_bytearray()).payload == Packet.from_raw(roster.to_bytearray()).payload
+
+        # what the binary format can't carry is sent as text
+        for members in [{'a\0b': ('10.0.0.1', 2137)}, {'a': ('10.0.0.1', 1 << 16)}]:
+            raw = Packet.new('user', PayloadType.ACCEPT, members).to_bytearray(Capability.BINARY_ROSTER)
+            assert Flags.BINARY not in Flags(raw[32 + 4 + FLAGS])
+
+        # smaller than text, plain and compressed, at any size
+        for n in [1, 10, 100, 1000]:
+            members = {f'user{i}': (f'192.168.{i // 256}.{i % 256}', 2137) for i in range(n)}
+            roster = Packet.new('user', PayloadType.ACCEPT, members)
+            binary, text = Packet._serialize_roster(members), Packet._serialize_payload(PayloadType.ACCEPT, members)
+            assert Packet._parse_roster(binary) == members
+            assert len(binary) < (0.6 if n >= 10 else 1) * len(text), n
+            zlib_caps = Capability.ZLIB | Capability.ZLIB_DICT
+            assert len(roster.to_bytearray(zlib_caps | Capability.BINARY_ROSTER)) < len(roster.to_bytearray(zlib_caps)), n
+
+        for broken in [binary[:-(5 + 6 * 1000)], binary + b'\x00', b'\x03' + binary[1:], binary[:5], b'', b'\x01\xff\xff\xff\xff', b'\x02\x00\x00\x00\x02\x00\x01\x00\x02a\x00b\x00c']:
+            try:
+                Packet._parse_roster(broken)
+                assert False, broken
+            except (ValueError, struct.error):
+                pass
+
+    test_membership()
+    test_binary_roster()
+    print("All tests passed successfully.")
@@ -1,20 +1,232 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from collections import deque
 import socket
-from alp import Packet, PayloadType
+from alp import Packet, PayloadType, FrameReader, Capability, HOPS, MAX_HOPS
+from pool import ConnectionPool
+from identity import IdentityStore, DEFAULT_DIR
+from heartbeat import Heartbeat
+from roster import Membership
+from history import MessageLog
+from metrics import Metrics
+from transfer import OutgoingTransfer, Transfers, IDLE_TIMEOUT, MAX_FILE_SIZE, TRANSFER_TYPES, TRANSFER_WINDOW
 import select
+import tls
 import queue
 import ssl
 import sys
-from datetime import datetime, timezone, timedelta
-from typing import Any
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable
 from tui import TuiMode
 import os
 
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives import serialization
-from cryptography import x509
-from cryptography.x509.oid import NameOID
-from cryptography.hazmat.primitives import hashes
+WRITE_SIZE = 64 * 1024
+RECORD_SIZE = 16 * 1024 # max TLS record payload
+ADMITTING_TYPES = frozenset({PayloadType.JOIN, PayloadType.ACCEPT})
+UNADMITTED_TYPES = frozenset({PayloadType.MSG, PayloadType.WHISPER, *TRANSFER_TYPES}) # ignored until then
+
+
+class SendQueue:
+    """
+    Bounded outbound buffer of a single peer.
+
+    Any thread can `put` serialized packets; the server loop drains them with
+    `write_to` whenever the peer's socket is writable. Once `high_water`
+    bytes are queued, `put` either fails right away (`'drop'` policy) or
+    waits up to `timeout` seconds for the peer to catch up (`'block'`).
+    The server loop itself puts with `block=False`: it must never wait for
+    a peer, whatever the policy.
+
+    Small packets queued back to back are coalesced into writes of up to
+    `flush_bytes`, i.e. a single TLS record and syscall for a burst. With a
+    `flush_delay` the queue also holds data back for up to that many
+    seconds after the first packet (unless `flush_bytes` are queued
+    sooner), so that a burst spread over time still goes out in one write.
+    """
+    def __init__(self, high_water: int, policy: str = 'drop', timeout: float = None, flush_delay: float = 0.0, flush_bytes: int = RECORD_SIZE):
+        if policy not in {'drop', 'block'}:
+            raise ValueError(f'Unknown overflow policy: `{policy}`')
+        self.high_water = high_water
+        self.policy = policy
+        self.timeout = timeout
+        self.flush_delay = flush_delay
+        self.flush_bytes = flush_bytes
+        self._chunks: deque[bytes] = deque()
+        self._offset = 0 # bytes of the first chunk that were already written
+        self._size = 0
+        self._since = 0.0 # when the oldest queued packet was put
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self._size
+
+    def put(self, data: bytes, block: bool = True) -> bool:
+        with self._cond:
+            if self._size and self._size + len(data) > self.high_water:
+                if self.policy == 'drop' or not block:
+                    return False
+                if not self._cond.wait_for(
+                    lambda: self._closed or not self._size or self._size + len(data) <= self.high_water,
+                    timeout=self.timeout
+                ):
+                    return False
+            if self._closed:
+                return False
+            if not self._chunks:
+                self._since = time.monotonic()
+            self._chunks.append(data)
+            self._size += len(data)
+            return True
+
+    def wait_below(self, size: int, timeout: float = None) -> bool:
+        """
+        Waits until at most `size` bytes are queued. False on timeout or
+        if the queue was closed meanwhile.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._closed or self._size <= size, timeout=timeout) and not self._closed
+
+    def ready_at(self) -> float:
+        """
+        Monotonic time at which the queued data should be written.
+        """
+        with self._cond:
+            if not self.flush_delay or self._offset or self._size >= self.flush_bytes:
+                return 0.0
+            return self._since + self.flush_delay
+
+    def write_to(self, sock: ssl.SSLSocket) -> int:
+        """
+        Writes as much as the non-blocking `sock` accepts. A write interrupted
+        by `SSLWantWriteError` is retried later with the very same buffer.
+        """
+        written = 0
+        while True:
+            with self._cond:
+                if not self._chunks:
+                    break
+                if not self._offset:
+                    self._coalesce()
+                chunk, offset = self._chunks[0], self._offset
+            try:
+                n = sock.send(memoryview(chunk)[offset:offset + WRITE_SIZE])
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                break
+            with self._cond:
+                written += n
+                self._size -= n
+                self._offset += n
+                if self._offset == len(chunk):
+                    self._chunks.popleft()
+                    self._offset = 0
+                    self._since = time.monotonic()
+                self._cond.notify_all()
+        return written
+
+    def _coalesce(self):
+        """
+        Merges small packets at the head of the queue into one chunk of at
+        most `flush_bytes`. The merged chunk replaces them in the queue, so a
+        retried write sends exactly the same buffer.
+        """
+        if len(self._chunks) < 2 or len(self._chunks[0]) >= self.flush_bytes:
+            return
+        batch = [self._chunks.popleft()]
+        size = len(batch[0])
+        while self._chunks and size + len(self._chunks[0]) <= self.flush_bytes:
+            chunk = self._chunks.popleft()
+            batch.append(chunk)
+            size += len(chunk)
+        self._chunks.appendleft(b''.join(batch))
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._chunks.clear()
+            self._size = 0
+            self._offset = 0
+            self._cond.notify_all()
+
+
+class ReceiveWorker:
+    """
+    Receives from a shard of the peer connections on a thread of its own.
+
+    TLS decryption, framing and parsing happen here (OpenSSL and zlib
+    release the GIL, so shards decrypt in parallel); `read(sock)` does the
+    actual work, see `Server._read_packets`. The results are handed to
+    `deliver(sock, user, result)` in the order they arrived on every
+    connection. A connection that failed or was closed by the peer is
+    dropped from the shard before it's delivered. `close` stops the thread.
+    """
+    def __init__(self, name: str, read: Callable, deliver: Callable):
+        self._read = read
+        self._deliver = deliver
+        self._lock = threading.Lock()
+        self._sockets: set[ssl.SSLSocket] = set()
+        self._closed = False
+        self._pipe_read, self._pipe_write = os.pipe()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._sockets)
+
+    def add(self, sock: ssl.SSLSocket):
+        with self._lock:
+            self._sockets.add(sock)
+        os.write(self._pipe_write, b'\n')
+
+    def remove(self, sock: ssl.SSLSocket):
+        with self._lock:
+            self._sockets.discard(sock)
+            if self._closed:
+                return
+        os.write(self._pipe_write, b'\n')
+
+    def close(self):
+        """
+        Stops the thread and closes its pipe. The sockets are left to the
+        server, which owns them.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._sockets.clear()
+        os.write(self._pipe_write, b'\n')
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        os.close(self._pipe_read)
+        os.close(self._pipe_write)
+
+    def _run(self):
+        while not self._closed:
+            with self._lock:
+                sockets = [s for s in self._sockets if s.fileno() >= 0]
+            try:
+                ready, _, _ = select.select(sockets + [self._pipe_read], [], [])
+            except (OSError, ValueError):
+                continue # a socket was closed under us, it's gone from the next snapshot
+            if self._closed:
+                return
+            for s in ready:
+                if s is self._pipe_read:
+                    os.read(s, 4096)
+                    continue
+                with self._lock:
+                    if s not in self._sockets:
+                        continue
+                user, result = self._read(s)
+                if not user or result == []:
+                    continue
+                if not isinstance(result, list):
+                    self.remove(s)
+                self._deliver(s, user, result)
+
 
 @dataclass
 class User:
@@ -23,6 +235,10 @@ class User:
     accepted: bool
     send_socket: ssl.SSLSocket
     recv_socket: ssl.SSLSocket
+    outbox: SendQueue = None
+    capabilities: Capability = Capability(0) # learned from the peer's packets
+    via: 'User' = None # tree topology: the neighbour a member we aren't connected to is reached through
+    sponsored: bool = False # we accepted them, so we pass on the roster changes they may have missed
 
     def __str__(self):
         return f'{self.name}@{self.addr[0]}:{self.addr[1]}'
@@ -33,6 +249,137 @@ class User:
     def __hash__(self):
         return hash(self.__key())
 
+class UserRegistry:
+    """
+    The set of known `User`s, indexed by name, by `(ip, port)`, by ip and by
+    socket (object or file descriptor), so lookups don't scan every user.
+
+    `User`s are hashed by their mutable name and address, so they are stored
+    by identity here and their indexed fields (`name`, `addr`, `send_socket`,
+    `recv_socket`) must be changed through `update` to keep the indexes
+    consistent. All methods are safe to call from any thread; iterating
+    yields a snapshot.
+    """
+    INDEXED = frozenset({'name', 'addr', 'send_socket', 'recv_socket'})
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._users: dict[int, User] = {}
+        self._by_name: dict[str, dict[int, User]] = {}
+        self._by_addr: dict[tuple[str, int], dict[int, User]] = {}
+        self._by_ip: dict[str, dict[int, User]] = {}
+        self._by_socket: dict[Any, dict[int, User]] = {}
+        self._indexed_keys: dict[int, list] = {} # keys as of indexing, sockets may be closed by now
+
+    def __len__(self):
+        return len(self._users)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._users.values()))
+
+    def __contains__(self, user: User):
+        return id(user) in self._users
+
+    def add(self, user: User):
+        with self._lock:
+            if id(user) in self._users:
+                return
+            self._users[id(user)] = user
+            self._index(user)
+
+    def remove(self, user: User):
+        with self._lock:
+            if self._users.pop(id(user), None):
+                self._unindex(user)
+
+    def clear(self):
+        with self._lock:
+            for index in (self._users, self._by_name, self._by_addr, self._by_ip, self._by_socket, self._indexed_keys):
+                index.clear()
+
+    def update(self, user: User, **fields):
+        """
+        Sets `fields` on `user` and reindexes it, e.g.
+        `users.update(user, name='bob', addr=('10.0.0.2', 2137))`. Setting
+        only fields that aren't `INDEXED` leaves the indexes alone.
+        """
+        with self._lock:
+            registered = id(user) in self._users and not self.INDEXED.isdisjoint(fields)
+            if registered:
+                self._unindex(user)
+            for name, value in fields.items():
+                setattr(user, name, value)
+            if registered:
+                self._index(user)
+
+    def find_by_name(self, name: str) -> User | None:
+        return self._first(self._by_name, name)
+
+    def find_by_addr(self, addr: tuple[str, int], ignore_port=False) -> User | None:
+        if ignore_port:
+            return self.find_by_ip(addr[0])
+        return self._first(self._by_addr, tuple(addr))
+
+    def find_by_ip(self, ip: str) -> User | None:
+        return self._first(self._by_ip, ip)
+
+    def find_by_socket(self, s) -> User | None:
+        return self._first(self._by_socket, s)
+
+    def _first(self, index: dict, key) -> User | None:
+        with self._lock:
+            users = index.get(key)
+            return next(iter(users.values())) if users else None
+
+    def _keys(self, user: User):
+        yield self._by_name, user.name
+        yield self._by_addr, tuple(user.addr)
+        yield self._by_ip, user.addr[0]
+        for s in (user.send_socket, user.recv_socket):
+            if s is None:
+                continue
+            yield self._by_socket, s
+            fileno = getattr(s, 'fileno', None)
+            if fileno and fileno() >= 0:
+                yield self._by_socket, fileno()
+
+    def _index(self, user: User):
+        keys = list(self._keys(user))
+        for index, key in keys:
+            index.setdefault(key, {})[id(user)] = user
+        self._indexed_keys[id(user)] = keys
+
+    def _unindex(self, user: User):
+        for index, key in self._indexed_keys.pop(id(user), []):
+            users = index.get(key)
+            if users is None:
+                continue
+            users.pop(id(user), None)
+            if not users:
+                del index[key]
+
+
+@dataclass
+class Delivery:
+    user: User
+    ok: bool
+    error: Exception = None
+
+    def __str__(self):
+        return f'{self.user}: {"delivered" if self.ok else f"failed ({self.error})"}'
+
+@dataclass
+class BootstrapReport:
+    connected: list[str] = field(default_factory=list)
+    failed: dict[str, Exception] = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    def __str__(self):
+        lines = [f'Connected to {len(self.connected)}/{len(self.connected) + len(self.failed)} peers in {self.elapsed:.2f}s']
+        lines += [f'Couldn\'t connect to {name}: {e}' for name, e in self.failed.items()]
+        return '\n'.join(lines)
+
 @dataclass
 class Server:
     sender: str
@@ -43,123 +390,517 @@ class Server:
     delete_keys: bool = True
     host: str = "0.0.0.0"
     port: int = 2137
+    send_timeout: float = 5.0
+    high_water: int = 1024 * 1024
+    overflow: str = 'drop'
+    bootstrap_workers: int = 16
+    flush_delay: float = 0.0
+    flush_bytes: int = RECORD_SIZE
+    identity_dir: str = DEFAULT_DIR
+    key_profile: str = 'p256'
+    compression: bool = True
+    download_dir: str = '.'
+    max_file_size: int = MAX_FILE_SIZE
+    transfer_timeout: float = IDLE_TIMEOUT # seconds an incoming file may get nothing before it's dropped
+    keep_history: bool = False # plaintext on disk, so only when asked for
+    receive_workers: int = 0
+    on_message: Callable = None # called with (user, packet) for every message received
+    output: Callable = print # where notices are shown, e.g. `Renderer.write`
+    output_message: Callable = None # where received messages are shown, e.g. `Renderer.message`; `output` by default
+    collect_metrics: bool = False
+    time_stages: bool = False # time encoding, decoding, TLS and dispatch too
+    metrics_file: str = None
+    metrics_port: int = None
+    topology: str = 'mesh' # or 'tree', see `_neighbours`
+    heartbeat_interval: float = 15.0 # probe peers silent for this long, 0 - never
+    heartbeat_timeout: float = 5.0
+    dead_peers: str = 'evict' # or 'reconnect' (once, then evict)
     
     def __post_init__(self):
+        self.output_message = self.output_message or self.output
         if not self.public or not self.private:
-            key = rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=2048
-            )
-            with open('key.pem', 'wb+') as private_fd:
-                private_fd.write(key.private_bytes(
-                    encoding=serialization.Encoding.PEM,
-                    format=serialization.PrivateFormat.TraditionalOpenSSL,
-                    encryption_algorithm=serialization.BestAvailableEncryption(self.passwd.encode('utf-8')),
-                ))
-
-            subject = issuer = x509.Name([
-                x509.NameAttribute(NameOID.COUNTRY_NAME, "PL"),
-                x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "mazowieckie"),
-                x509.NameAttribute(NameOID.LOCALITY_NAME, "Warszawa"),
-                x509.NameAttribute(NameOID.ORGANIZATION_NAME, "secure_messenger"),
-            ])
-
-            cert = x509.CertificateBuilder().subject_name(
-                subject
-            ).issuer_name(
-                issuer
-            ).public_key(
-                key.public_key()
-            ).serial_number(
-                x509.random_serial_number()
-            ).not_valid_before(
-                datetime.now(timezone.utc)
-            ).not_valid_after(
-                datetime.now(timezone.utc) + timedelta(days=10)
-            ).sign(key, hashes.SHA256())
-
-            with open('cert.pem', 'wb+') as public_fd:
-                public_fd.write(cert.public_bytes(serialization.Encoding.PEM))
-
-            self.public = 'cert.pem'
-            self.private = 'key.pem'
-
-        self.client_ctx = ssl._create_unverified_context(ssl.PROTOCOL_TLS_CLIENT)
-        self.client_ctx.load_cert_chain(self.public, self.private, password=self.passwd)
-
-        self.server_ctx = ssl._create_unverified_context(ssl.PROTOCOL_TLS_SERVER)
-        self.server_ctx.load_cert_chain(self.public, self.private, password=self.passwd)
-
-        del self.passwd # discard passwd - it's not used anymore
+            # keys to be deleted on exit aren't worth caching
+            self._identity_store = IdentityStore(self.sender, None if self.delete_keys else self.identity_dir, self.key_profile, self.output)
+            self._identity = self._identity_store.load_in_background(self.passwd)
+        else:
+            self._identity_store = None
+            self._identity = Future()
+            self._identity.set_result((self.public, self.private))
+        self._identity_lock = threading.Lock()
+        self.client_ctx = None
+        self.server_ctx = None
+
+        self.metrics = Metrics(self.time_stages) if self.collect_metrics or self.time_stages else None
+        if self.metrics:
+            self.metrics.gauge('peers', lambda: {(): len(self.users)})
+            self.metrics.gauge('send_queue_bytes', self._queue_depths)
+            if self.metrics_file:
+                self.metrics.export_to_file(self.metrics_file, output=self.output)
+            if self.metrics_port:
+                self.metrics.serve('127.0.0.1', self.metrics_port)
+
+        self.pool = ConnectionPool(None, timeout=self.send_timeout, source_address=self._source_address(), metrics=self.metrics)
 
         self.main_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-        self.users: set[User] = set()
+        self.users = UserRegistry()
 
         self._pipe_read, self._pipe_write = os.pipe()
 
+        self._readers: dict[ssl.SSLSocket, FrameReader] = {}
+        self._admitting: set[ssl.SSLSocket] = set() # sent a JOIN or ACCEPT, which may not have been handled yet
+        self._workers: list[ReceiveWorker] = []
+        self._shards: dict[ssl.SSLSocket, ReceiveWorker] = {}
+        self._inbox = queue.SimpleQueue() # what the workers received, in order
+
+        self._lock = threading.Lock()
+        self._pending: dict[ssl.SSLSocket, User] = {} # send sockets with queued data
+        self._woken = False
+        self._conversation_flush_delay = self.flush_delay
+
+        self.transfers = Transfers(self.download_dir, self.max_file_size, self.transfer_timeout, self.output)
+
+        self.history = MessageLog(os.path.join(self.identity_dir, self.sender, 'history'), self.output) if self.keep_history else None
+        self.conversation: str = None # label of the current conversation in the history
+
+        self.heartbeat = Heartbeat(self.heartbeat_interval, self.heartbeat_timeout, self._probe, self._dead) if self.heartbeat_interval > 0 else None
+        self.membership = Membership()
+
+    def _queue_depths(self) -> dict[tuple, int]:
+        return {(('peer', str(u)),): len(u.outbox) for u in self.users if u.outbox is not None}
+
+    def _source_address(self) -> tuple[str, int] | None:
+        """
+        Where to connect to peers from: the address we listen on, if it's a
+        specific one. Peers tell us apart by the IP our connections come from.
+        """
+        if self.host in {'', '0.0.0.0'}:
+            return None
+        return (self.host, 0)
+
+    def _load_identity(self):
+        """
+        Waits for the keys (they may still be generated in the background)
+        and sets up the TLS contexts. Called before the first connection.
+        """
+        with self._identity_lock:
+            if self.client_ctx:
+                return
+            self.public, self.private = self._identity.result()
+
+            client_ctx = tls.create_context(False, self.public, self.private, self.passwd)
+            self.server_ctx = tls.create_context(True, self.public, self.private, self.passwd)
+
+            del self.passwd # discard passwd - it's not used anymore
+
+            self.pool.ctx = client_ctx
+            self.client_ctx = client_ctx
+
     def send(self, packet: Packet, user: User):
         # 1. find the socket
         if not user.send_socket:
-            unsecure_send_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            send_socket = self.client_ctx.wrap_socket(unsecure_send_socket)
-            user.send_socket = send_socket
-            user.send_socket.connect(user.addr)
-        user.send_socket.send(packet.to_bytearray())
+            self._attach(user, self._connect(user.addr))
+        if not self._enqueue(user, self._encode(packet, user)):
+            raise queue.Full(f'send queue of {user} is full')
+        self._wake()
+        self._log(packet)
 
-    def sendall(self, packet: Packet):
-        for user in self.users:
+    def send_file(self, path: str, user: User) -> OutgoingTransfer:
+        """
+        Streams the file at `path` to `user` from a separate thread. At most
+        `TRANSFER_WINDOW` bytes are queued for the peer at a time, so messages
+        sent meanwhile go out between the chunks instead of after the file.
+        """
+        transfer = OutgoingTransfer(self.sender, path)
+        if not user.send_socket:
+            self._attach(user, self._connect(user.addr))
+        threading.Thread(target=self._stream, args=(transfer, user), name='transfer', daemon=True).start()
+        return transfer
+
+    def _stream(self, transfer: OutgoingTransfer, user: User):
+        outbox = user.outbox
+        for packet in transfer.packets():
+            if not outbox.wait_below(TRANSFER_WINDOW, self.send_timeout) or not self._enqueue(user, self._encode(packet, user)):
+                self.output(f'Couldn\'t send {transfer} to {user}: peer stopped receiving')
+                return
+            self._wake()
+        self.output(f'Sent {transfer} to {user}')
+
+    def sendall(self, packet: Packet) -> list['Delivery']:
+        deliveries = self.broadcast(packet)
+        self._log(packet)
+        return deliveries
+
+    def _log(self, packet: Packet):
+        """
+        Appends a sent or received message to the history.
+        """
+        if not self.history or packet.dtype not in {PayloadType.MSG, PayloadType.WHISPER}:
+            return
+        with self._lock:
+            if self.conversation is None:
+                self.conversation = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            conversation = self.conversation
+        self.history.append(conversation, packet.sender, packet.dtype, packet.payload)
+
+    def broadcast(self, packet: Packet, users=None, block=True) -> list['Delivery']:
+        """
+        Serializes `packet` once per compression capability set and queues
+        the same buffer for every accepted peer (or for `users`). A peer whose
+        queue is over its high-water mark gets a failed `Delivery`, the rest
+        are not held up by it. Without `block` that's so under the `'block'`
+        overflow policy too.
+        """
+        encoded = {}
+        deliveries = []
+        for user in list(self._neighbours() if users is None else users):
+            if not user.accepted or not user.send_socket:
+                continue
+            if self._enqueue(user, self._encode(packet, user, encoded), block):
+                deliveries.append(Delivery(user, True))
+            else:
+                deliveries.append(Delivery(user, False, queue.Full('send queue is full')))
+        self._wake()
+        return deliveries
+
+    def _encode(self, packet: Packet, user: User, encoded: dict = None) -> bytes:
+        """
+        `packet` on the wire for `user`, compressed as far as the peer can
+        decode it. `encoded` caches the result per capability set.
+        """
+        if m := self.metrics:
+            m.inc('packets_sent_total', type=packet.dtype.name)
+        compress = user.capabilities if self.compression else user.capabilities & Capability.BINARY_ROSTER
+        if encoded is not None and compress in encoded:
+            return encoded[compress]
+        start = time.perf_counter_ns() if m and m.timings else 0
+        data = bytes(packet.to_bytearray(compress))
+        if start:
+            m.since('stage_seconds', start, stage='encode')
+        if encoded is not None:
+            encoded[compress] = data
+        return data
+
+    def _enqueue(self, user: User, data: bytes, block=True) -> bool:
+        if not user.outbox.put(data, block):
+            return False
+        with self._lock:
             if user.send_socket:
-                user.send_socket.send(packet.to_bytearray())
-    
+                self._pending[user.send_socket] = user
+        return True
+
+    def _connect(self, addr: tuple[str, int]) -> ssl.SSLSocket:
+        self._load_identity()
+        send_socket = self.pool.acquire(addr)
+        send_socket.setblocking(False)
+        return send_socket
+
+    def _attach(self, user: User, send_socket: ssl.SSLSocket):
+        # the queue first: the loop may send to `user` as soon as it sees the socket
+        user.outbox = SendQueue(self.high_water, self.overflow, self.send_timeout, self._conversation_flush_delay, self.flush_bytes)
+        self.users.update(user, send_socket=send_socket)
+
+    def _close_send_socket(self, user: User):
+        """
+        Hands the connection back to the pool, which keeps its TLS session.
+        """
+        send_socket = user.send_socket
+        with self._lock:
+            self._pending.pop(send_socket, None)
+        self.users.update(user, send_socket=None)
+        if user.outbox is not None:
+            user.outbox.close()
+        if send_socket and send_socket.fileno() > 0:
+            self.pool.release(user.addr, send_socket)
+
+    def _flush(self, user: User):
+        m = self.metrics
+        start = time.perf_counter_ns() if m and m.timings else 0
+        try:
+            written = user.outbox.write_to(user.send_socket)
+        except OSError as e:
+            self.output(f'Couldn\'t deliver to {user}: {e}')
+            self._close_send_socket(user)
+            return
+        if m:
+            m.inc('bytes_sent_total', written)
+            if start:
+                m.since('stage_seconds', start, stage='tls_write')
+        with self._lock:
+            if not user.outbox:
+                self._pending.pop(user.send_socket, None)
+
+    def _writers(self) -> tuple[list[ssl.SSLSocket], float | None]:
+        """
+        Send sockets with data due to be written, and the number of seconds
+        until the next held back (coalescing) queue is due, if any.
+        """
+        now = time.monotonic()
+        writers = []
+        next_flush = None
+        with self._lock:
+            for send_socket, user in self._pending.items():
+                due = user.outbox.ready_at() - now
+                if due <= 0:
+                    writers.append(send_socket)
+                else:
+                    next_flush = due if next_flush is None else min(next_flush, due)
+        return writers, next_flush
+
+    def set_flush_delay(self, delay: float):
+        """
+        Changes the coalescing window of the current conversation,
+        `exit_conversation` goes back to the configured one.
+        """
+        for user in self.users:
+            if user.outbox is not None:
+                user.outbox.flush_delay = delay
+        self._conversation_flush_delay = delay
+        self._wake()
+
+    def _signal(self, command: bytes):
+        os.write(self._pipe_write, command + b'\n')
+
+    def _wake(self):
+        # one pending FLUSH is enough for the loop to pick up every queued write
+        with self._lock:
+            if self._woken:
+                return
+            self._woken = True
+        self._signal(b'FLUSH')
+
     def join(self, addr: tuple[str, int], username=None):
+        try:
+            self._join(addr, username)
+        except Exception as e:
+            self.output(f'Couldn\'t connect to requested address: {e}')
+
+    def _join(self, addr: tuple[str, int], username=None) -> User:
         packet = Packet.new(
             self.sender,
             PayloadType.JOIN,
             None,
             port=self.port
         )
-        try:
-            unsecure_send_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            send_socket = self.client_ctx.wrap_socket(unsecure_send_socket)
+        user = User('unknown' if username is None else username, addr, True, None, None)
+        self._attach(user, self._connect(addr))
+        self._enqueue(user, self._encode(packet, user))
 
-            send_socket.connect(addr)
+        self.users.add(user)
+        self._wake()
+        return user
 
-            send_socket.send(packet.to_bytearray())
+    def accept(self, user: User):
+        """
+        Lets `user` into the conversation: sends them a snapshot of the
+        members and the rest of the room a NEW_USR with just them, rather
+        than everyone the whole roster. In a mesh the members then let them
+        in when they join, in a tree the NEW_USR is relayed along it.
+        """
+        user.sponsored = True
+        version = self.membership.change(self.sender, {user.name: user.addr})
+        members = self.membership.members()
+        del members[user.name]
+        packet = Packet.new(self.sender, PayloadType.ACCEPT, members, port=self.port)
+        packet.roster_version = version
+        self.send(packet, user)
+        self._announce(PayloadType.NEW_USR, {user.name: user.addr}, version, exclude=user)
 
-            self.users.add(User('unknown' if username is None else username, addr, True, send_socket, None))
-        except Exception as e:
-            print(f'Couldn\'t connect to requested address: {e}')
+    def _neighbours(self, exclude: User = None) -> list[User]:
+        """
+        Peers that conversation-wide packets are sent to. In a mesh that's
+        everyone. In a tree it's only the peers we joined or accepted
+        ourselves, they relay the packets on to theirs, so the connections
+        and the upload per message of every member depend on how many peers
+        they accepted, not on the size of the room.
+        """
+        return [u for u in self.users if u.via is None and u is not exclude]
+
+    def _relay(self, packet: Packet, source: User, users: list[User] = None):
+        """
+        Passes a conversation-wide packet from `source` on to the rest of our
+        tree neighbours (or to `users`, in any topology). The tree has no
+        cycles, so nobody gets it twice.
+        """
+        if users is None:
+            if self.topology != 'tree':
+                return
+            users = self._neighbours(exclude=source)
+        if packet.hops >= MAX_HOPS or not users:
+            return
+        packet.rsvd[HOPS] += 1
+        if self.metrics:
+            self.metrics.inc('packets_relayed_total', type=packet.dtype.name)
+        self._forward(packet, users)
+
+    def _forward(self, packet: Packet, users: list[User]):
+        # called on the loop as well, don't wait for a full queue
+        self.broadcast(packet, users, block=False)
+
+    def _announce(self, dtype: PayloadType, members: dict[str, tuple[str, int]], version: int, exclude: User = None):
+        packet = Packet.new(self.sender, dtype, members, port=self.port)
+        packet.roster_version = version
+        self._forward(packet, self._neighbours(exclude=exclude))
+
+    def _update_members(self, packet: Packet, user: User):
+        """
+        Applies a NEW_USR/DEL_USR. One that changed something is relayed
+        along a tree, and in a mesh passed on to the members we accepted:
+        it may have been sent before its author knew about them.
+        """
+        left = packet.dtype == PayloadType.DEL_USR
+        changes = self.membership.update(packet.roster_version, packet.sender, {
+            name: None if left else addr for name, addr in packet.payload.items() if name != self.sender
+        })
+        if not changes:
+            return
+        for name, addr in changes.items():
+            if addr is None:
+                self._remove_member(name)
+            elif self.topology == 'tree':
+                self._add_members({name: addr}, user)
+            elif (member := self.users.find_by_name(name)) and member.accepted and not member.send_socket:
+                self._welcome(member) # they joined us before we heard about them
+            elif not member:
+                self.output(f'{name} is joining the conversation')
+        self._relay(packet, user, None if self.topology == 'tree' else [
+            u for u in self.users if u.sponsored and u is not user and u.name != packet.sender
+        ])
+
+    def _add_members(self, roster: dict[str, tuple[str, int]], via: User, announced=True):
+        for name, addr in roster.items():
+            if name == self.sender or self.users.find_by_name(name):
+                continue
+            self.users.add(User(name, tuple(addr), True, None, None, via=via))
+            if announced:
+                self.output(f'{name} joined the conversation')
+
+    def _remove_member(self, name: str):
+        user = self.users.find_by_name(name)
+        # direct neighbours are only dropped when we see them go ourselves
+        if user and user.via is not None:
+            self.output(f'{user} left the conversation')
+            self.users.remove(user)
+            if self.heartbeat is not None:
+                self.heartbeat.remove(user)
+            self._close_send_socket(user)
+            self._close_recv_socket(user)
+
+    def _welcome(self, user: User):
+        """
+        Accepts a member someone else already accepted into the
+        conversation, off the server loop.
+        """
+        def welcome():
+            try:
+                self.send(Packet.new(self.sender, PayloadType.ACCEPT, {}, port=self.port), user)
+            except Exception as e:
+                self.output(f'Couldn\'t connect to {user}: {e}')
+        threading.Thread(target=welcome, name='welcome', daemon=True).start()
+
+    def _beat(self) -> float | None:
+        """
+        Probes the peers that went quiet, handles the dead ones. Returns the
+        seconds until the next heartbeat timer, if any.
+        """
+        return self.heartbeat.expire() if self.heartbeat is not None else None
+
+    def _probe(self, user: User) -> bool:
+        if not user.send_socket:
+            return False
+        if self.metrics:
+            self.metrics.inc('heartbeat_probes_total')
+        self._forward(Packet.new(self.sender, PayloadType.RUA, None, port=self.port), [user])
+        return True
+
+    def _dead(self, user: User, strikes: int):
+        if user not in self.users:
+            self.heartbeat.remove(user)
+            return
+        reconnect = self.dead_peers == 'reconnect' and strikes == 1
+        if self.metrics:
+            self.metrics.inc('dead_peers_total', action='reconnect' if reconnect else 'evict')
+        if reconnect:
+            self.output(f'{user} stopped answering, reconnecting...')
+            self._reconnect(user)
+        else:
+            self.output(f'{user} stopped answering')
+            self._close_send_socket(user)
+            self._disconnect(user)
+
+    def _reconnect(self, user: User):
+        """
+        Replaces our connection to `user` with a new one and probes them
+        over it, off the server loop. If that fails they are disconnected.
+        """
+        self._close_send_socket(user)
+        def reconnect():
+            try:
+                self.send(Packet.new(self.sender, PayloadType.RUA, None, port=self.port), user)
+            except Exception as e:
+                self.output(f'Couldn\'t reconnect to {user}: {e}')
+                if user in self.users:
+                    self._deliver(None, user, ConnectionError(e))
+        threading.Thread(target=reconnect, name='reconnect', daemon=True).start()
+
+    def bootstrap(self, peers: dict[str, tuple[str, int]]) -> BootstrapReport:
+        """
+        Joins all `peers` (name -> address) we aren't connected to yet,
+        up to `bootstrap_workers` handshakes at a time. Each one is bounded
+        by `send_timeout`, so the whole mesh is set up in about the time of
+        the slowest handshake instead of the sum of all of them.
+        """
+        report = BootstrapReport()
+        peers = {name: tuple(addr) for name, addr in peers.items() if not self.find_by_addr(addr)}
+        if not peers:
+            return report
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=min(self.bootstrap_workers, len(peers)), thread_name_prefix='bootstrap') as executor:
+            futures = {executor.submit(self._join, addr, name): name for name, addr in peers.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                    report.connected.append(name)
+                except Exception as e:
+                    report.failed[name] = e
+        report.elapsed = time.monotonic() - start
+        return report
+
+    def _start_bootstrap(self, peers: dict[str, tuple[str, int]]):
+        # runs off the server loop, packets keep flowing while we connect
+        def bootstrap():
+            self.output(self.bootstrap(peers))
+        threading.Thread(target=bootstrap, name='bootstrap', daemon=True).start()
 
 
     def find_by_addr(self, addr: tuple[str, int], ignore_port=False) -> User | None:
-        for user in self.users:
-            if ignore_port:
-                if user.addr[0] == addr[0]:
-                    return user
-            else:
-                if user.addr == addr:
-                    return user
-        return None
+        return self.users.find_by_addr(addr, ignore_port=ignore_port)
     
-    def find_by_recv_socket(self, recv_socket: int) -> User | None:
-        for user in self.users:
-            if user.recv_socket == recv_socket:
-                return user
-        return None
+    def find_by_recv_socket(self, recv_socket: ssl.SSLSocket) -> User | None:
+        return self.users.find_by_socket(recv_socket)
     
     def stop(self):
+        self._delete_keys()
+        if self.history:
+            self.history.close()
+        self._signal(b'CLOSE')
+
+    def _delete_keys(self):
         if self.delete_keys:
-            if os.path.exists(self.public):
-                os.remove(self.public)
-            if os.path.exists(self.private):
-                os.remove(self.private)
-        os.write(self._pipe_write, b'CLOSE')
+            if self._identity_store:
+                self._identity_store.delete()
+            elif self.public and self.private:
+                if os.path.exists(self.public):
+                    os.remove(self.public)
+                if os.path.exists(self.private):
+                    os.remove(self.private)
 
     def exit_conversation(self):
-        os.write(self._pipe_write, b'EXIT_CONVERSATION')
+        self._signal(b'EXIT_CONVERSATION')
 
     def run(self):
+        self._load_identity()
         with self.server_ctx.wrap_socket(self.main_socket, server_side=True) as wrapped_socket:
             self.wrapped_socket = wrapped_socket
             wrapped_socket.bind((self.host, self.port))
@@ -170,99 +911,294 @@ class Server:
             self.potential_writers = []
             self.potential_errs = []
 
+            woke_at = 0
             while self.potential_readers:
+                self.potential_writers, next_flush = self._writers()
+                timeouts = [t for t in (next_flush, self._beat(), self.transfers.prune()) if t is not None]
+                if self.metrics and woke_at:
+                    self.metrics.since('loop_iteration_seconds', woke_at)
                 ready_to_read, ready_to_write, in_error = select.select(
                     self.potential_readers, 
                     self.potential_writers, 
-                    self.potential_errs
+                    self.potential_errs,
+                    min(timeouts) if timeouts else None
                 )
+                if self.metrics:
+                    # how long handling what woke us up takes
+                    woke_at = time.perf_counter_ns()
+                    self.metrics.inc('wakeups_total')
+
+                for s in ready_to_write:
+                    if user := self._pending.get(s):
+                        self._flush(user)
 
                 for s in ready_to_read:
                     if s is wrapped_socket:
                         # socket for accepting connections
                         connection, client_address = s.accept() # Accept connection
-                        print(f"Connection accepted: {client_address}")
+                        self.output(f"Connection accepted: {client_address}")
                         connection.setblocking(0)
-                        self.potential_readers.append(connection)
  
                         if user := self.find_by_addr(client_address, ignore_port=True):
-                            user.recv_socket = connection
+                            # a connection it replaces would stay readable with nobody to read it, spinning the loop
+                            self._close_recv_socket(user)
+                            self.users.update(user, recv_socket=connection)
                         else:
                             user = User('unknown', client_address, False, None, connection)
                             self.users.add(user)
+
+                        if self.receive_workers:
+                            if not self._workers:
+                                # started with the conversation, stopped when it's left
+                                self._workers = [
+                                    ReceiveWorker(f'receive_{i}', self._read_packets, self._deliver)
+                                    for i in range(self.receive_workers)
+                                ]
+                            worker = self._shards[connection] = min(self._workers, key=len)
+                            worker.add(connection)
+                        else:
+                            self.potential_readers.append(connection)
                     elif s is self._pipe_read:
-                        data = os.read(s, 1024)
-                        if data == b'CLOSE':
+                        commands = os.read(s, 4096).split(b'\n')
+                        with self._lock:
+                            self._woken = False
+                        if b'CLOSE' in commands:
+                            self._close_workers()
                             exit(0)
-                        if data == b'EXIT_CONVERSATION':
-                            for u in self.users:
-                                if u.send_socket and u.send_socket.fileno() > 0:
-                                    u.send_socket.close()
-                                if u.recv_socket and u.send_socket.fileno() > 0:
-                                    self.potential_readers.remove(u.recv_socket)
-                                    u.recv_socket.close()
-                            self.users.clear()
+                        if b'EXIT_CONVERSATION' in commands:
+                            self._leave_conversation()
+                        # FLUSH only wakes us up so that new pending writes get selected,
+                        # and whatever the receive workers delivered gets handled
+                        while True:
+                            try:
+                                self._dispatch(*self._inbox.get_nowait())
+                            except queue.Empty:
+                                break
                     else:
                         # socket for receiving data
-                        data = s.recv(1024)
-                        user = self.find_by_recv_socket(s)
-                        if not user:
-                            continue
-                        if data:
-                            try:
-                                packet = Packet.from_raw(bytearray(data))
-                                user.name = packet.sender
-                                if packet.port:
-                                    user.addr = (user.addr[0], packet.port)
-                            except Exception as e:
-                                s.send(
-                                    Packet.new(
-                                        self.sender, 
-                                        PayloadType.ERROR, 
-                                        f'Unknown packet format\n{e}'
-                                    ).to_bytearray()
-                                )
-                                if s in self.potential_readers:
-                                    self.potential_readers.remove(s)
-                                if s in self.potential_writers:
-                                    self.potential_writers.remove(s)
-                                if s in self.potential_errs:
-                                    self.potential_errs.remove(s)
-                                s.close()
-                                continue
-
-                            if packet.dtype in {PayloadType.MSG, PayloadType.WHISPER} and user.accepted:
-                                print(f'')
-                                print(f"[{packet.sender_time}] {user}{' whispers' if packet.dtype == PayloadType.WHISPER else ''}: {packet.payload}")
-                            elif packet.dtype == PayloadType.JOIN:
-                                if user in self.users:
-                                    continue
-                                # prompt user to send ACCEPT/DENY
-                                print(f'{user} wants to join the conversation')
-                                print(f'You can accept with /accept {user.name}')
-                                user.accepted = True
-                            elif packet.dtype == PayloadType.ACCEPT:
-                                user.accepted = True
-                                print(f'{user} accepted the invitation.')
-                                self.control.change_mode(TuiMode.Conversation)
-                                for u, u_addr in packet.payload.items():
-                                    if self.find_by_addr(u_addr):
-                                        continue
-                                    self.join(u_addr, u)
-                        else:
-                            print(f'{user} disconnected')
-                            new_users = set()
-                            for u in self.users:
-                                if u.name == user.name and u.addr[0] == user.addr[0] and u.addr[1] == user.addr[1]:
-                                    continue
-                                new_users.add(u)
-                            self.users = new_users
-
-                            if user.send_socket and user.send_socket.fileno() > 0:
-                                user.send_socket.close()
-                            if user.recv_socket and user.send_socket.fileno() > 0:
-                                self.potential_readers.remove(user.recv_socket)
-                                user.recv_socket.close()
+                        user, result = self._read_packets(s)
+                        if user:
+                            self._dispatch(s, user, result)
+
+    def _read_packets(self, s: ssl.SSLSocket) -> tuple[User, list[Packet] | Exception | None]:
+        """
+        Reads what arrived on the receiving socket `s` and parses the complete
+        packets. Returns the socket's user (None if it's unknown) and the
+        packets, None if the peer closed the connection, or the exception
+        that broke it.
+        """
+        user = self.find_by_recv_socket(s)
+        if not user:
+            return None, []
+        reader = self._readers.setdefault(s, FrameReader())
+        try:
+            if not self._recv(s, reader):
+                return user, None
+            packets = []
+            m = self.metrics
+            for frame in reader.frames():
+                if not user.accepted and s not in self._admitting:
+                    # `user.accepted` is only set when the JOIN/ACCEPT is dispatched, which may be later
+                    # (further in this batch, or on the server thread while a worker reads the next one)
+                    dtype = Packet.peek_dtype(frame)
+                    if dtype in ADMITTING_TYPES:
+                        self._admitting.add(s)
+                    elif dtype in UNADMITTED_TYPES:
+                        # would be ignored anyway, don't bother decoding the payload
+                        continue
+                start = time.perf_counter_ns() if m and m.timings else 0
+                packets.append(Packet.from_raw(frame))
+                if start:
+                    m.since('stage_seconds', start, stage='decode')
+        except ssl.SSLWantReadError:
+            return user, []
+        except Exception as e:
+            return user, e
+        return user, packets
+
+    def _deliver(self, s: ssl.SSLSocket, user: User, result):
+        """
+        Hands what a receive worker read over to the server loop.
+        """
+        self._inbox.put((s, user, result))
+        self._wake()
+
+    def _dispatch(self, s: ssl.SSLSocket, user: User, result):
+        if result is None or isinstance(result, ConnectionError):
+            self._disconnect(user)
+        elif isinstance(result, Exception):
+            self._reject(s, result)
+        else:
+            m = self.metrics
+            for packet in result:
+                start = time.perf_counter_ns() if m and m.timings else 0
+                self._handle_packet(s, user, packet)
+                if start:
+                    m.since('stage_seconds', start, stage='dispatch')
+
+    def _recv(self, s: ssl.SSLSocket, reader: FrameReader) -> bool:
+        m = self.metrics
+        start = time.perf_counter_ns() if m and m.timings else 0
+        n = reader.recv_into(s)
+        if not n:
+            return False
+        # TLS may have decrypted more than one record, select() won't wake us up for those
+        while s.pending():
+            n += reader.recv_into(s)
+        if m:
+            m.inc('bytes_received_total', n)
+            if start:
+                m.since('stage_seconds', start, stage='tls_read')
+        return True
+
+    def _handle_packet(self, s: ssl.SSLSocket, user: User, packet: Packet):
+        if self.metrics:
+            self.metrics.inc('packets_received_total', type=packet.dtype.name)
+        # a relayed packet's header describes its author, not the neighbour it came from
+        author = (self.users.find_by_name(packet.sender) or packet.sender) if packet.hops else user
+        known = bool(packet.hops)
+        if not known:
+            addr = (user.addr[0], packet.port) if packet.port else user.addr
+            known = (user.name, user.addr) == (packet.sender, addr)
+            if not known:
+                self.users.update(user, name=packet.sender, addr=addr)
+            user.capabilities = packet.capabilities
+        if self.heartbeat is not None and Capability.HEARTBEAT in user.capabilities:
+            self.heartbeat.seen(user)
+
+        if packet.dtype in {PayloadType.MSG, PayloadType.WHISPER} and user.accepted:
+            if packet.dtype == PayloadType.MSG:
+                self._relay(packet, user)
+            self.output_message(f"[{packet.sender_time}] {author}{' whispers' if packet.dtype == PayloadType.WHISPER else ''}: {packet.payload}")
+            self._log(packet)
+            if self.on_message:
+                self.on_message(user, packet)
+        elif packet.dtype == PayloadType.RUA:
+            self._forward(Packet.new(self.sender, PayloadType.IAA, None, port=self.port), [user])
+        elif packet.dtype in {PayloadType.NEW_USR, PayloadType.DEL_USR} and user.accepted:
+            self._update_members(packet, user)
+        elif packet.dtype in TRANSFER_TYPES:
+            self._receive_transfer(user, packet)
+        elif packet.dtype == PayloadType.JOIN:
+            if known:
+                return
+            user.accepted = True
+            if self.membership.get(user.name) == user.addr:
+                # announced by whoever accepted them
+                self.output(f'{user} joined the conversation')
+                self._welcome(user)
+                return
+            # prompt user to send ACCEPT/DENY
+            self.output(f'{user} wants to join the conversation')
+            self.output(f'You can accept with /accept {user.name}')
+        elif packet.dtype == PayloadType.ACCEPT:
+            user.accepted = True
+            self.output(f'{user} accepted the invitation.')
+            self.control.change_mode(TuiMode.Conversation)
+            members = {name: addr for name, addr in packet.payload.items() if name != self.sender}
+            added = self.membership.load(packet.roster_version, {**members, user.name: user.addr})
+            if self.topology == 'tree':
+                self._add_members(added, user, announced=False)
+            elif members:
+                self._start_bootstrap(members)
+
+    def _receive_transfer(self, user: User, packet: Packet):
+        if self.membership.get(user.name) != user.addr:
+            # only from someone accepted into the conversation, asking to join isn't enough
+            if packet.dtype == PayloadType.XFER_BEGIN:
+                self.output(f'Ignored a file from {user}, who is not in the conversation')
+            return
+        if packet.dtype == PayloadType.XFER_BEGIN:
+            self.output(f'{user} is sending {packet.payload.data.decode("utf-8", "replace")} ({packet.payload.offset} bytes)')
+        try:
+            done = self.transfers.receive(user.name, packet)
+        except Exception as e:
+            self.output(f'Transfer from {user} failed: {e}')
+            return
+        if done:
+            incoming, path = done
+            elapsed = time.monotonic() - incoming.started
+            self.output(f'Received {path} from {user} ({incoming.size / (1024 * 1024):.1f} MiB in {elapsed:.2f}s)')
+
+    def _reject(self, s: ssl.SSLSocket, e: Exception):
+        s.send(
+            Packet.new(
+                self.sender, 
+                PayloadType.ERROR, 
+                f'Unknown packet format\n{e}'
+            ).to_bytearray()
+        )
+        self._forget_socket(s)
+        s.close()
+
+    def _forget_socket(self, s: ssl.SSLSocket):
+        if s in self.potential_readers:
+            self.potential_readers.remove(s)
+        if s in self.potential_writers:
+            self.potential_writers.remove(s)
+        if s in self.potential_errs:
+            self.potential_errs.remove(s)
+        if worker := self._shards.pop(s, None):
+            worker.remove(s)
+        self._readers.pop(s, None)
+        self._admitting.discard(s)
+
+    def _disconnect(self, user: User):
+        self.output(f'{user} disconnected')
+        self.users.remove(user)
+        self.transfers.abort(user.name)
+        if self.heartbeat is not None:
+            self.heartbeat.remove(user)
+
+        self._close_send_socket(user)
+        self._close_recv_socket(user)
+
+        gone = [user]
+        if self.topology == 'tree' and user.via is None and user.accepted:
+            # whoever we reached through them is cut off from our part of the tree
+            behind = [u for u in self.users if u.via is user]
+            if behind:
+                self.output(f'Lost {len(behind)} members behind {user}, they have to join again')
+            for u in behind:
+                self.users.remove(u)
+                if self.heartbeat is not None:
+                    self.heartbeat.remove(u)
+                self._close_send_socket(u)
+                self._close_recv_socket(u)
+            gone += behind
+        gone = [u for u in gone if u.name in self.membership]
+        if gone:
+            version = self.membership.change(self.sender, {u.name: None for u in gone})
+            # in a mesh everyone sees them go for themselves
+            if self.topology == 'tree':
+                self._announce(PayloadType.DEL_USR, {u.name: u.addr for u in gone}, version)
+
+    def _close_recv_socket(self, user: User):
+        recv_socket = user.recv_socket
+        self.users.update(user, recv_socket=None)
+        if recv_socket and recv_socket.fileno() > 0:
+            self._forget_socket(recv_socket)
+            recv_socket.close()
+
+    def _leave_conversation(self):
+        for u in self.users:
+            self._close_send_socket(u)
+            self._close_recv_socket(u)
+        self.users.clear()
+        self.transfers.abort()
+        if self.heartbeat is not None:
+            self.heartbeat.clear()
+        self.membership.clear()
+        self._conversation_flush_delay = self.flush_delay
+        with self._lock:
+            self.conversation = None
+        self._close_workers()
+
+    def _close_workers(self):
+        workers, self._workers = self._workers, []
+        self._shards.clear()
+        for worker in workers:
+            worker.close()
 
 
 if __name__ == '__main__':
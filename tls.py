@@ -0,0 +1,47 @@
+import platform
+import ssl
+
+# not exported by the ssl module, see SSL_OP_PRIORITIZE_CHACHA in openssl/ssl.h
+OP_PRIORITIZE_CHACHA = 1 << 21
+# TLS 1.2 only (1.3 suites can't be changed through the ssl module), used if a peer can't do 1.3
+TLS12_CIPHERS = {
+    True: 'ECDHE+AESGCM:ECDHE+CHACHA20',
+    False: 'ECDHE+CHACHA20:ECDHE+AESGCM',
+}
+
+
+def has_aes_hardware() -> bool:
+    """
+    Best guess whether the CPU has AES instructions (AES-NI, ARMv8 crypto).
+    """
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith(('flags', 'Features')):
+                    return 'aes' in line.split(':', 1)[1].split()
+    except OSError:
+        pass
+    # no /proc (macOS, Windows): every x86-64 and Apple Silicon CPU from the last decade has it
+    return platform.machine().lower() in {'x86_64', 'amd64', 'arm64', 'aarch64'}
+
+
+def create_context(server_side: bool, public: str, private: str, passwd: str = None, tls13_only=True) -> ssl.SSLContext:
+    """
+    TLS context for peer connections (certificates aren't verified, peers
+    use self-signed ones). Negotiates TLS 1.3 with AES-GCM first when the
+    CPU accelerates AES and ChaCha20-Poly1305 first otherwise.
+    """
+    ctx = ssl._create_unverified_context(ssl.PROTOCOL_TLS_SERVER if server_side else ssl.PROTOCOL_TLS_CLIENT)
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_3 if tls13_only else ssl.TLSVersion.TLSv1_2
+    ctx.options |= ssl.OP_NO_COMPRESSION
+
+    aes = has_aes_hardware()
+    ctx.set_ciphers(TLS12_CIPHERS[aes])
+    if server_side:
+        ctx.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+        if not aes:
+            # picks ChaCha20 whenever the client lists it first, the 1.3 suite order itself is OpenSSL's
+            ctx.options |= OP_PRIORITIZE_CHACHA
+
+    ctx.load_cert_chain(public, private, password=passwd)
+    return ctx
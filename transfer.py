@@ -0,0 +1,319 @@
+from alp import Packet, PayloadType, Transfer, HEADER_SIZE, TRANSFER_HEADER, RECV_BUFFER_SIZE
+import bisect
+import itertools
+import mmap
+import os
+import tempfile
+import threading
+import time
+from typing import Callable
+
+# a chunk packet fills the receive buffer exactly
+CHUNK_SIZE = RECV_BUFFER_SIZE - HEADER_SIZE - TRANSFER_HEADER.size
+# bytes queued for a peer above which a transfer waits, so chat messages get in between the chunks
+TRANSFER_WINDOW = 2 * RECV_BUFFER_SIZE
+# the file is mapped this much at a time, mapped pages count towards the resident memory
+MAP_WINDOW = 256 * mmap.ALLOCATIONGRANULARITY
+MAX_FILE_SIZE = 1024 * 1024 * 1024
+# an incoming transfer that got nothing for this long is given up on, its partial file removed
+IDLE_TIMEOUT = 60.0
+TRANSFER_TYPES = frozenset({PayloadType.XFER_BEGIN, PayloadType.XFER_CHUNK, PayloadType.XFER_END})
+
+
+class OutgoingTransfer:
+    """
+    A file being sent to a peer.
+
+    `packets` yields the `XFER_*` packets one by one, reading the chunks
+    from a sliding memory-mapped window of the file as they are needed, so
+    memory use doesn't depend on the file size.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, sender: str, path: str):
+        self.sender = sender
+        self.name = os.path.basename(path)
+        self.transfer_id = next(OutgoingTransfer._ids)
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self.sent = 0
+
+    def __str__(self):
+        return f'{self.name} ({self.size} bytes)'
+
+    def packets(self):
+        try:
+            yield self._packet(PayloadType.XFER_BEGIN, self.size, self.name.encode('utf-8'))
+            for start in range(0, self.size, MAP_WINDOW):
+                length = min(MAP_WINDOW, self.size - start)
+                with mmap.mmap(self._file.fileno(), length, access=mmap.ACCESS_READ, offset=start) as m:
+                    if hasattr(m, 'madvise'):
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    for offset in range(0, length, CHUNK_SIZE):
+                        # slicing copies the chunk out, nothing keeps the mapping exported
+                        chunk = m[offset:offset + CHUNK_SIZE]
+                        self.sent = start + offset + len(chunk)
+                        yield self._packet(PayloadType.XFER_CHUNK, start + offset, chunk)
+            yield self._packet(PayloadType.XFER_END, self.size)
+        finally:
+            self._file.close()
+
+    def _packet(self, dtype: PayloadType, offset: int, data: bytes = b'') -> Packet:
+        return Packet.new(self.sender, dtype, Transfer(self.transfer_id, offset, data))
+
+
+class IncomingTransfer:
+    """
+    A file being received. Chunks are written straight to a temporary file
+    in `directory`, which is renamed to the sender's file name once all of
+    it has arrived. The byte ranges written are kept, so a chunk sent twice
+    can't make up for one that never came.
+    """
+    def __init__(self, directory: str, name: str, size: int):
+        # never trust a path from the network
+        self.name = os.path.basename(name) or 'unnamed'
+        self.directory = directory
+        self.size = size
+        self._ranges: list[list[int]] = [] # sorted, disjoint [start, end) ranges written
+        self.started = self.active = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        self._fd, self.tmp_path = tempfile.mkstemp(prefix=f'.{self.name}.', suffix='.part', dir=directory)
+
+    def write(self, offset: int, data: bytes):
+        if offset + len(data) > self.size:
+            raise ValueError(f'Chunk at {offset} is past the end of {self.name} ({self.size} bytes)')
+        os.pwrite(self._fd, data, offset)
+        self._mark(offset, offset + len(data))
+        self.active = time.monotonic()
+
+    @property
+    def received(self) -> int:
+        return sum(end - start for start, end in self._ranges)
+
+    def _mark(self, start: int, end: int):
+        if start == end:
+            return
+        ranges = self._ranges
+        last = ranges[-1] if ranges else None
+        if last and last[0] <= start <= last[1]:
+            # chunks come in order, so this is almost always it
+            last[1] = max(last[1], end)
+            return
+        i = bisect.bisect_left(ranges, [start, end])
+        ranges.insert(i, [start, end])
+        # merge with the neighbours it overlaps or touches
+        i = max(i - 1, 0)
+        while i + 1 < len(ranges):
+            if ranges[i][1] >= ranges[i + 1][0]:
+                ranges[i][1] = max(ranges[i][1], ranges.pop(i + 1)[1])
+            elif ranges[i][0] > end:
+                break
+            else:
+                i += 1
+
+    def finish(self) -> str:
+        """
+        Moves the complete file in place, returns its path.
+        """
+        os.close(self._fd)
+        if self._ranges != ([[0, self.size]] if self.size else []):
+            os.remove(self.tmp_path)
+            raise ValueError(f'{self.name} is incomplete ({self.received}/{self.size} bytes)')
+        base, ext = os.path.splitext(self.name)
+        path = os.path.join(self.directory, self.name)
+        for n in itertools.count(1):
+            if not os.path.exists(path):
+                break
+            path = os.path.join(self.directory, f'{base} ({n}){ext}')
+        os.replace(self.tmp_path, path)
+        return path
+
+    def abort(self):
+        os.close(self._fd)
+        os.remove(self.tmp_path)
+
+
+class Transfers:
+    """
+    Incoming transfers in flight, keyed by the sender and their transfer id.
+    Files larger than `max_size` are refused. `prune` gives up on the ones
+    that got nothing for `idle_timeout` seconds (the sender failed or went
+    quiet), telling `output` about it.
+    """
+    def __init__(self, directory: str, max_size: int = MAX_FILE_SIZE, idle_timeout: float = IDLE_TIMEOUT, output: Callable = print):
+        self.directory = directory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.output = output
+        self._lock = threading.Lock()
+        self._incoming: dict[tuple[str, int], IncomingTransfer] = {}
+        self._refused: set[tuple[str, int]] = set() # their remaining chunks are dropped quietly
+
+    def receive(self, sender: str, packet: Packet) -> tuple[IncomingTransfer, str] | None:
+        """
+        Handles an `XFER_*` packet. Returns the transfer and the path of the
+        received file once it's complete.
+        """
+        transfer = packet.payload
+        key = (sender, transfer.transfer_id)
+        match packet.dtype:
+            case PayloadType.XFER_BEGIN:
+                if transfer.offset > self.max_size:
+                    with self._lock:
+                        self._refused.add(key)
+                    raise ValueError(f'{transfer.offset} bytes is more than the limit of {self.max_size} bytes')
+                incoming = IncomingTransfer(self.directory, transfer.data.decode('utf-8'), transfer.offset)
+                with self._lock:
+                    previous = self._incoming.pop(key, None)
+                    self._incoming[key] = incoming
+                if previous:
+                    previous.abort()
+            case PayloadType.XFER_CHUNK:
+                with self._lock:
+                    incoming = self._incoming.get(key)
+                if not incoming:
+                    if key in self._refused:
+                        return None
+                    raise ValueError(f'Unknown transfer {transfer.transfer_id}')
+                try:
+                    incoming.write(transfer.offset, transfer.data)
+                except Exception:
+                    self._abort(key)
+                    with self._lock:
+                        self._refused.add(key)
+                    raise
+            case PayloadType.XFER_END:
+                with self._lock:
+                    incoming = self._incoming.pop(key, None)
+                    refused = key in self._refused
+                    self._refused.discard(key)
+                if not incoming:
+                    if refused:
+                        return None
+                    raise ValueError(f'Unknown transfer {transfer.transfer_id}')
+                return incoming, incoming.finish()
+        return None
+
+    def abort(self, sender: str = None):
+        """
+        Drops the unfinished transfers from `sender` (from everyone by default).
+        """
+        with self._lock:
+            keys = [key for key in self._incoming if sender is None or key[0] == sender]
+            self._refused = {key for key in self._refused if sender is not None and key[0] != sender}
+        for key in keys:
+            self._abort(key)
+
+    def prune(self, now: float = None) -> float | None:
+        """
+        Aborts the transfers idle for longer than `idle_timeout`. Returns
+        the number of seconds until the next one may expire, if any.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            expired = [key for key, incoming in self._incoming.items() if now - incoming.active >= self.idle_timeout]
+            left = [self.idle_timeout - (now - incoming.active) for key, incoming in self._incoming.items() if key not in expired]
+        for key in expired:
+            incoming = self._incoming.get(key)
+            self._abort(key)
+            if incoming:
+                self.output(f'Gave up on receiving {incoming.name} from {key[0]}: nothing arrived for {self.idle_timeout:.0f}s')
+        return min(left) if left else None
+
+    def _abort(self, key: tuple[str, int]):
+        with self._lock:
+            incoming = self._incoming.pop(key, None)
+        if incoming:
+            incoming.abort()
+
+
+if __name__ == '__main__':
+    def test():
+        import random
+
+        def packet(dtype: PayloadType, transfer_id: int, offset: int, data: bytes = b'') -> Packet:
+            return Packet.new('alice', dtype, Transfer(transfer_id, offset, data))
+
+        with tempfile.TemporaryDirectory() as directory:
+            notices = []
+            transfers = Transfers(directory, max_size=1000, idle_timeout=10.0, output=notices.append)
+            data = os.urandom(1000)
+
+            # out of order, duplicated and overlapping chunks
+            transfers.receive('alice', packet(PayloadType.XFER_BEGIN, 1, len(data), b'../../a.bin'))
+            chunks = [(offset, data[offset:offset + 100]) for offset in range(0, 1000, 100)]
+            random.Random(1).shuffle(chunks)
+            chunks += [(0, data[:100]), (50, data[50:250]), (950, data[950:])]
+            for offset, chunk in chunks:
+                assert transfers.receive('alice', packet(PayloadType.XFER_CHUNK, 1, offset, chunk)) is None
+            incoming, path = transfers.receive('alice', packet(PayloadType.XFER_END, 1, len(data)))
+            assert path == os.path.join(directory, 'a.bin') # no escaping the directory
+            assert incoming.received == 1000 and open(path, 'rb').read() == data
+            assert [name for name in os.listdir(directory) if name.endswith('.part')] == []
+
+            # a resent chunk doesn't make up for a missing one
+            partial = IncomingTransfer(directory, 'b.bin', 300)
+            for offset in (0, 0, 200):
+                partial.write(offset, data[offset:offset + 100])
+            assert partial._ranges == [[0, 100], [200, 300]] and partial.received == 200
+            partial._mark(50, 250)
+            assert partial._ranges == [[0, 300]]
+            partial.abort()
+            assert not os.path.exists(partial.tmp_path)
+            incoming = IncomingTransfer(directory, 'c.bin', 300)
+            incoming.write(0, data[:100])
+            incoming.write(0, data[:100])
+            incoming.write(100, data[100:200])
+            try:
+                incoming.finish()
+                assert False, 'finished an incomplete file'
+            except ValueError:
+                pass
+            assert not os.path.exists(os.path.join(directory, 'c.bin'))
+
+            # too big, or a chunk past the announced size
+            try:
+                transfers.receive('alice', packet(PayloadType.XFER_BEGIN, 2, 1001, b'big.bin'))
+                assert False, 'accepted a file over the limit'
+            except ValueError:
+                pass
+            assert transfers.receive('alice', packet(PayloadType.XFER_CHUNK, 2, 0, data[:10])) is None # dropped quietly
+            assert transfers.receive('alice', packet(PayloadType.XFER_END, 2, 1001)) is None
+            transfers.receive('alice', packet(PayloadType.XFER_BEGIN, 3, 100, b'd.bin'))
+            try:
+                transfers.receive('alice', packet(PayloadType.XFER_CHUNK, 3, 50, data[:100]))
+                assert False, 'wrote past the end'
+            except ValueError:
+                pass
+            assert transfers.receive('alice', packet(PayloadType.XFER_CHUNK, 3, 0, data[:10])) is None
+            transfers.abort('alice')
+
+            # a stalled transfer is given up on and its partial file removed
+            transfers.receive('alice', packet(PayloadType.XFER_BEGIN, 4, 500, b'e.bin'))
+            transfers.receive('alice', packet(PayloadType.XFER_CHUNK, 4, 0, data[:100]))
+            stalled = transfers._incoming[('alice', 4)]
+            now = time.monotonic()
+            assert 9.0 < transfers.prune(now) <= 10.0 and not notices
+            assert transfers.prune(now + 11.0) is None
+            assert len(notices) == 1 and 'e.bin' in notices[0]
+            assert not os.path.exists(stalled.tmp_path)
+            try:
+                transfers.receive('alice', packet(PayloadType.XFER_CHUNK, 4, 100, data[:100]))
+                assert False, 'wrote to an expired transfer'
+            except ValueError:
+                pass
+
+            # a whole file through the packets of an outgoing transfer
+            path = os.path.join(directory, 'source.bin')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(3 * CHUNK_SIZE + 123))
+            transfers.max_size = MAX_FILE_SIZE
+            os.makedirs(os.path.join(directory, 'downloads'))
+            transfers.directory = os.path.join(directory, 'downloads')
+            for sent in OutgoingTransfer('alice', path).packets():
+                done = transfers.receive('alice', Packet.from_raw(sent.to_bytearray()))
+            assert open(done[1], 'rb').read() == open(path, 'rb').read()
+
+        print("All tests passed successfully.")
+
+    test()
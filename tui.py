@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from enum import Enum
 from typing import Callable, Optional, Any
+import glob
 import readline
 from alp import Packet, PayloadType
 import os
@@ -11,10 +12,15 @@ class Tui:
     def __init__(self, control: Any, username: str, port=None):
         self.ctx = TuiContext(control, username, port)
         self.running = False
+        self.reading: str = None # the prompt of the input() in progress
+        self._matches: list[str] = []
 
     def run(self):
         readline.set_auto_history(False)
         readline.clear_history()
+        readline.set_completer(self.complete)
+        readline.set_completer_delims(' ')
+        readline.parse_and_bind('tab: complete')
         self.running = True
         print(f'Welcome, {self.ctx.username}!\nType /help to see available commands')
         print(f'Interfaces:')
@@ -22,7 +28,9 @@ class Tui:
         ip_addresses = socket.gethostbyname_ex(local_hostname)[2]
         print(ip_addresses)
         while self.running:
+            self.reading = self.ctx.prompt
             user_input = input(self.ctx.prompt)
+            self.reading = None
             self.exec_command(user_input)
 
     def stop(self):
@@ -34,47 +42,38 @@ class Tui:
     def exec_command(self, user_input: str):
         if not user_input.startswith('/'):
             return
-        
-        tokens = user_input.split(' ')
 
         self.ctx.add_to_cmd_history(user_input)
-        
-        if len(tokens) == 0:
-            return
-        
-        cmd_str = tokens[0].lstrip('/')
-        tui_command = TuiCommand.from_name(cmd_str)
-        if not tui_command:
-            print(f'Unknown command `{cmd_str}`')
-            return
 
-        if tui_command.name not in set([cmd.name for cmd in TuiCommand.available_commands(self.ctx)]):
+        cmd_str, _, args = user_input.lstrip('/').partition(' ')
+        tui_command = TuiCommand.available_commands(self.ctx).get(cmd_str)
+        if not tui_command:
+            if cmd_str not in TuiCommand.all_commands():
+                print(f'Unknown command `{cmd_str}`')
+                return
             print(f'Command `{cmd_str}` is not available in this mode!')
             print(f'Available commands:')
-            TuiCommand.all_commands()['help'].execute(self.ctx)
+            TuiCommand.from_name('help').execute(self.ctx)
             return
-        
-        match tui_command.n_args:
-            case 1: tui_command.execute(self.ctx)
-            case 2: 
-                if tui_command.name == 'msg':
-                    tui_command.execute(self.ctx, ' '.join(tokens[1::]))
-                else:
-                    if not self._guard(tui_command, tokens):
-                        return
-                    tui_command.execute(self.ctx, tokens[1])
-            case 3:
-                try:
-                    tui_command.execute(self.ctx, tokens[1], ' '.join(tokens[2::]))
-                except Exception as e:
-                    print(f'Couldn\'t whisper to {tokens[1]}: {e}')
-            case n: print(f'Internal error: unreachable statement reached with n_args={n} (???)')
-
-    def _guard(self, cmd, tokens):
-        if len(tokens) != cmd.n_args:
-            print(f'Too {"few" if len(tokens) < cmd.n_args else "many"} arguments ({len(tokens)}) for `{cmd.name}` command (needed: {cmd.n_args})')
-            return False
-        return True
+
+        args = tui_command.parse(args)
+        if args is not None:
+            tui_command.execute(self.ctx, *args)
+
+    def complete(self, text: str, state: int):
+        """
+        readline completer: command names first, then the arguments of the
+        command, from the same tables `exec_command` dispatches on.
+        """
+        if state == 0:
+            before = readline.get_line_buffer()[:readline.get_begidx()].split()
+            if not before:
+                self._matches = [f'/{name}' for name in TuiCommand.available_commands(self.ctx) if f'/{name}'.startswith(text)]
+            elif tui_command := TuiCommand.available_commands(self.ctx).get(before[0].lstrip('/')):
+                self._matches = tui_command.complete(self.ctx, len(before) - 1, text)
+            else:
+                self._matches = []
+        return self._matches[state] if state < len(self._matches) else None
 
 
 class TuiMode(Enum):
@@ -85,15 +84,15 @@ class TuiMode(Enum):
 class TuiContext:
     mode: TuiMode = TuiMode.Idle
     prompt: str = '(secure_messenger) '
-    cmd_history: dict[TuiMode, list[str]] = {
-        TuiMode.Idle: [],
-        TuiMode.Conversation: []
-    }
 
     def __init__(self, control: Any, username: str, port=None):
         self.control = control
         self.username = username
         self.port = port
+        self.cmd_history: dict[TuiMode, list[str]] = {
+            TuiMode.Idle: [],
+            TuiMode.Conversation: []
+        }
 
     def add_to_cmd_history(self, cmd: str):
         self.cmd_history[self.mode].append(cmd)
@@ -114,91 +113,168 @@ class TuiCommand:
     name: str
     description: str
     modes: set[TuiMode]
-    n_args: int
+    args: tuple[str, ...] # argument names, `...` - takes the rest of the line
     execute: Callable
 
+    @property
+    def usage(self) -> str:
+        return ' '.join([f'/{self.name}', *(f'<{arg}>' for arg in self.args)])
+
+    def parse(self, line: str) -> list[str] | None:
+        """
+        Splits the arguments after the command name, prints the usage and
+        returns None if there are too few or too many of them.
+        """
+        if self.args and self.args[-1].endswith('...'):
+            args = line.split(' ', len(self.args) - 1) if line else []
+        else:
+            args = line.split()
+        if len(args) != len(self.args):
+            print(f'Too {"few" if len(args) < len(self.args) else "many"} arguments ({len(args)}) for `{self.name}` command, usage: {self.usage}')
+            return None
+        return args
+
+    def complete(self, ctx: TuiContext, index: int, text: str) -> list[str]:
+        """
+        Completions of `text` as the `index`-th argument.
+        """
+        if index >= len(self.args):
+            if not (self.args and self.args[-1].endswith('...')):
+                return []
+            index = len(self.args) - 1
+        match self.args[index].rstrip('.'):
+            case 'user':
+                candidates = [user.name for user in ctx.control.users_list()]
+            case 'path':
+                return sorted(path + '/' if os.path.isdir(path) else path for path in glob.glob(os.path.expanduser(text) + '*'))
+            case arg if '|' in arg:
+                candidates = arg.split('|')
+            case _:
+                return []
+        return sorted(c for c in candidates if c.startswith(text))
+
     @staticmethod
-    def available_commands(ctx: TuiContext):
-        return set(filter(lambda cmd: ctx.mode in cmd.modes, TuiCommand.all_commands().values()))
+    def available_commands(ctx: TuiContext) -> dict[str, 'TuiCommand']:
+        return MODE_COMMANDS[ctx.mode]
 
     @staticmethod
-    def all_commands():
+    def all_commands() -> dict[str, 'TuiCommand']:
+        return COMMANDS
+
+    @staticmethod
+    def _registry():
         return {
             'join': TuiCommand(
                 'join',
                 'join a conversation using a known username or IPv4 address',
                 {TuiMode.Idle},
-                2,
+                ('address',),
                 TuiCommand._join,
             ),
             'accept': TuiCommand(
                 'accept',
                 'accept an invitation from another user',
                 {TuiMode.Idle, TuiMode.Conversation},
-                2,
+                ('user',),
                 TuiCommand._command_accept
             ),
             'list': TuiCommand(
                 'list',
                 'idle: display known users with theis IPs; conversation: display users in this conversation',
                 {TuiMode.Idle, TuiMode.Conversation},
-                1,
+                (),
                 TuiCommand._command_list,
             ),
             'msg': TuiCommand(
                 'msg',
                 'send message in this conversation',
                 {TuiMode.Conversation},
-                2,
-                lambda ctx, msg: ctx.control.sendall(
-                    Packet.new(
-                        ctx.username,
-                        PayloadType.MSG,
-                        msg,
-                    )
-                )
+                ('text...',),
+                TuiCommand._command_msg
             ),
             'whisper': TuiCommand(
                 'whisper',
                 'send message directly to a user',
                 {TuiMode.Conversation},
-                3,
-                lambda ctx, user, msg: ctx.control.send(
-                    Packet.new(
-                        ctx.username,
-                        PayloadType.WHISPER,
-                        msg,
-                    ),
-                    ctx.control.find_by_username(user)
-                )
+                ('user', 'text...'),
+                TuiCommand._command_whisper
+            ),
+            'send-file': TuiCommand(
+                'send-file',
+                'send a file directly to a user',
+                {TuiMode.Conversation},
+                ('user', 'path...'),
+                TuiCommand._command_send_file
+            ),
+            'history': TuiCommand(
+                'history',
+                'idle: display the last <n> messages; conversation: display the last <n> messages of this conversation',
+                {TuiMode.Idle, TuiMode.Conversation},
+                ('n',),
+                TuiCommand._command_history
+            ),
+            'search': TuiCommand(
+                'search',
+                'search the message history for a text',
+                {TuiMode.Idle, TuiMode.Conversation},
+                ('text...',),
+                TuiCommand._command_search
+            ),
+            'pool': TuiCommand(
+                'pool',
+                'display statistics of the outbound connection pool',
+                {TuiMode.Idle, TuiMode.Conversation},
+                (),
+                lambda ctx: print(ctx.control.pool_stats())
+            ),
+            'stats': TuiCommand(
+                'stats',
+                'display traffic, handshake and timing metrics',
+                {TuiMode.Idle, TuiMode.Conversation},
+                (),
+                lambda ctx: print(ctx.control.stats())
+            ),
+            'profile': TuiCommand(
+                'profile',
+                'start or stop sampling the app\'s threads, on stop the stacks are written for flamegraph tools',
+                {TuiMode.Idle, TuiMode.Conversation},
+                ('start|stop',),
+                lambda ctx, action: print(ctx.control.profile(action))
+            ),
+            'flush-delay': TuiCommand(
+                'flush-delay',
+                'hold outgoing messages back for up to <ms> milliseconds to send bursts in one write (0 - off) in this conversation',
+                {TuiMode.Conversation},
+                ('ms',),
+                TuiCommand._command_flush_delay
             ),
             'exit': TuiCommand(
                 'exit',
                 'idle: exit the app; conversation: exit the conversation',
                 {TuiMode.Idle, TuiMode.Conversation},
-                1,
+                (),
                 TuiCommand._command_exit
             ),
             # 'reconnect': TuiCommand(
             #     'reconnect',
             #     'reconnect to the last conversation you exited in this app session',
             #     {TuiMode.Idle},
-            #     1,
+            #     (),
             #     lambda ctx: print('TODO: reconnect to the last conversation!')
             # ),
             # 'regenerate-keys': TuiCommand(
             #     'regenerate-keys',
             #     're-generate the openssl keys used to encrypt the conversation',
             #     {TuiMode.Idle},
-            #     1,
+            #     (),
             #     lambda ctx: print('TODO: regenerate the openssl keys!')
             # ),
             'help': TuiCommand(
                 'help', 
                 'display this `help` message', 
                 {TuiMode.Idle, TuiMode.Conversation},
-                1,
-                lambda ctx: print('\n'.join([f'\t/{cmd.name} - {cmd.description}' for cmd in TuiCommand.available_commands(ctx)]))
+                (),
+                lambda ctx: print('\n'.join([f'\t{cmd.usage} - {cmd.description}' for cmd in TuiCommand.available_commands(ctx).values()]))
             )
         }
     
@@ -208,31 +284,71 @@ class TuiCommand:
         if not user:
             print(f'Unknown user: `{username}`')
             return
-        users = ctx.control.users_list()
-        mapping = {}
-        for u in users:
-            if u.name == username:
-                continue
-            elif u.name == ctx.username:
-                continue
-            name = u.name
-            ip = u.addr[0]
-            if u.addr[1] != 2137:
-                port = f':{u.addr[1]}'
-            else:
-                port = ''
-            mapping[name] = f'{ip}{port}'
-        ctx.control.send(
+        ctx.control.accept(user)
+        ctx.change_mode(TuiMode.Conversation)
+    
+    @staticmethod
+    def _command_msg(ctx: TuiContext, msg: str):
+        deliveries = ctx.control.sendall(
             Packet.new(
                 ctx.username,
-                PayloadType.ACCEPT,
-                mapping,
-                port=ctx.port
-            ), 
-            user
+                PayloadType.MSG,
+                msg,
+            )
         )
-        ctx.change_mode(TuiMode.Conversation)
-    
+        for delivery in deliveries or []:
+            if not delivery.ok:
+                print(f'Couldn\'t deliver to {delivery.user}: {delivery.error}')
+
+    @staticmethod
+    def _command_whisper(ctx: TuiContext, username: str, msg: str):
+        user = ctx.control.find_by_username(username)
+        if not user:
+            print(f'Unknown user: `{username}`')
+            return
+        try:
+            ctx.control.send(Packet.new(ctx.username, PayloadType.WHISPER, msg), user)
+        except Exception as e:
+            print(f'Couldn\'t whisper to {username}: {e}')
+
+    @staticmethod
+    def _command_send_file(ctx: TuiContext, username: str, path: str):
+        user = ctx.control.find_by_username(username)
+        if not user:
+            print(f'Unknown user: `{username}`')
+            return
+        try:
+            transfer = ctx.control.send_file(os.path.expanduser(path), user)
+        except Exception as e:
+            print(f'Couldn\'t send `{path}` to {username}: {e}')
+            return
+        print(f'Sending {transfer} to {user}...')
+
+    @staticmethod
+    def _command_history(ctx: TuiContext, n: str):
+        if not n.isdigit():
+            print(f'`{n}` is not a number of messages')
+            return
+        for entry in ctx.control.history(int(n)):
+            print(entry)
+
+    @staticmethod
+    def _command_search(ctx: TuiContext, text: str):
+        entries = ctx.control.search(text)
+        if not entries:
+            print(f'No messages with `{text}`')
+        for entry in reversed(entries):
+            print(entry)
+
+    @staticmethod
+    def _command_flush_delay(ctx: TuiContext, ms: str):
+        try:
+            delay = float(ms) / 1000
+        except ValueError:
+            print(f'`{ms}` is not a number of milliseconds')
+            return
+        ctx.control.set_flush_delay(max(delay, 0.0))
+
     @staticmethod
     def _command_list(ctx: TuiContext):
         print('Users:')
@@ -268,7 +384,15 @@ class TuiCommand:
     
     @staticmethod
     def from_name(name: str):
-        return TuiCommand.all_commands().get(name, None)
+        return COMMANDS.get(name, None)
+
+
+# built once, a typed or piped line is dispatched with a single lookup
+COMMANDS: dict[str, TuiCommand] = TuiCommand._registry()
+MODE_COMMANDS: dict[TuiMode, dict[str, TuiCommand]] = {
+    mode: {name: cmd for name, cmd in COMMANDS.items() if mode in cmd.modes}
+    for mode in TuiMode
+}
 
 
 if __name__ == '__main__':